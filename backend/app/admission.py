@@ -0,0 +1,261 @@
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import parse_qs
+from fastapi.responses import JSONResponse
+import threading
+import math
+import time
+import os
+import logging
+from .events import get_broker
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first. Each has its own Celery queue so a backfill never
+# sits in front of a line-critical scan, and workers can be dedicated to a class with -Q.
+PRIORITIES = ("inline", "interactive", "backfill")
+QUEUE_PREFIX = os.getenv("QUEUE_PREFIX", "pcb")
+QUEUES = {p: f"{QUEUE_PREFIX}.{p}" for p in PRIORITIES}
+DEFAULT_PRIORITY = "interactive"
+BATCH_PRIORITY = "backfill"
+
+def _per_priority(value: str):
+    # "inline=10,interactive=60,backfill=3600"
+    limits = {}
+    for part in value.split(","):
+        if "=" in part:
+            name, limit = part.split("=", 1)
+            limits[name.strip()] = float(limit)
+    return limits
+
+ADMISSION_MAX_WAIT = _per_priority(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "inline=10,interactive=60,backfill=3600"))
+ADMISSION_MAX_DEPTH = _per_priority(os.getenv("ADMISSION_MAX_DEPTH", "inline=200,interactive=2000,backfill=100000"))
+ADMISSION_REFRESH_SECONDS = float(os.getenv("ADMISSION_REFRESH_SECONDS", "2"))
+ADMISSION_RETRY_SECONDS = int(os.getenv("ADMISSION_RETRY_SECONDS", "5"))
+WORKER_STALE_SECONDS = float(os.getenv("WORKER_STALE_SECONDS", "30"))
+LOAD_EWMA_ALPHA = 0.3
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "600"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "60"))
+RATE_LIMIT_CLIENT_HEADER = os.getenv("RATE_LIMIT_CLIENT_HEADER", "")
+RATE_LIMIT_MAX_CLIENTS = 10000
+LOAD_EVENT = "worker_load"
+
+def route_by_priority(name, args, kwargs, options, task=None, **kw):
+    # Celery router: tasks carrying a priority kwarg go to that class's queue.
+    priority = (kwargs or {}).get("priority")
+    if priority in QUEUES:
+        return {"queue": QUEUES[priority]}
+    return None
+
+class LoadTracker:
+    # Worker side. Rates are completions per second of time spent busy with a class, so a
+    # lightly loaded worker reports what it can drain rather than what it was offered.
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._in_flight = Counter()
+        self._busy_since = {}
+        self._busy = Counter()
+        self._completed = Counter()
+
+    @contextmanager
+    def track(self, priority: str, count: int = 1):
+        with self._lock:
+            if self._in_flight[priority] == 0:
+                self._busy_since[priority] = self.clock()
+            self._in_flight[priority] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[priority] -= 1
+                self._completed[priority] += count
+                if self._in_flight[priority] == 0:
+                    self._busy[priority] += self.clock() - self._busy_since.pop(priority)
+
+    def rates(self):
+        now = self.clock()
+        with self._lock:
+            rates = {}
+            for priority, completed in self._completed.items():
+                busy = self._busy[priority]
+                if priority in self._busy_since:
+                    busy += now - self._busy_since[priority]
+                    self._busy_since[priority] = now
+                if completed and busy > 0:
+                    rates[priority] = completed / busy
+            self._completed.clear()
+            self._busy.clear()
+            return rates
+
+    def report(self, worker: str):
+        # Sent every poll even when idle, so the API keeps counting this worker's capacity.
+        get_broker().publish({"type": LOAD_EVENT, "worker": worker, "rates": self.rates()})
+
+class AdmissionController:
+    # API side. Estimates how long new work would wait in a class's queue from the broker
+    # depth and the drain rates workers report, and turns work away past the class's limits.
+    # Depth is refreshed in the background so a slow or unreachable broker never stalls a request.
+    def __init__(self, depth_source, max_wait: dict = None, max_depth: dict = None,
+                 refresh_seconds: float = ADMISSION_REFRESH_SECONDS, stale_seconds: float = WORKER_STALE_SECONDS):
+        self.depth_source = depth_source
+        self.max_wait = max_wait if max_wait is not None else ADMISSION_MAX_WAIT
+        self.max_depth = max_depth if max_depth is not None else ADMISSION_MAX_DEPTH
+        self.refresh_seconds = refresh_seconds
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._depths = {}
+        self._admitted = Counter()
+        self._refreshed_at = None
+        self._refreshing = False
+        self._subscribed = False
+        self._workers = {}
+        self.rejected = Counter()
+
+    def start(self):
+        with self._lock:
+            if self._subscribed:
+                return
+            self._subscribed = True
+        get_broker().subscribe(self.observe)
+
+    def observe(self, event: dict):
+        if event.get("type") != LOAD_EVENT:
+            return
+        with self._lock:
+            _, rates = self._workers.get(event["worker"], (None, {}))
+            rates = dict(rates)
+            for priority, rate in (event.get("rates") or {}).items():
+                previous = rates.get(priority)
+                rates[priority] = rate if previous is None else LOAD_EWMA_ALPHA * rate + (1 - LOAD_EWMA_ALPHA) * previous
+            self._workers[event["worker"]] = (time.monotonic(), rates)
+
+    def throughput(self, priority: str):
+        cutoff = time.monotonic() - self.stale_seconds
+        with self._lock:
+            return sum(rates.get(priority, 0.0) for seen, rates in self._workers.values() if seen >= cutoff)
+
+    def _maybe_refresh(self):
+        with self._lock:
+            fresh = self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self.refresh_seconds
+            if self._refreshing or fresh:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="admission-refresh", daemon=True).start()
+
+    def refresh(self):
+        with self._lock:
+            self._refreshing = True
+            admitted_before = dict(self._admitted)
+        try:
+            depths = self.depth_source()
+        except Exception as e:
+            depths = None
+            logger.debug(f"Queue depth refresh failed: {e}")
+        with self._lock:
+            if depths is not None:
+                self._depths = {p: depths.get(queue, 0) for p, queue in QUEUES.items()}
+                # Work admitted while the depth was being read may or may not be in it; keep counting it.
+                for priority, count in admitted_before.items():
+                    self._admitted[priority] -= count
+            self._refreshed_at = time.monotonic()
+            self._refreshing = False
+
+    def check(self, priority: str, count: int = 1, reserve: bool = True):
+        # Returns None when admitted, otherwise the number of seconds to put in Retry-After.
+        # With reserve=False an admitted check is not counted as queued work.
+        self.start()
+        self._maybe_refresh()
+        rate = self.throughput(priority)
+        with self._lock:
+            depth = self._depths.get(priority, 0) + max(self._admitted[priority], 0) + count
+            retry, reason = None, None
+            max_depth = self.max_depth.get(priority)
+            max_wait = self.max_wait.get(priority)
+            if max_depth is not None and depth > max_depth:
+                retry = (depth - max_depth) / rate if rate else ADMISSION_RETRY_SECONDS
+                reason = "depth"
+            elif max_wait is not None and rate and depth / rate > max_wait:
+                retry = depth / rate - max_wait
+                reason = "wait"
+            if reason is None:
+                if reserve:
+                    self._admitted[priority] += count
+                return None
+            self.rejected[(priority, reason)] += 1
+        metrics.ADMISSION_REJECTED.labels(priority, reason).inc()
+        return max(1, math.ceil(retry))
+
+    def stats(self):
+        rates = {p: self.throughput(p) for p in PRIORITIES}
+        with self._lock:
+            return {
+                "depth": dict(self._depths),
+                "admitted_since_refresh": dict(self._admitted),
+                "throughput_per_sec": rates,
+                "workers": len(self._workers),
+                "rejected": {f"{p}:{r}": n for (p, r), n in self.rejected.items()},
+            }
+
+# Upload routes and the priority each defaults to.
+ADMISSION_PATHS = {"/predict": DEFAULT_PRIORITY, "/predict/batch": BATCH_PRIORITY}
+
+class AdmissionGate:
+    # Starlette spools the whole multipart body before a route runs, so a request the route
+    # turns away has already cost its upload. This sheds new work from the query string alone
+    # while the class is full; routes still admit after hashing, where cache hits skip the check.
+    def __init__(self, app, check, paths: dict = None):
+        self.app = app
+        self.check = check
+        self.paths = paths or ADMISSION_PATHS
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        priority = query.get("priority", [self.paths[scope["path"]]])[-1]
+        # Unknown priorities are left to the route's validation.
+        retry_after = self.check(priority) if priority in PRIORITIES else None
+        if retry_after is None:
+            return await self.app(scope, receive, send)
+        response = JSONResponse({"detail": f"The {priority} queue is full; retry later."}, status_code=429,
+                                headers={"Retry-After": str(retry_after)})
+        await response(scope, receive, send)
+
+class RateLimiter:
+    # Token bucket per client: up to `burst` requests at once, refilled at rate_per_minute.
+    def __init__(self, rate_per_minute: float = RATE_LIMIT_PER_MINUTE, burst: int = RATE_LIMIT_BURST,
+                 clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def acquire(self, client: str):
+        # Returns 0 when the request may proceed, otherwise the seconds until a token is available.
+        if self.rate <= 0:
+            return 0.0
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[client] = (tokens - 1, now)
+                if len(self._buckets) > RATE_LIMIT_MAX_CLIENTS:
+                    self._prune(now)
+                return 0.0
+            self._buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now: float):
+        # A bucket that has refilled completely carries no state worth keeping.
+        for client, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self.rate >= self.burst:
+                del self._buckets[client]
+
+def client_id(request):
+    if RATE_LIMIT_CLIENT_HEADER and request.headers.get(RATE_LIMIT_CLIENT_HEADER):
+        return request.headers[RATE_LIMIT_CLIENT_HEADER]
+    return request.client.host if request.client else "unknown"
@@ -1,39 +1,316 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
-from sqlalchemy.orm import Session
-from backend.app.models import get_db
-from backend.app.services import get_history, get_task_status, create_task_entry
-from backend.app.tasks import predict_defect
-import shutil
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, StreamingResponse
+from typing import List, Optional
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from backend.app.models import AsyncSessionLocal, get_db
+from backend.app.services import (
+    get_history, get_task_status, create_task_entry, find_cached_prediction, get_cache_stats,
+    find_cached_predictions, create_task_entries, get_batch_status, get_batch_tasks, get_status_snapshot,
+)
+from backend.app.events import Subscription, get_broker
+from backend.app.stats import get_stats, ALL_VERSIONS
+from backend.app.defects import query_defects, defect_density
+from backend.app.tasks import predict_defect, dispatch_batch, queue_depths
+from backend.app.admission import (
+    PRIORITIES, DEFAULT_PRIORITY, BATCH_PRIORITY, AdmissionController, RateLimiter, client_id,
+)
+from backend.app.model_registry import registry
+from backend.app.uploads import (
+    UPLOAD_DIR, MAX_BATCH_FILES, MAX_UPLOAD_BYTES, receive_upload, receive_archive, place_uploads, discard_uploads, is_archive,
+)
+from backend.app.streaming import FrameStream, STREAM_DUP_THRESHOLD
+from backend.app import tiling, metrics, renders, golden
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import json
+import math
+import time
 import os
 import uuid
 
 router = APIRouter()
 
-UPLOAD_DIR = "/app/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+FINAL_STATUSES = ("SUCCESS", "FAILURE")
+EVENTS_HEARTBEAT_SECONDS = 15
+RENDER_CACHE_CONTROL = "public, max-age=86400"
 
-@router.post("/predict")
-async def predict_image(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    if not file.content_type.startswith("image/"):
+PRIORITY_PATTERN = f"^({'|'.join(PRIORITIES)})$"
+
+admission = AdmissionController(queue_depths)
+rate_limiter = RateLimiter()
+
+def enforce_rate_limit(request: Request):
+    wait = rate_limiter.acquire(client_id(request))
+    if wait:
+        metrics.ADMISSION_REJECTED.labels("any", "rate_limit").inc()
+        raise HTTPException(status_code=429, detail="Rate limit exceeded.", headers={"Retry-After": str(math.ceil(wait))})
+
+def _admit(priority: str, count: int = 1):
+    retry_after = admission.check(priority, count)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429, detail=f"The {priority} queue is full; retry later.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+def precheck_admission(priority: str):
+    # Run by AdmissionGate before the body is read: would one more item of new work be admitted
+    # now? Nothing is reserved; the route admits for real once cache hits are known.
+    return admission.check(priority, reserve=False)
+
+def _render_urls(task_id: str):
+    return {"thumbnail_url": f"/thumbnail/{task_id}", "overlay_url": f"/overlay/{task_id}"}
+
+def get_inference_options(
+    tiled: bool = False,
+    tile_size: int = Query(tiling.DEFAULT_TILE_SIZE, ge=64, le=4096),
+    tile_overlap: float = Query(tiling.DEFAULT_TILE_OVERLAP, ge=0.0, lt=0.9),
+    skip_blank_std: float = Query(tiling.DEFAULT_BLANK_STD, ge=0.0),
+    board_type: Optional[str] = None,
+):
+    options = {}
+    if tiled:
+        options["tiling"] = {"tile_size": tile_size, "tile_overlap": tile_overlap, "skip_blank_std": skip_blank_std}
+    if board_type:
+        meta = golden.reference_meta(board_type) if golden.valid_board_type(board_type) else None
+        if meta is None:
+            raise HTTPException(status_code=400, detail=f"No golden reference registered for board type {board_type}.")
+        # The reference version is part of the options, so re-registering a reference invalidates cached results.
+        options["reference"] = {"board_type": board_type, "version": meta["version"]}
+    return options
+
+@router.post("/predict", dependencies=[Depends(enforce_rate_limit)])
+async def predict_image(
+    file: UploadFile = File(...),
+    options: dict = Depends(get_inference_options),
+    priority: str = Query(DEFAULT_PRIORITY, pattern=PRIORITY_PATTERN),
+    db: AsyncSession = Depends(get_db),
+):
+    if file.content_type and not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
 
     file_id = str(uuid.uuid4())
-    extension = file.filename.split(".")[-1]
-    filename = f"{file_id}.{extension}"
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    model_version = await run_in_threadpool(registry.version)
+    with metrics.stage_timer("upload_write", model_version):
+        tmp_path, filename, content_hash, _ = await receive_upload(file)
 
-    db_task = create_task_entry(db, file_id, filename, file.filename)
+    inference_options = json.dumps(options, sort_keys=True) if options else ""
 
-    task = predict_defect.delay(file_path, file_id)
-    
-    return {"task_id": file_id, "status": "PENDING", "image_url": f"/uploads/{filename}"}
+    try:
+        with metrics.stage_timer("cache_lookup", model_version):
+            cached = await db.run_sync(find_cached_prediction, content_hash, model_version, inference_options)
+        # Cached answers cost no worker time, so only new work is subject to admission control.
+        if not cached:
+            _admit(priority)
+    except BaseException:
+        await run_in_threadpool(discard_uploads, [tmp_path])
+        raise
+    [file_path] = await run_in_threadpool(place_uploads, [(tmp_path, filename)])
+
+    if cached:
+        with metrics.stage_timer("create_task_entry", model_version):
+            entry = await db.run_sync(
+                create_task_entry, file_id, filename, file.filename, content_hash, model_version, inference_options,
+                status=cached.status, result=cached.result, source_task_id=cached.task_id,
+            )
+        # The entry carries the source's final result if it finished after the lookup above.
+        response = {"task_id": file_id, "status": entry.status, "image_url": f"/uploads/{filename}",
+                    **_render_urls(file_id), "cached": True, "source_task_id": cached.task_id}
+        if entry.status == "SUCCESS":
+            response["result"] = entry.result
+        return response
+
+    with metrics.stage_timer("create_task_entry", model_version):
+        await db.run_sync(
+            create_task_entry, file_id, filename, file.filename, content_hash, model_version, inference_options
+        )
+
+    with metrics.stage_timer("dispatch", model_version):
+        task = await run_in_threadpool(predict_defect.delay, file_path, file_id, options, time.time(), priority=priority)
+
+    return {"task_id": file_id, "status": "PENDING", "image_url": f"/uploads/{filename}", **_render_urls(file_id)}
+
+@router.post("/predict/batch", dependencies=[Depends(enforce_rate_limit)])
+async def predict_batch(
+    files: List[UploadFile] = File(...),
+    options: dict = Depends(get_inference_options),
+    priority: str = Query(BATCH_PRIORITY, pattern=PRIORITY_PATTERN),
+    db: AsyncSession = Depends(get_db),
+):
+    received, rejected = [], []
+    try:
+        for file in files:
+            header = await file.read(512)
+            await file.seek(0)
+            if is_archive(header):
+                members, skipped = await run_in_threadpool(receive_archive, file.file)
+                received.extend(members)
+                rejected.extend(skipped)
+            else:
+                try:
+                    received.append((file.filename, *await receive_upload(file)))
+                except HTTPException as e:
+                    rejected.append({"filename": file.filename, "reason": e.detail})
+            if len(received) > MAX_BATCH_FILES:
+                raise HTTPException(status_code=413, detail=f"Batch holds more than {MAX_BATCH_FILES} files.")
+        if not received:
+            raise HTTPException(status_code=400, detail="No images found in batch.")
+
+        batch_id = str(uuid.uuid4())
+        inference_options = json.dumps(options, sort_keys=True) if options else ""
+        model_version = await run_in_threadpool(registry.version)
+        cached = await db.run_sync(find_cached_predictions, [item[3] for item in received], model_version, inference_options)
+
+        entries, queued = [], []
+        first_in_batch = {}
+        for original_filename, _, filename, content_hash, _ in received:
+            task_id = str(uuid.uuid4())
+            entry = {
+                "task_id": task_id, "filename": filename, "original_filename": original_filename,
+                "status": "PENDING", "content_hash": content_hash, "model_version": model_version,
+                "inference_options": inference_options, "batch_id": batch_id,
+            }
+            source = cached.get(content_hash)
+            if source is not None:
+                entry.update(status=source.status, result=source.result, source_task_id=source.task_id)
+            elif content_hash in first_in_batch:
+                entry["source_task_id"] = first_in_batch[content_hash]
+            else:
+                first_in_batch[content_hash] = task_id
+                queued.append((filename, task_id))
+            entries.append(entry)
+
+        if queued:
+            _admit(priority, len(queued))
+    except BaseException:
+        await run_in_threadpool(discard_uploads, [item[1] for item in received])
+        raise
+    paths = await run_in_threadpool(place_uploads, [(tmp_path, filename) for _, tmp_path, filename, _, _ in received])
+    file_paths = dict(zip((item[2] for item in received), paths))
+    queued = [(file_paths[filename], task_id) for filename, task_id in queued]
+
+    with metrics.stage_timer("create_task_entry", model_version):
+        entries = await db.run_sync(create_task_entries, entries)
+    if queued:
+        with metrics.stage_timer("dispatch", model_version):
+            await run_in_threadpool(dispatch_batch, queued, options, batch_id, priority=priority)
+
+    return {
+        "batch_id": batch_id,
+        "total": len(entries),
+        "queued": len(queued),
+        "cached": len(entries) - len(queued),
+        "rejected": rejected,
+        "tasks": [{"task_id": e["task_id"], "filename": e["original_filename"], "status": e["status"]} for e in entries],
+    }
+
+@router.websocket("/stream")
+async def stream_frames(websocket: WebSocket, dup_threshold: int = Query(STREAM_DUP_THRESHOLD, ge=0, le=64)):
+    # Binary messages are encoded frames (JPEG/PNG); the text message "end" finishes the stream
+    # and is answered with a summary once every frame sent before it has been handled.
+    await websocket.accept()
+    stream = FrameStream(websocket.send_json, dup_threshold=dup_threshold)
+    runner = asyncio.create_task(stream.run())
+    try:
+        while not runner.done():
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                stream.feed(message["bytes"])
+            elif message.get("text") == "end":
+                await stream.end()
+                await websocket.send_json(await runner)
+                await websocket.close()
+                return
+        await runner
+    except WebSocketDisconnect:
+        pass
+    finally:
+        runner.cancel()
+
+@router.get("/batch/{batch_id}")
+async def check_batch_status(batch_id: str, include_tasks: bool = False, db: AsyncSession = Depends(get_db)):
+    status = await db.run_sync(get_batch_status, batch_id)
+    if not status:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    if include_tasks:
+        status["tasks"] = [
+            {"task_id": t.task_id, "filename": t.original_filename, "status": t.status,
+             "result": t.result if t.status == "SUCCESS" else None}
+            for t in await db.run_sync(get_batch_tasks, batch_id)
+        ]
+    return status
+
+def _sse(event: dict):
+    return f"event: status\ndata: {json.dumps(event, default=str)}\n\n"
+
+async def _load_result(task_id: str):
+    async with AsyncSessionLocal() as db:
+        task = await db.run_sync(get_task_status, task_id)
+        return task.result if task else None
+
+@router.get("/events")
+async def stream_status(
+    task_id: List[str] = Query([]),
+    batch_id: List[str] = Query([]),
+    db: AsyncSession = Depends(get_db),
+):
+    if not task_id and not batch_id:
+        raise HTTPException(status_code=400, detail="Subscribe to at least one task_id or batch_id")
+
+    # Subscribe before reading the snapshot so no transition can fall between the two.
+    subscription = Subscription(asyncio.get_running_loop(), task_id, batch_id)
+    broker = get_broker()
+    broker.subscribe(subscription)
+    try:
+        snapshot = await db.run_sync(get_status_snapshot, task_id, batch_id)
+    except Exception:
+        broker.unsubscribe(subscription)
+        raise
+    finally:
+        # Streams can stay open for minutes; give the pooled connection back right away.
+        await db.close()
+
+    async def stream():
+        try:
+            pending = set()
+            for row in snapshot:
+                event = {"task_id": row.task_id, "status": row.status, "batch_id": row.batch_id}
+                if row.status == "SUCCESS":
+                    event["result"] = row.result
+                if row.status not in FINAL_STATUSES:
+                    pending.add(row.task_id)
+                yield _sse(event)
+            for missing in set(task_id) - {row.task_id for row in snapshot}:
+                yield _sse({"task_id": missing, "status": "NOT_FOUND"})
+
+            while pending:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event.pop("result_truncated", False):
+                    event["result"] = await _load_result(event["task_id"])
+                if event["status"] in FINAL_STATUSES:
+                    pending.discard(event["task_id"])
+                elif event.get("batch_id") in subscription.batch_ids:
+                    pending.add(event["task_id"])
+                yield _sse(event)
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @router.get("/status/{task_id}")
-def check_status(task_id: str, db: Session = Depends(get_db)):
-    task = get_task_status(db, task_id)
+async def check_status(task_id: str, db: AsyncSession = Depends(get_db)):
+    task = await db.run_sync(get_task_status, task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
@@ -49,7 +326,116 @@ def check_status(task_id: str, db: Session = Depends(get_db)):
     
     return response
 
+async def _serve_render(kind: str, task_id: str, request: Request, db: AsyncSession):
+    task = await db.run_sync(get_task_status, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if kind == "overlay" and task.status != "SUCCESS":
+        raise HTTPException(status_code=404, detail="Overlay is available once the task succeeds")
+    result = task.result if kind == "overlay" else None
+    # The render name is content-addressed, so it doubles as a strong ETag and a
+    # revalidation never touches the image on disk.
+    etag = f'"{renders.render_name(task.filename, kind, result)}"'
+    headers = {"ETag": etag, "Cache-Control": RENDER_CACHE_CONTROL}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    # Rows from before the worker rendered previews are rendered here once and cached;
+    # cached previews outlive their source image when retention removes it.
+    path = renders.render_path(task.filename, kind, result)
+    if not os.path.exists(path):
+        image_path = os.path.join(UPLOAD_DIR, task.filename)
+        if not os.path.exists(image_path):
+            raise HTTPException(status_code=404, detail="Source image is no longer available")
+        path = (await run_in_threadpool(renders.render, image_path, (kind,), result))[kind]
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
+@router.get("/thumbnail/{task_id}")
+async def get_thumbnail(task_id: str, request: Request, db: AsyncSession = Depends(get_db)):
+    return await _serve_render("thumbnail", task_id, request, db)
+
+@router.get("/overlay/{task_id}")
+async def get_overlay(task_id: str, request: Request, db: AsyncSession = Depends(get_db)):
+    return await _serve_render("overlay", task_id, request, db)
+
 @router.get("/history")
-def get_prediction_history(skip: int = 0, limit: int = 20, db: Session = Depends(get_db)):
-    history = get_history(db, skip, limit)
+async def get_prediction_history(
+    response: Response,
+    skip: int = 0,
+    limit: int = Query(20, ge=1, le=500),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    defect_type: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    fields: str = Query("full", pattern="^(full|summary)$"),
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        history, next_cursor = await db.run_sync(
+            get_history, skip, limit, cursor=cursor, status=status, defect_type=defect_type,
+            date_from=date_from, date_to=date_to, summary=fields == "summary",
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return history
+
+@router.get("/cache/stats")
+async def get_result_cache_stats(db: AsyncSession = Depends(get_db)):
+    return await db.run_sync(get_cache_stats)
+
+@router.post("/references/{board_type}")
+async def register_golden_reference(board_type: str, file: UploadFile = File(...)):
+    if not golden.valid_board_type(board_type):
+        raise HTTPException(status_code=400, detail="Board type may only contain letters, digits, '.', '_' and '-'.")
+    data = await file.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {MAX_UPLOAD_BYTES} bytes.")
+    try:
+        return await run_in_threadpool(golden.register_reference, board_type, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/references")
+async def list_golden_references():
+    return await run_in_threadpool(golden.list_references)
+
+@router.get("/admission/stats")
+async def get_admission_stats():
+    return admission.stats()
+
+@router.get("/stats")
+async def get_prediction_stats(
+    model_version: str = ALL_VERSIONS,
+    granularity: Optional[str] = Query(None, pattern="^(hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    return await db.run_sync(get_stats, model_version, granularity, since, until)
+
+@router.get("/defects")
+async def get_defects(
+    response: Response,
+    defect_type: Optional[str] = None,
+    min_confidence: Optional[float] = Query(None, ge=0.0, le=1.0),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[int] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    defects, next_cursor = await db.run_sync(query_defects, defect_type, min_confidence, since, until, limit, cursor)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return defects
+
+@router.get("/defects/density")
+async def get_defect_density(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    defect_type: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    return await db.run_sync(defect_density, since, until, defect_type)
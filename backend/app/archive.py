@@ -0,0 +1,319 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import insert, or_
+from datetime import datetime, timedelta
+from collections import defaultdict
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import json
+import os
+import time
+import uuid
+import logging
+from .models import PredictionHistory, PredictionArchive, ArchivedTask
+from .uploads import UPLOAD_DIR
+from . import renders
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/app/archive")
+HOT_RETENTION_DAYS = int(os.getenv("HOT_RETENTION_DAYS", "30"))
+IMAGE_RETENTION_DAYS = int(os.getenv("IMAGE_RETENTION_DAYS", "90"))
+IMAGE_RETENTION_ACTION = os.getenv("IMAGE_RETENTION_ACTION", "delete")
+IMAGE_ARCHIVE_DIR = os.getenv("IMAGE_ARCHIVE_DIR", os.path.join(ARCHIVE_DIR, "uploads"))
+ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", "5000"))
+ARCHIVABLE_STATUSES = ("SUCCESS", "FAILURE")
+
+# Hot/cold split: prediction_history only keeps recent and unfinished rows. Older final
+# rows are moved to zstd Parquet files under <archive>/prediction_history/<YYYY-MM>/,
+# and prediction_archive indexes each file by its created_at range so reads open only
+# the files that can match.
+SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("task_id", pa.string()),
+    ("filename", pa.string()),
+    ("original_filename", pa.string()),
+    ("result", pa.string()),
+    ("status", pa.string()),
+    ("created_at", pa.timestamp("us")),
+    ("content_hash", pa.string()),
+    ("model_version", pa.string()),
+    ("inference_options", pa.string()),
+    ("source_task_id", pa.string()),
+    ("batch_id", pa.string()),
+    ("defect_count", pa.int32()),
+    ("defect_types", pa.string()),
+])
+COLUMNS = SCHEMA.names
+
+def _write_file(rows: list, archive_dir: str):
+    month = rows[0]["created_at"].strftime("%Y-%m")
+    relative = os.path.join("prediction_history", month, f"part-{uuid.uuid4().hex}.parquet")
+    path = os.path.join(archive_dir, relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rows = sorted(rows, key=lambda r: (r["created_at"], r["id"]))
+    columns = {c: [r[c] for r in rows] for c in COLUMNS}
+    columns["result"] = [json.dumps(r) if r is not None else None for r in columns["result"]]
+    tmp_path = f"{path}.part"
+    pq.write_table(pa.table(columns, schema=SCHEMA), tmp_path, compression="zstd")
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return PredictionArchive(
+        path=relative, period_start=rows[0]["created_at"], period_end=rows[-1]["created_at"],
+        min_id=min(r["id"] for r in rows), max_id=max(r["id"] for r in rows),
+        row_count=len(rows), size_bytes=os.path.getsize(path),
+    )
+
+def _index_tasks(db: Session, archive_id: int, task_ids: list):
+    task_ids = [task_id for task_id in task_ids if task_id is not None]
+    if task_ids:
+        db.execute(insert(ArchivedTask), [{"task_id": task_id, "archive_id": archive_id} for task_id in task_ids])
+
+def index_archived_tasks(db: Session, archive_dir: str = None):
+    # Fills archived_task for files written before it existed.
+    archive_dir = archive_dir or ARCHIVE_DIR
+    indexed = 0
+    for entry in _archive_files(db):
+        task_ids = _read(os.path.join(archive_dir, entry.path), ["task_id"], None).column("task_id").to_pylist()
+        _index_tasks(db, entry.id, task_ids)
+        indexed += len(task_ids)
+    db.commit()
+    return indexed
+
+def archive_rows(db: Session, older_than: datetime, archive_dir: str = None,
+                 chunk_size: int = ARCHIVE_CHUNK_SIZE):
+    # Each chunk is written and fsynced before the index rows and the deletes commit in one
+    # transaction; a crash in between leaves an unindexed file that readers never open.
+    archive_dir = archive_dir or ARCHIVE_DIR
+    columns = [getattr(PredictionHistory, c) for c in COLUMNS]
+    archived, files, last_id = 0, 0, 0
+    while True:
+        rows = (
+            db.query(*columns)
+            .filter(PredictionHistory.id > last_id, PredictionHistory.created_at < older_than,
+                    PredictionHistory.status.in_(ARCHIVABLE_STATUSES))
+            .order_by(PredictionHistory.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not rows:
+            break
+        by_month = defaultdict(list)
+        for row in rows:
+            by_month[row.created_at.strftime("%Y-%m")].append(row._asdict())
+        for month_rows in by_month.values():
+            entry = _write_file(month_rows, archive_dir)
+            db.add(entry)
+            db.flush()
+            _index_tasks(db, entry.id, [row["task_id"] for row in month_rows])
+            files += 1
+        ids = [row.id for row in rows]
+        # prediction_defect rows stay: they are the compact, indexed projection long-range defect
+        # queries and rollup rebuilds read, and they refer to archived predictions by id.
+        db.query(PredictionHistory).filter(PredictionHistory.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        archived += len(rows)
+        last_id = ids[-1]
+    return {"rows": archived, "files": files}
+
+def _archive_files(db: Session, since: datetime = None, until: datetime = None):
+    query = db.query(PredictionArchive)
+    if since:
+        query = query.filter(PredictionArchive.period_end >= since)
+    if until:
+        query = query.filter(PredictionArchive.period_start < until)
+    return query.order_by(PredictionArchive.period_end.desc()).all()
+
+def has_archives(db: Session):
+    return db.query(PredictionArchive.id).first() is not None
+
+def _read(path: str, columns: list, filters: list):
+    return pq.read_table(path, columns=columns, filters=filters or None, schema=SCHEMA)
+
+def query_archive(db: Session, limit: int, cursor: tuple = None, status: str = None, defect_type: str = None,
+                  date_from: datetime = None, date_to: datetime = None, columns: list = None,
+                  archive_dir: str = None):
+    # Returns up to `limit` archived rows newest first, in the same (created_at, id) keyset order
+    # as get_history so the two can be merged and paginated with one cursor.
+    archive_dir = archive_dir or ARCHIVE_DIR
+    columns = columns or COLUMNS
+    base = []
+    if status:
+        base.append(("status", "=", status))
+    if date_from:
+        base.append(("created_at", ">=", date_from))
+    if date_to:
+        base.append(("created_at", "<", date_to))
+    filters = [base]
+    if cursor:
+        filters = [base + [("created_at", "<", cursor[0])], base + [("created_at", "=", cursor[0]), ("id", "<", cursor[1])]]
+    until = date_to
+    if cursor:
+        until = min(until, cursor[0] + timedelta(microseconds=1)) if until else cursor[0] + timedelta(microseconds=1)
+
+    found = []
+    for entry in _archive_files(db, date_from, until):
+        # Files are visited newest first; once `limit` rows are in hand, a file that ends
+        # before the oldest of them cannot contribute.
+        if len(found) >= limit and entry.period_end < found[limit - 1][0]:
+            break
+        table = _read(os.path.join(archive_dir, entry.path), list(set(columns) | {"id", "created_at", "defect_types"}),
+                      [f for f in filters if f] or None)
+        if defect_type:
+            table = table.filter(pc.match_substring(pc.fill_null(table["defect_types"], ""), f",{defect_type},"))
+        for row in table.to_pylist():
+            found.append((row["created_at"], row["id"], row))
+        found.sort(key=lambda r: (r[0], r[1]), reverse=True)
+        del found[limit:]
+    rows = []
+    for _, _, row in found:
+        if "result" in columns and row.get("result") is not None:
+            row["result"] = json.loads(row["result"])
+        rows.append({c: row[c] for c in columns})
+    return rows
+
+def find_archived_task(db: Session, task_id: str, archive_dir: str = None):
+    # archived_task names the one file holding the task; ids it doesn't know never reach Parquet.
+    archive_dir = archive_dir or ARCHIVE_DIR
+    entry = (
+        db.query(PredictionArchive)
+        .join(ArchivedTask, ArchivedTask.archive_id == PredictionArchive.id)
+        .filter(ArchivedTask.task_id == task_id)
+        .first()
+    )
+    if entry is None:
+        return None
+    table = _read(os.path.join(archive_dir, entry.path), COLUMNS, [("task_id", "=", task_id)])
+    if not table.num_rows:
+        return None
+    row = table.slice(0, 1).to_pylist()[0]
+    if row["result"] is not None:
+        row["result"] = json.loads(row["result"])
+    return row
+
+def find_archived_by_id(db: Session, ids: list, columns: list = None, archive_dir: str = None):
+    # prediction_archive records each file's id range, so only files that can hold the ids are opened.
+    archive_dir = archive_dir or ARCHIVE_DIR
+    columns = columns or COLUMNS
+    ids = sorted(set(ids))
+    found = {}
+    if not ids:
+        return found
+    entries = db.query(PredictionArchive).filter(PredictionArchive.min_id <= ids[-1], PredictionArchive.max_id >= ids[0])
+    for entry in entries:
+        wanted = [i for i in ids if entry.min_id <= i <= entry.max_id and i not in found]
+        if wanted:
+            table = _read(os.path.join(archive_dir, entry.path), list(set(columns) | {"id"}), [("id", "in", wanted)])
+            found.update((row["id"], row) for row in table.to_pylist())
+    return found
+
+def iter_archived(db: Session, columns: list, archive_dir: str = None):
+    archive_dir = archive_dir or ARCHIVE_DIR
+    for entry in _archive_files(db):
+        for batch in _read(os.path.join(archive_dir, entry.path), columns, None).to_batches():
+            for row in batch.to_pylist():
+                if row.get("result") is not None:
+                    row["result"] = json.loads(row["result"])
+                yield row
+
+def _referenced_archived(db: Session, names: list, since: datetime, archive_dir: str = None):
+    archive_dir = archive_dir or ARCHIVE_DIR
+    referenced = set()
+    for entry in _archive_files(db, since=since):
+        table = _read(os.path.join(archive_dir, entry.path), ["filename"],
+                      [("created_at", ">=", since), ("filename", "in", names)])
+        referenced.update(table.column("filename").to_pylist())
+    return referenced
+
+def _drop_referenced_hot(db: Session, candidates: dict, cutoff: datetime):
+    names = list(candidates)
+    for i in range(0, len(names), 500):
+        in_use = (
+            db.query(PredictionHistory.filename)
+            .filter(PredictionHistory.filename.in_(names[i:i + 500]),
+                    or_(PredictionHistory.created_at >= cutoff, PredictionHistory.status.notin_(ARCHIVABLE_STATUSES)))
+            .distinct()
+        )
+        for (name,) in in_use:
+            candidates.pop(name, None)
+
+def _claim_aged(path: str, cutoff_ts: float):
+    # The file is moved aside before its age is checked again. An upload that dedups onto it
+    # either touched it first (the mtime is recent and it is put back) or finds it gone and
+    # stores its own copy, so a row created meanwhile never loses its image.
+    claimed = os.path.join(os.path.dirname(path), f".retire-{uuid.uuid4().hex}")
+    try:
+        os.replace(path, claimed)
+    except FileNotFoundError:
+        return None
+    if os.stat(claimed).st_mtime >= cutoff_ts:
+        os.replace(claimed, path)
+        return None
+    return claimed
+
+def apply_image_retention(db: Session, days: int = IMAGE_RETENTION_DAYS, action: str = IMAGE_RETENTION_ACTION,
+                          upload_dir: str = UPLOAD_DIR, target_dir: str = IMAGE_ARCHIVE_DIR,
+                          archive_dir: str = None):
+    # Uploads are content-addressed and shared by duplicate rows, so a file only ages out
+    # once no unfinished row and no row newer than the cutoff (hot or archived) uses it.
+    # Thumbnails are kept so history listings still show a preview.
+    if days <= 0:
+        return {"removed": 0, "action": action}
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    cutoff_ts = time.time() - days * 86400
+    candidates = {}
+    with os.scandir(upload_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.startswith(".") and entry.stat().st_mtime < cutoff_ts:
+                candidates[entry.name] = entry.path
+    _drop_referenced_hot(db, candidates, cutoff)
+    if candidates:
+        for name in _referenced_archived(db, list(candidates), cutoff, archive_dir):
+            candidates.pop(name, None)
+    # Rows may have started using a file while the archives were read.
+    _drop_referenced_hot(db, candidates, cutoff)
+
+    if action == "move":
+        os.makedirs(target_dir, exist_ok=True)
+    removed = []
+    for name, path in candidates.items():
+        claimed = _claim_aged(path, cutoff_ts)
+        if claimed is None:
+            continue
+        if action == "move":
+            os.replace(claimed, os.path.join(target_dir, name))
+        else:
+            os.remove(claimed)
+        removed.append(name)
+    stems = {os.path.splitext(name)[0] for name in removed}
+    if stems and os.path.isdir(renders.RENDER_DIR):
+        for render in os.listdir(renders.RENDER_DIR):
+            if "-overlay" in render and render.split("-overlay")[0] in stems:
+                os.remove(os.path.join(renders.RENDER_DIR, render))
+    return {"removed": len(removed), "action": action}
+
+def compact(db: Session, hot_days: int = HOT_RETENTION_DAYS, image_days: int = IMAGE_RETENTION_DAYS,
+            image_action: str = IMAGE_RETENTION_ACTION):
+    start = time.perf_counter()
+    rows = archive_rows(db, datetime.utcnow() - timedelta(days=hot_days))
+    images = apply_image_retention(db, image_days, image_action)
+    summary = {"archived": rows, "images": images, "seconds": round(time.perf_counter() - start, 3)}
+    logger.info(f"Compaction finished: {summary}")
+    return summary
+
+if __name__ == "__main__":
+    import argparse
+    from .models import SessionLocal
+    from .migrations import migrate
+    parser = argparse.ArgumentParser(description="Archive old prediction_history rows and age out uploads")
+    parser.add_argument("--hot-days", type=int, default=HOT_RETENTION_DAYS)
+    parser.add_argument("--image-days", type=int, default=IMAGE_RETENTION_DAYS)
+    parser.add_argument("--image-action", choices=["delete", "move"], default=IMAGE_RETENTION_ACTION)
+    args = parser.parse_args()
+    migrate()
+    session = SessionLocal()
+    try:
+        print(f"Compaction complete: {compact(session, args.hot_days, args.image_days, args.image_action)}")
+    finally:
+        session.close()
@@ -0,0 +1,126 @@
+from collections import Counter, deque
+from concurrent.futures import Future
+import numpy as np
+import threading
+import queue
+import time
+import os
+import logging
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "20"))
+STATS_WINDOW = 1000
+
+class MicroBatcher:
+    def __init__(self, handler, max_batch_size: int = BATCH_MAX_SIZE, max_wait_ms: float = BATCH_MAX_WAIT_MS,
+                 version=None):
+        self.handler = handler
+        self.version = version
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batch_sizes = Counter()
+        self.queue_waits = deque(maxlen=STATS_WINDOW)
+        self.batch_latencies = deque(maxlen=STATS_WINDOW)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        self.start()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._process(batch)
+            except Exception as e:
+                metrics.record_error("micro_batcher", e)
+                logger.error(f"Micro-batcher failed on a batch of {len(batch)}: {e}")
+            # The thread outlives any failure above, and no submitter is left waiting on a future.
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Micro-batch produced no result for this item"))
+
+    def _process(self, batch):
+        started = time.perf_counter()
+        items = [item for item, _, _ in batch]
+        with self._lock:
+            self.batch_sizes[len(batch)] += 1
+            self.queue_waits.extend(started - enqueued for _, _, enqueued in batch)
+        version = None
+        try:
+            version = self.version() if self.version else None
+            for _, _, enqueued in batch:
+                metrics.observe_stage("batch_wait", started - enqueued, version)
+            results = list(self.handler(items))
+            if len(results) != len(items):
+                raise RuntimeError(f"Handler returned {len(results)} results for {len(items)} items")
+            outcomes = [(result, None) for result in results]
+        except Exception as e:
+            metrics.record_error("micro_batcher", e, version)
+            logger.warning(f"Batch of {len(batch)} failed ({e}), retrying items individually")
+            outcomes = [self._run_single(item) for item in items]
+        with self._lock:
+            self.batch_latencies.append(time.perf_counter() - started)
+        for (_, future, _), (result, error) in zip(batch, outcomes):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _run_single(self, item):
+        try:
+            return self.handler([item])[0], None
+        except Exception as e:
+            return None, e
+
+    def stats(self):
+        with self._lock:
+            waits = np.array(self.queue_waits) * 1000
+            latencies = np.array(self.batch_latencies) * 1000
+            batches = sum(self.batch_sizes.values())
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "pending": self._queue.qsize(),
+                "batches": batches,
+                "images": sum(size * count for size, count in self.batch_sizes.items()),
+                "batch_size_distribution": dict(sorted(self.batch_sizes.items())),
+                "queue_wait_ms": _summary(waits),
+                "batch_latency_ms": _summary(latencies),
+            }
+
+def _summary(values):
+    if not len(values):
+        return {}
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(values.max()),
+    }
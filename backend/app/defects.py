@@ -0,0 +1,124 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import func, insert, or_, update
+from datetime import datetime
+from .models import PredictionHistory, PredictionDefect
+from . import archive
+
+def summarize_result(result: dict):
+    if not result or "defects" not in result:
+        return {"defect_count": None, "defect_types": None}
+    types = sorted({d.get("type", "unknown") for d in result["defects"]})
+    return {"defect_count": len(result["defects"]), "defect_types": f",{','.join(types)}," if types else ""}
+
+def defect_rows(prediction_id: int, created_at: datetime, result: dict):
+    rows = []
+    for d in (result or {}).get("defects") or []:
+        bbox = list(d.get("bbox") or []) + [None] * 4
+        rows.append({
+            "prediction_id": prediction_id,
+            "class_id": d.get("class_id"),
+            "defect_type": d.get("type", "unknown"),
+            "confidence": float(d.get("confidence", 0.0)),
+            "x1": bbox[0], "y1": bbox[1], "x2": bbox[2], "y2": bbox[3],
+            "created_at": created_at,
+        })
+    return rows
+
+def record_defects(db: Session, completed: list):
+    # completed: (prediction_id, created_at, result) for rows that just reached a final status.
+    rows = [row for prediction_id, created_at, result in completed for row in defect_rows(prediction_id, created_at, result)]
+    if rows:
+        db.execute(insert(PredictionDefect), rows)
+    return len(rows)
+
+def query_defects(db: Session, defect_type: str = None, min_confidence: float = None,
+                  since: datetime = None, until: datetime = None, limit: int = 100, cursor: int = None):
+    query = db.query(
+        PredictionDefect.id, PredictionDefect.class_id, PredictionDefect.defect_type,
+        PredictionDefect.confidence, PredictionDefect.x1, PredictionDefect.y1,
+        PredictionDefect.x2, PredictionDefect.y2, PredictionDefect.created_at, PredictionDefect.prediction_id,
+        PredictionHistory.task_id, PredictionHistory.original_filename,
+    ).outerjoin(PredictionHistory, PredictionHistory.id == PredictionDefect.prediction_id)
+    if defect_type:
+        query = query.filter(PredictionDefect.defect_type == defect_type)
+    if min_confidence is not None:
+        query = query.filter(PredictionDefect.confidence >= min_confidence)
+    if since:
+        query = query.filter(PredictionDefect.created_at >= since)
+    if until:
+        query = query.filter(PredictionDefect.created_at < until)
+    if cursor:
+        query = query.filter(PredictionDefect.id < cursor)
+    rows = [row._asdict() for row in query.order_by(PredictionDefect.id.desc()).limit(limit).all()]
+    # Defects of archived predictions keep their rows; the prediction's fields come from the archive.
+    archived_ids = [row["prediction_id"] for row in rows if row["task_id"] is None]
+    if archived_ids:
+        archived = archive.find_archived_by_id(db, archived_ids, ["task_id", "original_filename"])
+        for row in rows:
+            if row["prediction_id"] in archived:
+                row.update(task_id=archived[row["prediction_id"]]["task_id"],
+                           original_filename=archived[row["prediction_id"]]["original_filename"])
+    for row in rows:
+        del row["prediction_id"]
+    next_cursor = rows[-1]["id"] if len(rows) == limit else None
+    return rows, next_cursor
+
+def defect_density(db: Session, since: datetime = None, until: datetime = None, defect_type: str = None):
+    day = func.date(PredictionDefect.created_at)
+    query = db.query(
+        day.label("day"), PredictionDefect.defect_type,
+        func.count(PredictionDefect.id).label("defects"),
+        func.count(func.distinct(PredictionDefect.prediction_id)).label("boards"),
+        func.avg(PredictionDefect.confidence).label("mean_confidence"),
+    )
+    if defect_type:
+        query = query.filter(PredictionDefect.defect_type == defect_type)
+    if since:
+        query = query.filter(PredictionDefect.created_at >= since)
+    if until:
+        query = query.filter(PredictionDefect.created_at < until)
+    rows = query.group_by(day, PredictionDefect.defect_type).order_by(day, PredictionDefect.defect_type).all()
+    return [{**row._asdict(), "day": str(row.day)} for row in rows]
+
+def backfill_defects(db: Session, chunk_size: int = 5000):
+    # Walks prediction_history by id and bulk-inserts defects for successful rows that have
+    # none yet. Only rows that can have detections are read: defect_count > 0, or NULL for rows
+    # written before the column existed, whose summary columns are filled in here. Clean boards
+    # are never rescanned, so the job can be stopped and resumed cheaply.
+    has_defects = db.query(PredictionDefect.id).filter(PredictionDefect.prediction_id == PredictionHistory.id).exists()
+    may_have_defects = or_(PredictionHistory.defect_count > 0, PredictionHistory.defect_count.is_(None))
+    last_id, inserted, scanned = 0, 0, 0
+    while True:
+        rows = (
+            db.query(PredictionHistory.id, PredictionHistory.created_at, PredictionHistory.result,
+                     PredictionHistory.defect_count)
+            .filter(PredictionHistory.id > last_id, PredictionHistory.status == "SUCCESS", may_have_defects, ~has_defects)
+            .order_by(PredictionHistory.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not rows:
+            break
+        legacy = [{"id": row.id, **summarize_result({"defects": (row.result or {}).get("defects") or []})}
+                  for row in rows if row.defect_count is None]
+        if legacy:
+            db.execute(update(PredictionHistory), legacy)
+        inserted += record_defects(db, [(row.id, row.created_at, row.result) for row in rows])
+        db.commit()
+        scanned += len(rows)
+        last_id = rows[-1].id
+    return {"predictions": scanned, "defects": inserted}
+
+if __name__ == "__main__":
+    import argparse
+    from .models import SessionLocal
+    from .migrations import migrate
+    parser = argparse.ArgumentParser(description="Backfill prediction_defect from prediction_history results")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+    migrate()
+    session = SessionLocal()
+    try:
+        print(f"Backfill complete: {backfill_defects(session, args.chunk_size)}")
+    finally:
+        session.close()
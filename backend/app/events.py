@@ -0,0 +1,147 @@
+from sqlalchemy import text
+from .models import DATABASE_URL, engine
+import threading
+import asyncio
+import select
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "postgres" if DATABASE_URL.startswith("postgresql") else "memory")
+EVENTS_CHANNEL = "task_events"
+# Postgres rejects NOTIFY payloads of 8000 bytes or more; larger results are
+# sent without the result and subscribers read it from the database.
+MAX_NOTIFY_BYTES = 7900
+
+class InMemoryBroker:
+    def __init__(self):
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def publish_many(self, events: list, conn=None):
+        for event in events:
+            self.publish(event)
+
+    def publish(self, event: dict):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.error(f"Event listener failed: {e}")
+
+    def subscribe(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+class PostgresNotifyBroker(InMemoryBroker):
+    def __init__(self, channel: str = EVENTS_CHANNEL):
+        super().__init__()
+        self.channel = channel
+        self._thread = None
+
+    def _payload(self, event: dict):
+        payload = json.dumps(event, default=str)
+        if len(payload.encode()) > MAX_NOTIFY_BYTES:
+            payload = json.dumps({k: v for k, v in event.items() if k != "result"} | {"result_truncated": True}, default=str)
+        return payload
+
+    def publish(self, event: dict):
+        self.publish_many([event])
+
+    def publish_many(self, events: list, conn=None):
+        # One statement for all events. Given a connection (or session) the NOTIFYs join its
+        # transaction and Postgres delivers them on commit, in order.
+        if not events:
+            return
+        stmt = text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload")
+        params = {"channel": self.channel, "payloads": [self._payload(event) for event in events]}
+        if conn is not None:
+            conn.execute(stmt, params)
+            return
+        with engine.begin() as conn:
+            conn.execute(stmt, params)
+
+    def subscribe(self, listener):
+        super().subscribe(listener)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name="pg-listen", daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        import psycopg2
+        while True:
+            try:
+                conn = psycopg2.connect(engine.url.set(drivername="postgresql").render_as_string(hide_password=False))
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        InMemoryBroker.publish(self, json.loads(notify.payload))
+            except Exception as e:
+                logger.error(f"LISTEN {self.channel} failed, reconnecting: {e}")
+                threading.Event().wait(1)
+
+class Subscription:
+    def __init__(self, loop, task_ids=(), batch_ids=()):
+        self.loop = loop
+        self.task_ids = set(task_ids)
+        self.batch_ids = set(batch_ids)
+        self.queue = asyncio.Queue()
+
+    def __call__(self, event: dict):
+        if event.get("task_id") in self.task_ids or (event.get("batch_id") and event["batch_id"] in self.batch_ids):
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+_broker = None
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = PostgresNotifyBroker() if EVENTS_BACKEND == "postgres" else InMemoryBroker()
+    return _broker
+
+def status_event(task_id: str, status: str, result: dict = None, batch_id: str = None):
+    event = {"task_id": task_id, "status": status, "batch_id": batch_id}
+    if result is not None:
+        event["result"] = result
+    return event
+
+def publish_status(task_id: str, status: str, result: dict = None, batch_id: str = None):
+    try:
+        get_broker().publish(status_event(task_id, status, result, batch_id))
+    except Exception as e:
+        logger.error(f"Publishing status for {task_id} failed: {e}")
+
+def publish_statuses(statuses: list, db=None):
+    # statuses are (task_id, status, result, batch_id). Given an open session, Postgres NOTIFYs are
+    # queued in its transaction and sent on commit. Other brokers deliver at once, so nothing is sent
+    # and False tells the caller to publish again after committing.
+    broker = get_broker()
+    if db is not None and not isinstance(broker, PostgresNotifyBroker):
+        return False
+    events = [status_event(*status) for status in statuses]
+    try:
+        if db is None:
+            broker.publish_many(events)
+        else:
+            # A savepoint keeps a failed NOTIFY from aborting the results it announces.
+            with db.begin_nested():
+                broker.publish_many(events, db)
+    except Exception as e:
+        logger.error(f"Publishing {len(events)} statuses failed: {e}")
+    return True
@@ -0,0 +1,199 @@
+from datetime import datetime
+import numpy as np
+import threading
+import hashlib
+import json
+import cv2
+import os
+import re
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+GOLDEN_DIR = os.getenv("GOLDEN_DIR", "/app/golden")
+REFERENCE_NAME = "reference.png"
+META_NAME = "reference.json"
+BOARD_TYPE_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$")
+
+ALIGN_MAX_SIDE = int(os.getenv("ALIGN_MAX_SIDE", "1200"))
+ORB_FEATURES = int(os.getenv("ORB_FEATURES", "4000"))
+MATCH_RATIO = 0.75
+MIN_MATCHES = int(os.getenv("ALIGN_MIN_MATCHES", "25"))
+RANSAC_PX = float(os.getenv("ALIGN_RANSAC_PX", "6"))
+DIFF_THRESHOLD = int(os.getenv("REFERENCE_DIFF_THRESHOLD", "40"))
+MIN_REGION_AREA = int(os.getenv("REFERENCE_MIN_REGION_AREA", "64"))
+REGION_PAD = int(os.getenv("REFERENCE_REGION_PAD", "32"))
+REGION_MIN_SIDE = int(os.getenv("REFERENCE_REGION_MIN_SIDE", "160"))
+REGION_CELL = 256
+# Past this changed fraction cropping saves little, so the whole board is inspected in one pass.
+FULL_FRAME_FRACTION = float(os.getenv("REFERENCE_FULL_FRAME_FRACTION", "0.5"))
+
+# Layout:
+#   <golden>/<board_type>/reference.png   known-good image, replaced atomically on register
+#   <golden>/<board_type>/reference.json  version (content digest), size, registration time
+
+class AlignmentError(ValueError):
+    pass
+
+class Reference:
+    def __init__(self, board_type: str, version: str, image: np.ndarray):
+        self.board_type = board_type
+        self.version = version
+        self.gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        self.points, self.descriptors = features(self.gray)
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def valid_board_type(board_type: str):
+    return bool(board_type and BOARD_TYPE_PATTERN.match(board_type))
+
+def reference_dir(board_type: str, golden_dir: str = None):
+    if not valid_board_type(board_type):
+        raise ValueError(f"Invalid board type {board_type!r}")
+    return os.path.join(golden_dir or GOLDEN_DIR, board_type)
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def register_reference(board_type: str, data: bytes, golden_dir: str = None):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode reference image")
+    target = reference_dir(board_type, golden_dir)
+    os.makedirs(target, exist_ok=True)
+    ok, encoded = cv2.imencode(".png", image)
+    meta = {
+        "board_type": board_type,
+        "version": hashlib.sha256(encoded.tobytes()).hexdigest()[:12],
+        "width": image.shape[1],
+        "height": image.shape[0],
+        "registered_at": datetime.utcnow().isoformat(),
+    }
+    # Image first, then meta: a reader that sees the new version always finds the new image.
+    _write_atomic(os.path.join(target, REFERENCE_NAME), encoded.tobytes())
+    _write_atomic(os.path.join(target, META_NAME), json.dumps(meta).encode())
+    logger.info(f"Registered golden reference {board_type} version {meta['version']}")
+    return meta
+
+def reference_meta(board_type: str, golden_dir: str = None):
+    try:
+        with open(os.path.join(reference_dir(board_type, golden_dir), META_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def list_references(golden_dir: str = None):
+    root = golden_dir or GOLDEN_DIR
+    if not os.path.isdir(root):
+        return []
+    metas = [reference_meta(name, root) for name in sorted(os.listdir(root)) if valid_board_type(name)]
+    return [meta for meta in metas if meta]
+
+def load_reference(board_type: str, golden_dir: str = None):
+    # Reference keypoints are computed once per registered version and kept in memory.
+    meta = reference_meta(board_type, golden_dir)
+    if meta is None:
+        raise KeyError(f"No golden reference for board type {board_type}")
+    key = (golden_dir or GOLDEN_DIR, board_type)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached.version == meta["version"]:
+            return cached
+    image = cv2.imread(os.path.join(reference_dir(board_type, golden_dir), REFERENCE_NAME))
+    if image is None:
+        raise KeyError(f"Golden reference image for {board_type} is missing")
+    reference = Reference(board_type, meta["version"], image)
+    with _cache_lock:
+        _cache[key] = reference
+    return reference
+
+def features(gray: np.ndarray, max_side: int = ALIGN_MAX_SIDE):
+    # ORB on a downscaled copy; keypoints are returned in full-resolution coordinates.
+    scale = min(1.0, max_side / max(gray.shape[:2]))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+    keypoints, descriptors = cv2.ORB_create(ORB_FEATURES).detectAndCompute(small, None)
+    points = np.float32([k.pt for k in keypoints]).reshape(-1, 2) / scale
+    return points, descriptors
+
+def align(gray: np.ndarray, reference: Reference):
+    # Homography mapping reference coordinates onto the incoming image, and its RANSAC inlier count.
+    points, descriptors = features(gray)
+    if descriptors is None or reference.descriptors is None:
+        raise AlignmentError("No features to align on")
+    pairs = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(reference.descriptors, descriptors, k=2)
+    good = [p[0] for p in pairs if len(p) == 2 and p[0].distance < MATCH_RATIO * p[1].distance]
+    if len(good) < MIN_MATCHES:
+        raise AlignmentError(f"Only {len(good)} feature matches")
+    src = reference.points[[m.queryIdx for m in good]]
+    dst = points[[m.trainIdx for m in good]]
+    homography, inliers = cv2.findHomography(src, dst, cv2.RANSAC, RANSAC_PX)
+    if homography is None or int(inliers.sum()) < MIN_MATCHES:
+        raise AlignmentError("Alignment did not converge")
+    return homography, int(inliers.sum())
+
+def _merge_overlapping(boxes: list):
+    # Overlapping boxes are merged only while the union stays about as small as its parts, so
+    # e.g. the strips along two image edges never turn into one box covering the whole board.
+    def area(b):
+        return (b[2] - b[0]) * (b[3] - b[1])
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if not (a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]):
+                    continue
+                union = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                if area(union) <= area(a) + area(b):
+                    boxes[i] = union
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+def _grow(box: tuple, width: int, height: int, pad: int, min_side: int):
+    x0, y0, x1, y1 = box[0] - pad, box[1] - pad, box[2] + pad, box[3] + pad
+    grow_x, grow_y = max(0, min_side - (x1 - x0)), max(0, min_side - (y1 - y0))
+    x0, x1 = x0 - grow_x // 2, x1 + grow_x - grow_x // 2
+    y0, y1 = y0 - grow_y // 2, y1 + grow_y - grow_y // 2
+    return (max(0, x0), max(0, y0), min(width, x1), min(height, y1))
+
+def changed_regions(gray: np.ndarray, reference: Reference, homography: np.ndarray,
+                    threshold: int = DIFF_THRESHOLD, min_area: int = MIN_REGION_AREA,
+                    pad: int = REGION_PAD, min_side: int = REGION_MIN_SIDE):
+    # The reference is warped into the incoming image's frame, so regions are already in
+    # image coordinates. Pixels the reference does not cover count as changed.
+    height, width = gray.shape[:2]
+    warped = cv2.warpPerspective(reference.gray, homography, (width, height), flags=cv2.INTER_LINEAR)
+    covered = cv2.warpPerspective(np.full(reference.gray.shape, 255, np.uint8), homography, (width, height),
+                                  flags=cv2.INTER_NEAREST)
+    covered = cv2.erode(covered, np.ones((5, 5), np.uint8)) > 0
+    image = cv2.GaussianBlur(gray, (5, 5), 0).astype(np.float32)
+    warped = cv2.GaussianBlur(warped, (5, 5), 0).astype(np.float32)
+    if covered.any():
+        # Match global brightness and contrast so lighting drift is not reported as change.
+        warped = (warped - warped[covered].mean()) * (image[covered].std() / max(warped[covered].std(), 1e-3)) \
+            + image[covered].mean()
+    mask = ((np.abs(image - warped) > threshold) & covered) | ~covered
+    mask = cv2.morphologyEx(mask.astype(np.uint8), cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    # Components are cut at a grid so a long thin change (a misregistered edge, the uncovered
+    # border) yields boxes hugging it instead of one bounding box around the whole board.
+    mask[:, ::REGION_CELL] = 0
+    mask[::REGION_CELL, :] = 0
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    boxes = [
+        _grow((x, y, x + w, y + h), width, height, pad, min_side)
+        for x, y, w, h, area in stats[1:count] if area >= min_area
+    ]
+    return _merge_overlapping(boxes)
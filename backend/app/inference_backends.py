@@ -0,0 +1,58 @@
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "pytorch")
+DEFAULT_BACKEND = "pytorch"
+
+# Artifact written next to <stem>.pt by ml/export.py for each backend; Ultralytics
+# picks the runtime (ONNX Runtime / OpenVINO) from the artifact itself.
+BACKEND_ARTIFACTS = {
+    "pytorch": "{stem}.pt",
+    "torchscript": "{stem}.torchscript",
+    "onnxruntime": "{stem}.onnx",
+    "onnx-int8": "{stem}.int8.onnx",
+    "openvino": "{stem}_openvino_model",
+    "openvino-int8": "{stem}_int8_openvino_model",
+}
+
+def artifact_path(model_path: str, backend: str):
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(os.path.dirname(model_path), BACKEND_ARTIFACTS[backend].format(stem=stem))
+
+def parity_report_path(model_path: str):
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(os.path.dirname(model_path), f"{stem}.parity.json")
+
+def load_parity_report(model_path: str):
+    path = parity_report_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def resolve_backend(model_path: str, source_digest: str, backend: str = None):
+    # A non-PyTorch backend is only served when its artifact exists and the parity
+    # report for this exact source checkpoint says it matched the PyTorch reference.
+    backend = backend or INFERENCE_BACKEND
+    if backend == DEFAULT_BACKEND:
+        return model_path, DEFAULT_BACKEND
+    if backend not in BACKEND_ARTIFACTS:
+        logger.warning(f"Unknown inference backend {backend}, using {DEFAULT_BACKEND}")
+        return model_path, DEFAULT_BACKEND
+
+    artifact = artifact_path(model_path, backend)
+    report = load_parity_report(model_path) or {}
+    check = report.get("backends", {}).get(backend, {})
+    if not os.path.exists(artifact):
+        reason = f"artifact {artifact} is missing"
+    elif report.get("source_digest") != source_digest:
+        reason = "no parity report for this checkpoint"
+    elif not check.get("passed"):
+        reason = f"parity check did not pass ({check or 'not run'})"
+    else:
+        return artifact, backend
+    logger.warning(f"Inference backend {backend} disabled: {reason}; using {DEFAULT_BACKEND}")
+    return model_path, DEFAULT_BACKEND
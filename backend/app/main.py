@@ -1,11 +1,15 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from .api import routes
-from .models import Base, engine
+from .migrations import migrate
+from .uploads import UPLOAD_DIR, UploadSizeLimit
+from .admission import AdmissionGate
+from . import metrics
+import time
 import os
 
-Base.metadata.create_all(bind=engine)
+migrate()
 
 app = FastAPI(title="PCB Defect Detection API")
 
@@ -21,13 +25,38 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(UploadSizeLimit)
+# Outermost, so overload is shed before any body is read.
+app.add_middleware(AdmissionGate, check=routes.precheck_admission)
 
-UPLOAD_DIR = "/app/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 app.include_router(routes.router)
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    except Exception as e:
+        metrics.record_error("api", e)
+        raise
+    finally:
+        # Label by route template so /status/<id> does not explode the label set.
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            request.method, getattr(route, "path", "unmatched"), str(status)
+        ).observe(time.perf_counter() - start)
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to PCB Defect Detection API"}
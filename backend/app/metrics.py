@@ -0,0 +1,72 @@
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, start_http_server
+from contextlib import contextmanager
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+UNKNOWN_VERSION = "unknown"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Stages: upload_write, cache_lookup, create_task_entry, dispatch (API);
+# queue_wait, batch_wait, preprocess, inference, nms, postprocess, db_update, task_total (worker).
+STAGE_SECONDS = Histogram(
+    "pcb_stage_duration_seconds", "Time spent in each pipeline stage",
+    ["stage", "model_version"], buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "pcb_http_request_duration_seconds", "API request latency",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+QUEUE_DEPTH = Gauge("pcb_queue_depth", "Items waiting in a queue", ["queue"])
+TASKS_IN_FLIGHT = Gauge("pcb_tasks_in_flight", "Celery tasks currently executing", ["task"])
+TASKS_TOTAL = Counter("pcb_tasks_total", "Finished predictions by outcome", ["status", "model_version"])
+BATCH_SIZE = Histogram("pcb_inference_batch_size", "Images per model call", buckets=(1, 2, 4, 8, 16, 32, 64))
+MODEL_LOAD_SECONDS = Histogram(
+    "pcb_model_load_seconds", "Model load and warm-up time",
+    ["phase", "backend"], buckets=LATENCY_BUCKETS,
+)
+MODEL_CACHE_REQUESTS = Counter("pcb_model_cache_requests_total", "Model registry lookups", ["result"])
+MODEL_CACHE_EVICTIONS = Counter("pcb_model_cache_evictions_total", "Models evicted from the registry")
+MODEL_SWAPS = Counter("pcb_model_swaps_total", "Active model swaps after a promote or rollback")
+MODEL_CACHE_ENTRIES = Gauge("pcb_model_cache_entries", "Models held in the registry")
+MODEL_LOADED = Gauge("pcb_model_loaded", "Model versions currently resident", ["model_version", "backend"])
+ADMISSION_REJECTED = Counter("pcb_admission_rejected_total", "Requests turned away with 429", ["priority", "reason"])
+STREAM_FRAMES = Counter("pcb_stream_frames_total", "Frames received on inspection streams by outcome", ["outcome"])
+REFERENCE_BOARDS = Counter("pcb_reference_boards_total", "Golden-reference inspections by outcome", ["outcome"])
+REFERENCE_SKIPPED_FRACTION = Histogram(
+    "pcb_reference_skipped_fraction", "Share of each board the detector did not have to look at",
+    buckets=(0.0, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0),
+)
+ERRORS = Counter("pcb_errors_total", "Errors by component and exception type", ["component", "exception", "model_version"])
+
+def observe_stage(stage: str, seconds: float, model_version: str = None):
+    STAGE_SECONDS.labels(stage, model_version or UNKNOWN_VERSION).observe(seconds)
+
+@contextmanager
+def stage_timer(stage: str, model_version: str = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start, model_version)
+
+def record_error(component: str, error: BaseException, model_version: str = None):
+    ERRORS.labels(component, type(error).__name__, model_version or UNKNOWN_VERSION).inc()
+
+def render():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+def start_exporter(port: int = METRICS_PORT):
+    if port <= 0:
+        return False
+    try:
+        start_http_server(port)
+        logger.info(f"Metrics exporter listening on :{port}")
+        return True
+    except OSError as e:
+        logger.warning(f"Metrics exporter not started on :{port}: {e}")
+        return False
@@ -0,0 +1,82 @@
+from sqlalchemy import inspect, or_, text
+from sqlalchemy.orm import Session
+import logging
+from .models import Base, engine, ArchivedTask, PredictionDefect, PredictionHistory, PredictionRollup
+
+logger = logging.getLogger(__name__)
+
+# create_all only creates missing tables, so columns and indexes added to a table after it
+# first shipped are applied here. Every step reads the live schema first: migrate() is run on
+# each API start (and by the CLI jobs) and is a no-op once the database is current.
+
+def add_missing_columns(conn):
+    inspector = inspect(conn)
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # New columns are nullable: rows written before them get NULL, which every reader handles.
+            if_not_exists = "IF NOT EXISTS " if conn.dialect.name == "postgresql" else ""
+            conn.execute(text(
+                f"ALTER TABLE {table.name} ADD COLUMN {if_not_exists}{column.name} {column.type.compile(dialect=conn.dialect)}"
+            ))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+def create_missing_indexes(conn):
+    inspector = inspect(conn)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(conn, checkfirst=True)
+                created.append(index.name)
+    return created
+
+def drop_defect_foreign_key(conn):
+    # prediction_defect rows outlive archived predictions, so the cascading FK to
+    # prediction_history is dropped. SQLite doesn't enforce it unless asked to and can't drop it.
+    if conn.dialect.name != "postgresql" or not inspect(conn).has_table("prediction_defect"):
+        return []
+    dropped = []
+    for fk in inspect(conn).get_foreign_keys("prediction_defect"):
+        if fk["referred_table"] == "prediction_history" and fk["name"]:
+            conn.execute(text(f'ALTER TABLE prediction_defect DROP CONSTRAINT IF EXISTS "{fk["name"]}"'))
+            dropped.append(fk["name"])
+    return dropped
+
+def seed_derived_tables(bind):
+    # Tables derived from existing data start empty on an upgraded database; they are filled
+    # once, while still empty, so lookups cover what was written before they existed.
+    from . import archive, defects, stats
+    seeded = []
+    with Session(bind=bind) as db:
+        if db.query(ArchivedTask.task_id).first() is None and archive.has_archives(db):
+            seeded.append(f"archived_task ({archive.index_archived_tasks(db)} rows)")
+        if db.query(PredictionDefect.id).first() is None and db.query(PredictionHistory.id).filter(
+                PredictionHistory.status == "SUCCESS",
+                or_(PredictionHistory.defect_count > 0, PredictionHistory.defect_count.is_(None))).first():
+            seeded.append(f"prediction_defect ({defects.backfill_defects(db)['defects']} rows)")
+        if db.query(PredictionRollup.id).first() is None and (archive.has_archives(db) or db.query(PredictionHistory.id).filter(
+                PredictionHistory.status.in_(["SUCCESS", "FAILURE"])).first()):
+            stats.rebuild_rollups(db)
+            seeded.append("prediction_rollup")
+    return seeded
+
+def migrate(bind=None):
+    bind = bind or engine
+    Base.metadata.create_all(bind=bind)
+    with bind.begin() as conn:
+        applied = add_missing_columns(conn) + create_missing_indexes(conn) + drop_defect_foreign_key(conn)
+    applied += seed_derived_tables(bind)
+    if applied:
+        logger.info(f"Schema migrated: {', '.join(applied)}")
+    return applied
+
+if __name__ == "__main__":
+    print(f"Applied: {migrate() or 'nothing, schema is current'}")
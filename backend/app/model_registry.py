@@ -0,0 +1,231 @@
+from collections import OrderedDict
+from ultralytics import YOLO
+import numpy as np
+import hashlib
+import threading
+import time
+import os
+import logging
+from .inference_backends import (
+    INFERENCE_BACKEND, DEFAULT_BACKEND, BACKEND_ARTIFACTS, artifact_path, parity_report_path, resolve_backend,
+)
+from . import metrics, model_store
+
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = os.getenv("MODEL_PATH", "/app/ml/yolov8_model/best.pt")
+FALLBACK_MODEL = "yolov8n.pt"
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", "3"))
+WARMUP_IMGSZ = int(os.getenv("MODEL_WARMUP_IMGSZ", "640"))
+MODEL_POLL_SECONDS = float(os.getenv("MODEL_POLL_SECONDS", "5"))
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024):
+    h = hashlib.sha256()
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    for p in paths:
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def _stamp(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+class ModelRegistry:
+    def __init__(self, max_size: int = MODEL_CACHE_SIZE, store: str = model_store.MODEL_STORE,
+                 poll_seconds: float = MODEL_POLL_SECONDS):
+        self.max_size = max_size
+        self.store = store
+        self.poll_seconds = poll_seconds
+        self._models = OrderedDict()
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.swaps = 0
+        self.load_times = {}
+        self._resolved = {}
+        self._active = None
+        self._checked_at = 0.0
+        self._swapping = False
+
+    def resolve_path(self, path: str = None):
+        # An explicit path wins, then the version promoted in the model store, then MODEL_PATH.
+        return path or model_store.active_weights(self.store) or MODEL_PATH
+
+    def _key(self, path: str, backend: str = None):
+        backend = backend or INFERENCE_BACKEND
+        if not os.path.exists(path):
+            return (path, None, None, DEFAULT_BACKEND, path)
+        st = os.stat(path)
+        stamp = (path, st.st_mtime_ns, st.st_size)
+        digest = self._digests.get(stamp)
+        if digest is None:
+            digest = file_digest(path)
+            self._digests[stamp] = digest
+        # The parity report and the exported artifact can be (re)written after the weights, so
+        # their stamps are part of the key: a backend that stops passing parity is dropped on the
+        # next lookup rather than at restart.
+        checks = (backend, _stamp(parity_report_path(path)),
+                  _stamp(artifact_path(path, backend)) if backend in BACKEND_ARTIFACTS else None)
+        resolved = self._resolved.get((stamp, checks))
+        if resolved is None:
+            resolved = resolve_backend(path, digest, backend)
+            self._resolved[(stamp, checks)] = resolved
+        artifact, resolved_backend = resolved
+        return (path, st.st_mtime_ns, digest, resolved_backend, artifact)
+
+    def _lookup_key(self, path: str = None, backend: str = None):
+        path = self.resolve_path(path)
+        if not os.path.exists(path):
+            logger.warning(f"Model not found at {path}, using {FALLBACK_MODEL}")
+            path = FALLBACK_MODEL
+        with self._lock:
+            return self._key(path, backend)
+
+    def _load(self, path: str):
+        start = time.perf_counter()
+        model = YOLO(path, task="detect")
+        load_time = time.perf_counter() - start
+        start = time.perf_counter()
+        model(np.zeros((WARMUP_IMGSZ, WARMUP_IMGSZ, 3), dtype=np.uint8), imgsz=WARMUP_IMGSZ, verbose=False)
+        warmup_time = time.perf_counter() - start
+        logger.info(f"Loaded model {path} in {load_time:.3f}s (warm-up {warmup_time:.3f}s)")
+        return model, {"load_s": load_time, "warmup_s": warmup_time}
+
+    def get(self, path: str = None, backend: str = None):
+        return self._get(self._lookup_key(path, backend))
+
+    def _get(self, key):
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                metrics.MODEL_CACHE_REQUESTS.labels("hit").inc()
+                return model
+            loading = self._loading.setdefault(key, threading.Lock())
+        # Loading and warm-up happen outside the registry lock so a slow load of one
+        # version never blocks lookups of the versions already in memory.
+        with loading:
+            with self._lock:
+                model = self._models.get(key)
+            if model is not None:
+                return model
+            with self._lock:
+                self.misses += 1
+            metrics.MODEL_CACHE_REQUESTS.labels("miss").inc()
+            try:
+                model, timings = self._load(key[4])
+            except Exception as e:
+                metrics.record_error("model_registry", e, self._version(key))
+                raise
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+            metrics.MODEL_LOAD_SECONDS.labels("load", key[3]).observe(timings["load_s"])
+            metrics.MODEL_LOAD_SECONDS.labels("warmup", key[3]).observe(timings["warmup_s"])
+            metrics.MODEL_LOADED.labels(self._version(key), key[3]).set(1)
+            with self._lock:
+                self._models[key] = model
+                self.load_times[key] = timings
+                self._evict()
+                metrics.MODEL_CACHE_ENTRIES.set(len(self._models))
+            return model
+
+    def _evict(self):
+        active = self._active[0] if self._active else None
+        for old_key in [k for k in self._models if k != active][:max(len(self._models) - self.max_size, 0)]:
+            del self._models[old_key]
+            self.load_times.pop(old_key, None)
+            self.evictions += 1
+            metrics.MODEL_CACHE_EVICTIONS.inc()
+            metrics.MODEL_LOADED.labels(self._version(old_key), old_key[3]).set(0)
+            logger.info(f"Evicted model {old_key[0]} (mtime {old_key[1]})")
+
+    def acquire(self):
+        # Returns the model serving traffic and its version. A newly promoted version is
+        # loaded and warmed on a background thread while requests keep using the current
+        # one, then becomes active in a single assignment. Rolling back to a version still
+        # in the LRU swaps on the next check without reloading.
+        if self._active is None:
+            key = self._lookup_key()
+            model = self._get(key)
+            with self._lock:
+                if self._active is None:
+                    self._active = (key, model)
+                    self._checked_at = time.monotonic()
+        elif time.monotonic() - self._checked_at >= self.poll_seconds:
+            self._checked_at = time.monotonic()
+            self._check_for_swap()
+        key, model = self._active
+        return model, self._version(key)
+
+    def _check_for_swap(self):
+        key = self._lookup_key()
+        with self._lock:
+            if key == self._active[0] or self._swapping:
+                return
+            self._swapping = True
+        threading.Thread(target=self._activate, args=(key,), name="model-swap", daemon=True).start()
+
+    def _activate(self, key):
+        try:
+            model = self._get(key)
+            with self._lock:
+                previous = self._active[0]
+                self._active = (key, model)
+                self.swaps += 1
+            metrics.MODEL_SWAPS.inc()
+            logger.info(f"Swapped model {self._version(previous)} -> {self._version(key)}")
+        except Exception as e:
+            logger.error(f"Model swap to {self._version(key)} failed, keeping current model: {e}")
+        finally:
+            with self._lock:
+                self._swapping = False
+
+    @staticmethod
+    def _version(key):
+        if key[2] is None:
+            return key[0]
+        return key[2][:12] if key[3] == DEFAULT_BACKEND else f"{key[2][:12]}-{key[3]}"
+
+    def version(self, path: str = None, backend: str = None):
+        path = self.resolve_path(path)
+        if not os.path.exists(path):
+            return FALLBACK_MODEL
+        with self._lock:
+            key = self._key(path, backend)
+        return self._version(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._models),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "swaps": self.swaps,
+                "active": self._version(self._active[0]) if self._active else None,
+                "models": [
+                    {"path": k[0], "mtime_ns": k[1], "digest": k[2], "backend": k[3], "artifact": k[4], **self.load_times.get(k, {})}
+                    for k in self._models
+                ],
+            }
+
+registry = ModelRegistry()
+
+def get_model(path: str = None):
+    return registry.get(path)
+
+def acquire_model():
+    return registry.acquire()
@@ -0,0 +1,155 @@
+from datetime import datetime
+import hashlib
+import shutil
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+MODEL_STORE = os.getenv("MODEL_STORE", "/app/ml/model_store")
+WEIGHTS_NAME = "best.pt"
+POINTER_NAME = "CURRENT"
+HISTORY_NAME = "history.jsonl"
+
+# Layout:
+#   <store>/versions/<version>/best.pt   immutable weights (+ exported artifacts and parity report)
+#   <store>/CURRENT                      version id being served, replaced atomically on promote
+#   <store>/history.jsonl                append-only promote/rollback log
+
+_pointer_cache = {}
+
+def _digest(path: str, chunk_size: int = 1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def version_dir(version: str, store: str = MODEL_STORE):
+    return os.path.join(store, "versions", version)
+
+def weights_path(version: str, store: str = MODEL_STORE):
+    return os.path.join(version_dir(version, store), WEIGHTS_NAME)
+
+def list_versions(store: str = MODEL_STORE):
+    root = os.path.join(store, "versions")
+    if not os.path.isdir(root):
+        return []
+    versions = [v for v in os.listdir(root) if os.path.exists(weights_path(v, store))]
+    return sorted(versions, key=lambda v: os.path.getmtime(weights_path(v, store)))
+
+def register_version(source_path: str, store: str = MODEL_STORE):
+    # The version id is the same digest prefix ModelRegistry.version() reports, so rows,
+    # caches and the store all agree on what "version" means.
+    version = _digest(source_path)[:12]
+    target = version_dir(version, store)
+    if os.path.exists(weights_path(version, store)):
+        return version
+    tmp_dir = f"{target}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    shutil.copyfile(source_path, os.path.join(tmp_dir, WEIGHTS_NAME))
+    with open(os.path.join(tmp_dir, WEIGHTS_NAME), "rb") as f:
+        os.fsync(f.fileno())
+    os.rename(tmp_dir, target)
+    logger.info(f"Registered model version {version} from {source_path}")
+    return version
+
+def current_version(store: str = MODEL_STORE):
+    pointer = os.path.join(store, POINTER_NAME)
+    try:
+        mtime = os.stat(pointer).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _pointer_cache.get(store)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(pointer) as f:
+        version = f.read().strip() or None
+    _pointer_cache[store] = (mtime, version)
+    return version
+
+def active_weights(store: str = MODEL_STORE):
+    version = current_version(store)
+    return weights_path(version, store) if version else None
+
+def _write_pointer(version: str, store: str):
+    tmp_path = os.path.join(store, f"{POINTER_NAME}.tmp-{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(store, POINTER_NAME))
+
+def _log(store: str, action: str, version: str, previous: str):
+    with open(os.path.join(store, HISTORY_NAME), "a") as f:
+        f.write(json.dumps({"at": datetime.utcnow().isoformat(), "action": action,
+                            "version": version, "previous": previous}) + "\n")
+
+def history(store: str = MODEL_STORE):
+    path = os.path.join(store, HISTORY_NAME)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def promote(version: str, store: str = MODEL_STORE):
+    path = weights_path(version, store)
+    if not os.path.exists(path):
+        raise ValueError(f"Unknown model version {version}")
+    if _digest(path)[:12] != version:
+        raise ValueError(f"Weights for {version} do not match their digest")
+    previous = current_version(store)
+    _write_pointer(version, store)
+    _log(store, "promote", version, previous)
+    logger.info(f"Promoted model version {version} (was {previous})")
+    return previous
+
+def _promotion_stack(store: str):
+    stack = []
+    for entry in history(store):
+        if entry["action"] == "promote":
+            stack.append(entry["version"])
+        elif entry["action"] == "rollback" and stack:
+            stack.pop()
+    return stack
+
+def rollback(store: str = MODEL_STORE):
+    # Undoes the latest promotion; repeated rollbacks keep walking back through earlier ones.
+    stack = _promotion_stack(store)
+    if len(stack) < 2:
+        raise ValueError("No earlier version to roll back to")
+    current, target = current_version(store), stack[-2]
+    _write_pointer(target, store)
+    _log(store, "rollback", target, current)
+    logger.info(f"Rolled back model version {current} -> {target}")
+    return target
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage versioned model weights")
+    parser.add_argument("--store", default=MODEL_STORE)
+    sub = parser.add_subparsers(dest="command", required=True)
+    register_cmd = sub.add_parser("register")
+    register_cmd.add_argument("weights")
+    register_cmd.add_argument("--promote", action="store_true")
+    sub.add_parser("promote").add_argument("version")
+    sub.add_parser("rollback")
+    sub.add_parser("list")
+    args = parser.parse_args()
+
+    if args.command == "register":
+        version = register_version(args.weights, args.store)
+        print(f"Registered {version}")
+        if args.promote:
+            promote(version, args.store)
+            print(f"Promoted {version}")
+    elif args.command == "promote":
+        promote(args.version, args.store)
+        print(f"Promoted {args.version}")
+    elif args.command == "rollback":
+        print(f"Rolled back to {rollback(args.store)}")
+    else:
+        current = current_version(args.store)
+        for version in list_versions(args.store):
+            print(f"{'*' if version == current else ' '} {version}")
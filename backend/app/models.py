@@ -1,14 +1,46 @@
-from sqlalchemy import Column, Integer, String, JSON, DateTime, create_engine
+from sqlalchemy import Column, Integer, String, Float, JSON, DateTime, Index, UniqueConstraint, create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 import os
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/pcb_defects")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "30"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
 
-engine = create_engine(DATABASE_URL)
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def async_database_url(url: str):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+def async_engine_options(url):
+    # asyncpg keeps its own per-connection prepared statement cache on top of
+    # SQLAlchemy's compiled cache; both are sized from DB_STATEMENT_CACHE_SIZE.
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "query_cache_size": DB_STATEMENT_CACHE_SIZE}
+    if url.get_backend_name() == "sqlite":
+        return options
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                   pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE)
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    return options
+
+# The worker, CLI jobs and migrations stay on the synchronous engine.
+engine = create_engine(DATABASE_URL, pool_pre_ping=DB_POOL_PRE_PING)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# The API runs on the async engine so request handlers never block the event loop on I/O.
+ASYNC_DATABASE_URL = async_database_url(os.getenv("ASYNC_DATABASE_URL", DATABASE_URL))
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **async_engine_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 class PredictionHistory(Base):
@@ -21,10 +53,84 @@ class PredictionHistory(Base):
     result = Column(JSON)
     status = Column(String, default="PENDING")
     created_at = Column(DateTime, default=datetime.utcnow)
+    content_hash = Column(String, index=True)
+    model_version = Column(String)
+    inference_options = Column(String, default="")
+    source_task_id = Column(String, index=True)
+    batch_id = Column(String, index=True)
+    defect_count = Column(Integer)
+    defect_types = Column(String)
+
+    __table_args__ = (
+        Index("ix_prediction_history_cache_key", "content_hash", "model_version", "inference_options"),
+        Index("ix_prediction_history_created_at_id", "created_at", "id"),
+        Index("ix_prediction_history_status_created_at_id", "status", "created_at", "id"),
+    )
+
+class PredictionDefect(Base):
+    __tablename__ = "prediction_defect"
+
+    id = Column(Integer, primary_key=True)
+    # No foreign key: defect rows outlive their prediction when it is archived, so long-range
+    # defect queries keep working; the prediction itself is then read from the archive by id.
+    prediction_id = Column(Integer, nullable=False, index=True)
+    class_id = Column(Integer)
+    defect_type = Column(String, nullable=False)
+    confidence = Column(Float, nullable=False)
+    x1 = Column(Float)
+    y1 = Column(Float)
+    x2 = Column(Float)
+    y2 = Column(Float)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_prediction_defect_type_created_at", "defect_type", "created_at"),
+        Index("ix_prediction_defect_type_confidence", "defect_type", "confidence"),
+        Index("ix_prediction_defect_created_at", "created_at"),
+    )
+
+class PredictionRollup(Base):
+    __tablename__ = "prediction_rollup"
+
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String, nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    model_version = Column(String, nullable=False, default="*")
+    defect_type = Column(String, nullable=False, default="")
+    scans = Column(Integer, nullable=False, default=0)
+    defective_scans = Column(Integer, nullable=False, default=0)
+    defects = Column(Integer, nullable=False, default=0)
+    failures = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint("granularity", "bucket_start", "model_version", "defect_type", name="uq_prediction_rollup_key"),
+    )
+
+class ArchivedTask(Base):
+    # Which archive file holds each archived task, so /status and the previews answer unknown
+    # ids from this index instead of scanning Parquet.
+    __tablename__ = "archived_task"
+
+    task_id = Column(String, primary_key=True)
+    archive_id = Column(Integer, nullable=False, index=True)
+
+class PredictionArchive(Base):
+    __tablename__ = "prediction_archive"
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False, unique=True)
+    period_start = Column(DateTime, nullable=False)
+    period_end = Column(DateTime, nullable=False)
+    min_id = Column(Integer, nullable=False)
+    max_id = Column(Integer, nullable=False)
+    row_count = Column(Integer, nullable=False)
+    size_bytes = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_prediction_archive_period", "period_end", "period_start"),
+    )
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,97 @@
+from PIL import Image
+import numpy as np
+import cv2
+import hashlib
+import json
+import os
+import uuid
+from .uploads import UPLOAD_DIR
+
+RENDER_DIR = os.getenv("RENDER_DIR", os.path.join(UPLOAD_DIR, "renders"))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+OVERLAY_SIZE = int(os.getenv("OVERLAY_SIZE", "1280"))
+JPEG_QUALITY = int(os.getenv("RENDER_JPEG_QUALITY", "85"))
+KINDS = ("thumbnail", "overlay")
+
+BOX_COLOR = (0, 0, 255)
+# cv2 can decode JPEGs at 1/2, 1/4 or 1/8 scale straight from the DCT coefficients,
+# which is far cheaper than decoding a full-resolution board and shrinking it.
+REDUCED_READ_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def _defects_digest(result: dict):
+    boxes = [(d.get("type"), round(float(d.get("confidence", 0.0)), 4), [round(float(v), 1) for v in d.get("bbox") or []])
+             for d in (result or {}).get("defects") or []]
+    return hashlib.sha256(json.dumps(boxes).encode()).hexdigest()[:12]
+
+def render_name(filename: str, kind: str, result: dict = None):
+    # Uploads are stored under their content hash, so the name (and the ETag derived
+    # from it) changes exactly when the source image or the drawn boxes change.
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    if kind == "thumbnail":
+        return f"{stem}-thumb{THUMBNAIL_SIZE}.jpg"
+    return f"{stem}-overlay{OVERLAY_SIZE}-{_defects_digest(result)}.jpg"
+
+def render_path(filename: str, kind: str, result: dict = None, render_dir: str = RENDER_DIR):
+    return os.path.join(render_dir, render_name(filename, kind, result))
+
+def _read_scaled(image_path: str, max_side: int):
+    height, width = _image_size(image_path)
+    if height and width:
+        for factor, flag in REDUCED_READ_FLAGS:
+            if max(height, width) / factor >= max_side:
+                image = cv2.imread(image_path, flag)
+                if image is not None:
+                    return image, max(height, width) / max(image.shape[:2])
+                break
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Could not read image {image_path}")
+    return image, 1.0
+
+def _image_size(image_path: str):
+    try:
+        with Image.open(image_path) as im:
+            return im.height, im.width
+    except Exception:
+        return None, None
+
+def _fit(image: np.ndarray, max_side: int):
+    scale = min(max_side / max(image.shape[:2]), 1.0)
+    if scale < 1.0:
+        size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image, scale
+
+def draw_defects(image: np.ndarray, defects: list, scale: float):
+    thickness = max(2, round(max(image.shape[:2]) / 400))
+    for d in defects:
+        x1, y1, x2, y2 = [int(round(v * scale)) for v in d["bbox"]]
+        cv2.rectangle(image, (x1, y1), (x2, y2), BOX_COLOR, thickness)
+        label = f"{d['type'].upper()} ({d['confidence']:.2f})"
+        cv2.putText(image, label, (x1, max(y1 - 6, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, BOX_COLOR, 1, cv2.LINE_AA)
+    return image
+
+def _write(path: str, image: np.ndarray):
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise ValueError(f"Could not encode {path}")
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    with open(tmp_path, "wb") as f:
+        f.write(encoded.tobytes())
+    os.replace(tmp_path, path)
+
+def render(image_path: str, kinds=KINDS, result: dict = None, render_dir: str = RENDER_DIR):
+    # Renders whichever of the requested kinds are not cached yet from a single decode.
+    paths = {kind: render_path(image_path, kind, result, render_dir) for kind in kinds}
+    missing = [kind for kind, path in paths.items() if not os.path.exists(path)]
+    if not missing:
+        return paths
+    os.makedirs(render_dir, exist_ok=True)
+    max_side = OVERLAY_SIZE if "overlay" in missing else THUMBNAIL_SIZE
+    image, decode_scale = _read_scaled(image_path, max_side)
+    if "overlay" in missing:
+        overlay, scale = _fit(image.copy(), OVERLAY_SIZE)
+        _write(paths["overlay"], draw_defects(overlay, (result or {}).get("defects") or [], scale / decode_scale))
+    if "thumbnail" in missing:
+        _write(paths["thumbnail"], _fit(image, THUMBNAIL_SIZE)[0])
+    return paths
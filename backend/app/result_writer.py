@@ -0,0 +1,140 @@
+from collections import Counter
+from concurrent.futures import Future
+import threading
+import queue
+import time
+import os
+import logging
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+RESULT_FLUSH_SIZE = int(os.getenv("RESULT_FLUSH_SIZE", "64"))
+RESULT_FLUSH_MS = float(os.getenv("RESULT_FLUSH_MS", "50"))
+RESULT_FLUSH_RETRIES = int(os.getenv("RESULT_FLUSH_RETRIES", "5"))
+RESULT_RETRY_BACKOFF_MS = float(os.getenv("RESULT_RETRY_BACKOFF_MS", "100"))
+
+_STOP = object()
+
+class ResultWriter:
+    # Collects finished results from all task threads and hands them to `flush` in groups of
+    # up to max_batch_size, or whatever arrived within max_wait_ms of the first one. Each
+    # submit returns a Future that resolves once its result is committed.
+    def __init__(self, flush, max_batch_size: int = RESULT_FLUSH_SIZE, max_wait_ms: float = RESULT_FLUSH_MS,
+                 retries: int = RESULT_FLUSH_RETRIES, backoff_ms: float = RESULT_RETRY_BACKOFF_MS):
+        self.flush = flush
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.retries = retries
+        self.backoff = backoff_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self.flush_sizes = Counter()
+        self.written = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, task_id: str, result: dict, status: str, model_version: str = None):
+        future = Future()
+        item = (task_id, result, status, model_version)
+        if self._closed:
+            # Stragglers after shutdown are written inline rather than dropped.
+            self._write([(item, future)])
+            return future
+        self.start()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self):
+        while True:
+            batch, stopping = self._collect()
+            if batch:
+                self._write(batch)
+            if stopping:
+                break
+
+    def _write(self, batch):
+        items = [item for item, _ in batch]
+        for attempt in range(self.retries + 1):
+            try:
+                self.flush(items)
+                with self._lock:
+                    self.flush_sizes[len(batch)] += 1
+                    self.written += len(batch)
+                for _, future in batch:
+                    future.set_result(None)
+                return
+            except Exception as e:
+                metrics.record_error("result_writer", e)
+                logger.warning(f"Flushing {len(batch)} results failed (attempt {attempt + 1}): {e}")
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+        # A batch that keeps failing is written row by row so one bad result cannot hold back the rest.
+        for item, future in batch:
+            try:
+                self.flush([item])
+                with self._lock:
+                    self.written += 1
+                future.set_result(None)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                future.set_exception(e)
+
+    def close(self, timeout: float = 30):
+        # Flushes everything submitted so far; called on worker shutdown.
+        self._closed = True
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+        leftovers = []
+        while not self._queue.empty():
+            entry = self._queue.get_nowait()
+            if entry is not _STOP:
+                leftovers.append(entry)
+        if leftovers:
+            self._write(leftovers)
+
+    def stats(self):
+        with self._lock:
+            flushes = sum(self.flush_sizes.values())
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "pending": self._queue.qsize(),
+                "flushes": flushes,
+                "written": self.written,
+                "retried": self.retried,
+                "failed": self.failed,
+                "mean_flush_size": sum(size * count for size, count in self.flush_sizes.items()) / flushes if flushes else 0.0,
+            }
@@ -1,52 +1,311 @@
 from sqlalchemy.orm import Session
-from .models import PredictionHistory, SessionLocal
-from ultralytics import YOLO
+from sqlalchemy import and_, func, insert, or_, tuple_, update
+from .models import PredictionHistory, PredictionDefect, SessionLocal
+from .model_registry import acquire_model, registry
+from .stats import record_rollups, in_rollups
+from .defects import record_defects, summarize_result
+from .events import publish_statuses
+from . import tiling, metrics, archive, golden
+import numpy as np
 import cv2
+from datetime import datetime
 import json
 import os
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
-MODEL_PATH = os.getenv("MODEL_PATH", "/app/ml/yolov8_model/best.pt")
+FINAL_STATUSES = ("SUCCESS", "FAILURE")
 
-def get_history(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(PredictionHistory).order_by(PredictionHistory.created_at.desc()).offset(skip).limit(limit).all()
+HISTORY_SUMMARY_COLUMNS = [
+    PredictionHistory.id, PredictionHistory.task_id, PredictionHistory.filename,
+    PredictionHistory.original_filename, PredictionHistory.status, PredictionHistory.created_at,
+    PredictionHistory.model_version, PredictionHistory.batch_id,
+    PredictionHistory.defect_count, PredictionHistory.defect_types,
+]
+
+def encode_cursor(created_at: datetime, row_id: int):
+    return f"{created_at.isoformat()}_{row_id}"
+
+def decode_cursor(cursor: str):
+    created_at, row_id = cursor.rsplit("_", 1)
+    return datetime.fromisoformat(created_at), int(row_id)
+
+# Keyset pagination on (created_at, id): each page is an index range scan that
+# starts where the previous one ended, so deep pages cost the same as the first.
+def get_history(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, status: str = None,
+                defect_type: str = None, date_from: datetime = None, date_to: datetime = None,
+                summary: bool = False):
+    query = db.query(*HISTORY_SUMMARY_COLUMNS) if summary else db.query(PredictionHistory)
+    if status:
+        query = query.filter(PredictionHistory.status == status)
+    if date_from:
+        query = query.filter(PredictionHistory.created_at >= date_from)
+    if date_to:
+        query = query.filter(PredictionHistory.created_at < date_to)
+    if defect_type:
+        query = query.filter(
+            db.query(PredictionDefect.id)
+            .filter(PredictionDefect.prediction_id == PredictionHistory.id, PredictionDefect.defect_type == defect_type)
+            .exists()
+        )
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        query = query.filter(tuple_(PredictionHistory.created_at, PredictionHistory.id) < position)
+        skip = 0
+    query = query.order_by(PredictionHistory.created_at.desc(), PredictionHistory.id.desc())
+    if archive.has_archives(db):
+        # Rows older than the hot window live in Parquet archives; both sides are read in
+        # the same keyset order and merged, so one cursor pages through hot and cold rows.
+        columns = [c.key for c in HISTORY_SUMMARY_COLUMNS] if summary else archive.COLUMNS
+        hot = [row._asdict() if summary else {c: getattr(row, c) for c in columns}
+               for row in query.limit(skip + limit).all()]
+        cold = archive.query_archive(db, skip + limit, position, status, defect_type, date_from, date_to, columns)
+        rows = sorted(hot + cold, key=lambda r: (r["created_at"], r["id"]), reverse=True)[skip:skip + limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if len(rows) == limit else None
+        return rows, next_cursor
+    if skip:
+        query = query.offset(skip)
+    rows = query.limit(limit).all()
+    next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id) if len(rows) == limit else None
+    if summary:
+        rows = [row._asdict() for row in rows]
+    return rows, next_cursor
 
 def get_task_status(db: Session, task_id: str):
-    return db.query(PredictionHistory).filter(PredictionHistory.task_id == task_id).first()
+    task = db.query(PredictionHistory).filter(PredictionHistory.task_id == task_id).first()
+    if task is None:
+        # Archived rows come back as transient objects that are never added to the session.
+        row = archive.find_archived_task(db, task_id)
+        task = PredictionHistory(**row) if row else None
+    return task
 
-def create_task_entry(db: Session, task_id: str, filename: str, original_filename: str):
-    db_item = PredictionHistory(task_id=task_id, filename=filename, original_filename=original_filename, status="PENDING")
+def lock_source_tasks(db: Session, task_ids):
+    # Linking a duplicate upload and writing its source's result both lock the source row first.
+    # Whichever runs second sees the other's commit: the writer finds the linked row, or the link
+    # finds the finished source and copies its result instead of waiting on a flush that has passed.
+    if not task_ids:
+        return {}
+    rows = (
+        db.query(PredictionHistory.task_id, PredictionHistory.status, PredictionHistory.result)
+        .filter(PredictionHistory.task_id.in_(list(task_ids)))
+        .order_by(PredictionHistory.id)
+        .with_for_update()
+        .all()
+    )
+    return {row.task_id: row for row in rows}
+
+def create_task_entry(db: Session, task_id: str, filename: str, original_filename: str,
+                      content_hash: str = None, model_version: str = None, inference_options: str = "",
+                      status: str = "PENDING", result: dict = None, source_task_id: str = None, batch_id: str = None):
+    if source_task_id and status not in FINAL_STATUSES:
+        source = lock_source_tasks(db, [source_task_id]).get(source_task_id)
+        if source is not None and source.status in FINAL_STATUSES:
+            status, result = source.status, source.result
+    db_item = PredictionHistory(
+        task_id=task_id, filename=filename, original_filename=original_filename, status=status,
+        content_hash=content_hash, model_version=model_version, inference_options=inference_options,
+        result=result, source_task_id=source_task_id, batch_id=batch_id, **summarize_result(result),
+    )
     db.add(db_item)
+    if status in FINAL_STATUSES:
+        db.flush()
+        if in_rollups(batch_id):
+            record_rollups(db, [(db_item.created_at, model_version, status, result)])
+        record_defects(db, [(db_item.id, db_item.created_at, result)])
     db.commit()
     return db_item
 
-def update_task_result(task_id: str, result: dict, status: str):
+def find_cached_prediction(db: Session, content_hash: str, model_version: str, inference_options: str = ""):
+    return (
+        db.query(PredictionHistory)
+        .filter(
+            PredictionHistory.content_hash == content_hash,
+            PredictionHistory.model_version == model_version,
+            PredictionHistory.inference_options == inference_options,
+            PredictionHistory.status.in_(["SUCCESS", "PENDING"]),
+            PredictionHistory.source_task_id.is_(None),
+        )
+        .order_by(PredictionHistory.created_at.desc())
+        .first()
+    )
+
+def find_cached_predictions(db: Session, content_hashes: list, model_version: str, inference_options: str = ""):
+    rows = (
+        db.query(PredictionHistory)
+        .filter(
+            PredictionHistory.content_hash.in_(content_hashes),
+            PredictionHistory.model_version == model_version,
+            PredictionHistory.inference_options == inference_options,
+            PredictionHistory.status.in_(["SUCCESS", "PENDING"]),
+            PredictionHistory.source_task_id.is_(None),
+        )
+        .order_by(PredictionHistory.created_at.asc())
+        .all()
+    )
+    return {row.content_hash: row for row in rows}
+
+def create_task_entries(db: Session, entries: list):
+    if entries:
+        now = datetime.utcnow()
+        sources = lock_source_tasks(db, {
+            e["source_task_id"] for e in entries if e.get("source_task_id") and e["status"] not in FINAL_STATUSES
+        })
+        for i, entry in enumerate(entries):
+            source = sources.get(entry.get("source_task_id"))
+            if source is not None and source.status in FINAL_STATUSES and entry["status"] not in FINAL_STATUSES:
+                entries[i] = {**entry, "status": source.status, "result": source.result}
+        entries = [{"created_at": now, **entry, **summarize_result(entry.get("result"))} for entry in entries]
+        db.execute(insert(PredictionHistory), entries)
+        final = [e for e in entries if e["status"] in FINAL_STATUSES]
+        record_rollups(db, [(e["created_at"], e.get("model_version"), e["status"], e.get("result")) for e in final])
+        if final:
+            ids = dict(
+                db.query(PredictionHistory.task_id, PredictionHistory.id)
+                .filter(PredictionHistory.task_id.in_([e["task_id"] for e in final]))
+                .all()
+            )
+            record_defects(db, [(ids[e["task_id"]], e["created_at"], e.get("result")) for e in final])
+        db.commit()
+    return entries
+
+def get_batch_status(db: Session, batch_id: str):
+    counts = dict(
+        db.query(PredictionHistory.status, func.count(PredictionHistory.id))
+        .filter(PredictionHistory.batch_id == batch_id)
+        .group_by(PredictionHistory.status)
+        .all()
+    )
+    total = sum(counts.values())
+    if not total:
+        return None
+    failed = counts.get("FAILURE", 0)
+    done = counts.get("SUCCESS", 0) + failed
+    if done < total:
+        status = "PENDING"
+    elif failed == total:
+        status = "FAILURE"
+    else:
+        status = "PARTIAL_FAILURE" if failed else "SUCCESS"
+    return {
+        "batch_id": batch_id,
+        "total": total,
+        "counts": counts,
+        "completed": done,
+        "progress": done / total,
+        "status": status,
+    }
+
+def get_status_snapshot(db: Session, task_ids: list, batch_ids: list):
+    return (
+        db.query(
+            PredictionHistory.task_id, PredictionHistory.batch_id,
+            PredictionHistory.status, PredictionHistory.result,
+        )
+        .filter(or_(PredictionHistory.task_id.in_(task_ids), PredictionHistory.batch_id.in_(batch_ids)))
+        .all()
+    )
+
+def get_batch_tasks(db: Session, batch_id: str):
+    return (
+        db.query(
+            PredictionHistory.task_id, PredictionHistory.original_filename,
+            PredictionHistory.status, PredictionHistory.result,
+        )
+        .filter(PredictionHistory.batch_id == batch_id)
+        .order_by(PredictionHistory.id)
+        .all()
+    )
+
+def get_cache_stats(db: Session):
+    total, hits = db.query(
+        func.count(PredictionHistory.id), func.count(PredictionHistory.source_task_id)
+    ).filter(PredictionHistory.content_hash.isnot(None)).one()
+    return {"uploads": total, "hits": hits, "hit_ratio": hits / total if total else 0.0}
+
+def write_task_results(db: Session, items: list):
+    # items: (task_id, result, status, model_version). One SELECT covers the tasks and the
+    # duplicate uploads linked to them, one executemany UPDATE writes them all, and rollups
+    # and defects are only recorded for rows reaching a final status here, so replaying the
+    # same items after a failed or uncertain commit changes nothing.
+    latest = {task_id: (result, status, model_version) for task_id, result, status, model_version in items}
+    lock_source_tasks(db, latest)
+    rows = (
+        db.query(
+            PredictionHistory.id, PredictionHistory.task_id, PredictionHistory.status, PredictionHistory.created_at,
+            PredictionHistory.model_version, PredictionHistory.batch_id, PredictionHistory.source_task_id,
+        )
+        .filter(or_(
+            PredictionHistory.task_id.in_(list(latest)),
+            and_(PredictionHistory.source_task_id.in_(list(latest)), PredictionHistory.status == "PENDING"),
+        ))
+        .all()
+    )
+    updates, completed, published = [], [], []
+    for row in rows:
+        result, status, model_version = latest[row.task_id if row.task_id in latest else row.source_task_id]
+        values = {"id": row.id, "result": result, "status": status, **summarize_result(result)}
+        if model_version:
+            values["model_version"] = model_version
+        updates.append(values)
+        if row.status not in FINAL_STATUSES:
+            completed.append((row.id, row.created_at, model_version or row.model_version, status, result))
+        published.append((row.task_id, status, result, row.batch_id))
+    if updates:
+        db.execute(update(PredictionHistory), updates)
+    record_rollups(db, [(created_at, version, status, result) for _, created_at, version, status, result in completed])
+    record_defects(db, [(row_id, created_at, result) for row_id, created_at, _, _, result in completed])
+    return published
+
+def flush_task_results(items: list):
     db = SessionLocal()
+    start = time.perf_counter()
     try:
-        task = db.query(PredictionHistory).filter(PredictionHistory.task_id == task_id).first()
-        if task:
-            task.result = result
-            task.status = status
-            db.commit()
-    except Exception as e:
-        logger.error(f"Error updating task result: {e}")
+        published = write_task_results(db, items)
+        # With the Postgres broker the whole flush is announced by one NOTIFY statement on this
+        # transaction instead of a connection and round-trip per task.
+        notified = publish_statuses(published, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
     finally:
         db.close()
+    elapsed = time.perf_counter() - start
+    for _, _, _, model_version in items:
+        metrics.observe_stage("db_update", elapsed / len(items), model_version)
+    if not notified:
+        publish_statuses(published)
+    return len(published)
+
+def update_task_result(task_id: str, result: dict, status: str, model_version: str = None):
+    try:
+        flush_task_results([(task_id, result, status, model_version)])
+    except Exception as e:
+        metrics.record_error("db_update", e, model_version)
+        logger.error(f"Error updating task result: {e}")
 
 def run_inference(image_path: str):
+    return run_inference_batch([image_path])[0]
+
+def run_inference_batch(images: list):
+    # images are file paths or decoded BGR arrays (stream frames); Ultralytics takes either.
     try:
-        if os.path.exists(MODEL_PATH):
-             model = YOLO(MODEL_PATH)
-        else:
-             logger.warning(f"Model not found at {MODEL_PATH}, using yolov8n.pt")
-             model = YOLO("yolov8n.pt") 
+        # One acquire per batch: every image in it is attributed to the model that ran it,
+        # even if a promoted version becomes active mid-flight.
+        model, version = acquire_model()
+        results = model(images, verbose=False)
+        metrics.BATCH_SIZE.observe(len(images))
 
-        results = model(image_path)
-        
-        defects = []
+        start = time.perf_counter()
+        batch = []
         for r in results:
+            # Ultralytics reports per-image preprocess / forward / NMS times in ms.
+            for stage, key in (("preprocess", "preprocess"), ("inference", "inference"), ("nms", "postprocess")):
+                if r.speed.get(key) is not None:
+                    metrics.observe_stage(stage, r.speed[key] / 1000, version)
+            defects = []
             for box in r.boxes:
                 b = box.xyxy[0].tolist()
                 conf = float(box.conf[0])
@@ -54,10 +313,160 @@ def run_inference(image_path: str):
                 label = model.names[cls]
                 defects.append({
                     "type": label,
+                    "class_id": cls,
                     "confidence": conf,
                     "bbox": b
                 })
-        return {"defects": defects}
+            batch.append({"defects": defects, "model_version": version})
+        metrics.observe_stage("postprocess", (time.perf_counter() - start) / max(len(batch), 1), version)
+        return batch
     except Exception as e:
+        metrics.record_error("inference", e)
         logger.error(f"Inference failed: {e}")
         raise e
+
+def run_tiled_inference(image_path: str, tile_size: int = tiling.DEFAULT_TILE_SIZE,
+                        tile_overlap: float = tiling.DEFAULT_TILE_OVERLAP,
+                        skip_blank_std: float = tiling.DEFAULT_BLANK_STD,
+                        merge_iou: float = tiling.DEFAULT_MERGE_IOU):
+    try:
+        timings = {}
+        start = time.perf_counter()
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not read image {image_path}")
+        height, width = image.shape[:2]
+        timings["decode_ms"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        windows = tiling.tile_grid(height, width, tile_size, tile_overlap)
+        tiles, offsets = [], []
+        for x0, y0, x1, y1 in windows:
+            tile = image[y0:y1, x0:x1]
+            if tiling.is_blank(tile, skip_blank_std):
+                continue
+            tiles.append(tile)
+            offsets.append((x0, y0, x0, y0))
+        timings["tiling_ms"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        model, version = acquire_model()
+        results = model(tiles, imgsz=tile_size, verbose=False) if tiles else []
+        timings["inference_ms"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        boxes, scores, classes = [], [], []
+        for r, offset in zip(results, offsets):
+            if len(r.boxes):
+                boxes.append(r.boxes.xyxy.cpu().numpy() + np.array(offset, dtype=np.float32))
+                scores.append(r.boxes.conf.cpu().numpy())
+                classes.append(r.boxes.cls.cpu().numpy().astype(int))
+        if boxes:
+            boxes, scores, classes = tiling.merge_boxes(
+                np.concatenate(boxes), np.concatenate(scores), np.concatenate(classes), merge_iou
+            )
+        defects = [
+            {"type": model.names[int(c)], "class_id": int(c), "confidence": float(s), "bbox": b.tolist()}
+            for b, s, c in zip(boxes, scores, classes)
+        ]
+        timings["merge_ms"] = (time.perf_counter() - start) * 1000
+        for name, ms in timings.items():
+            metrics.observe_stage(f"tiled_{name[:-3]}", ms / 1000, version)
+
+        return {
+            "defects": defects,
+            "model_version": version,
+            "tiling": {
+                "tile_size": tile_size,
+                "tile_overlap": tile_overlap,
+                "tiles": len(windows),
+                "tiles_inferred": len(tiles),
+                "tiles_skipped": len(windows) - len(tiles),
+                "timings_ms": timings,
+            },
+        }
+    except Exception as e:
+        metrics.record_error("tiled_inference", e)
+        logger.error(f"Tiled inference failed: {e}")
+        raise e
+
+def run_reference_inference(image_path: str, board_type: str, tile_size: int = tiling.DEFAULT_TILE_SIZE,
+                            merge_iou: float = tiling.DEFAULT_MERGE_IOU):
+    # Runs the detector only where the board differs from its golden reference. A clean board
+    # never reaches the model; one that cannot be aligned, or differs almost everywhere, is
+    # inspected whole.
+    try:
+        timings = {}
+        start = time.perf_counter()
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not read image {image_path}")
+        height, width = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        reference = golden.load_reference(board_type)
+        timings["decode_ms"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        summary = {"board_type": board_type, "version": reference.version, "aligned": False, "matches": 0}
+        try:
+            homography, summary["matches"] = golden.align(gray, reference)
+            summary["aligned"] = True
+        except golden.AlignmentError as e:
+            logger.warning(f"Aligning {image_path} to {board_type} failed: {e}")
+        timings["align_ms"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        regions = golden.changed_regions(gray, reference, homography) if summary["aligned"] else None
+        inspected = np.zeros((height, width), dtype=bool)
+        for x0, y0, x1, y1 in regions or []:
+            inspected[y0:y1, x0:x1] = True
+        full_frame = regions is None or bool(inspected.mean() > golden.FULL_FRAME_FRACTION)
+        crops, offsets = [], []
+        if full_frame:
+            crops, offsets = [image], [(0, 0, 0, 0)]
+            inspected[:] = True
+        else:
+            # Large regions are tiled so crops keep native resolution, as in tiled inference.
+            for rx0, ry0, rx1, ry1 in regions:
+                for x0, y0, x1, y1 in tiling.tile_grid(ry1 - ry0, rx1 - rx0, tile_size, tiling.DEFAULT_TILE_OVERLAP):
+                    crops.append(image[ry0 + y0:ry0 + y1, rx0 + x0:rx0 + x1])
+                    offsets.append((rx0 + x0, ry0 + y0, rx0 + x0, ry0 + y0))
+        summary.update(
+            regions=len(regions) if regions is not None else None, crops=len(crops), full_frame=full_frame,
+            skipped_fraction=round(1.0 - float(inspected.mean()), 4),
+        )
+        timings["diff_ms"] = (time.perf_counter() - start) * 1000
+
+        boxes, scores, classes = [], [], []
+        if crops:
+            start = time.perf_counter()
+            model, model_version = acquire_model()
+            results = model(crops, imgsz=tile_size, verbose=False)
+            timings["inference_ms"] = (time.perf_counter() - start) * 1000
+            for r, offset in zip(results, offsets):
+                if len(r.boxes):
+                    boxes.append(r.boxes.xyxy.cpu().numpy() + np.array(offset, dtype=np.float32))
+                    scores.append(r.boxes.conf.cpu().numpy())
+                    classes.append(r.boxes.cls.cpu().numpy().astype(int))
+            if boxes:
+                boxes, scores, classes = tiling.merge_boxes(
+                    np.concatenate(boxes), np.concatenate(scores), np.concatenate(classes), merge_iou
+                )
+            names = model.names
+        else:
+            model_version, names = registry.version(), {}
+        defects = [
+            {"type": names[int(c)], "class_id": int(c), "confidence": float(s), "bbox": b.tolist()}
+            for b, s, c in zip(boxes, scores, classes)
+        ]
+
+        outcome = "unaligned" if not summary["aligned"] else "full_frame" if full_frame else "changed" if crops else "clean"
+        metrics.REFERENCE_BOARDS.labels(outcome).inc()
+        metrics.REFERENCE_SKIPPED_FRACTION.observe(summary["skipped_fraction"])
+        for name, ms in timings.items():
+            metrics.observe_stage(f"reference_{name[:-3]}", ms / 1000, model_version)
+        return {"defects": defects, "model_version": model_version, "reference": {**summary, "timings_ms": timings}}
+    except Exception as e:
+        metrics.record_error("reference_inference", e)
+        logger.error(f"Reference inference failed: {e}")
+        raise e
@@ -0,0 +1,153 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import or_
+from sqlalchemy.dialects import postgresql, sqlite
+from collections import Counter, defaultdict
+from datetime import datetime
+from .models import PredictionHistory, PredictionRollup
+from . import archive
+import logging
+
+logger = logging.getLogger(__name__)
+
+ALL_TIME = datetime(1970, 1, 1)
+ALL_VERSIONS = "*"
+GRANULARITIES = ("hour", "day", "all")
+ROLLUP_KEY = ["granularity", "bucket_start", "model_version", "defect_type"]
+ROLLUP_COUNTERS = ["scans", "defective_scans", "defects", "failures"]
+
+# Streams persist only their defective frames, so counting those rows would inflate the
+# defect rate; stream frames are reported by pcb_stream_frames_total instead.
+STREAM_BATCH_PREFIX = "stream-"
+
+def in_rollups(batch_id: str):
+    return not (batch_id or "").startswith(STREAM_BATCH_PREFIX)
+
+def bucket_start(ts: datetime, granularity: str):
+    if granularity == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ALL_TIME
+
+def rollup_increments(completed: list):
+    # completed: (timestamp, model_version, status, result) for rows that just reached a final status.
+    increments = defaultdict(Counter)
+    for ts, model_version, status, result in completed:
+        defects = (result or {}).get("defects") or []
+        per_class = Counter(d.get("type", "unknown") for d in defects)
+        board = {"scans": 1, "defective_scans": int(bool(defects)), "defects": len(defects),
+                 "failures": int(status == "FAILURE")}
+        for granularity in GRANULARITIES:
+            start = bucket_start(ts, granularity)
+            for version in {model_version or ALL_VERSIONS, ALL_VERSIONS}:
+                increments[(granularity, start, version, "")].update(board)
+                for defect_type, count in per_class.items():
+                    increments[(granularity, start, version, defect_type)].update(
+                        {"scans": 1, "defective_scans": 1, "defects": count}
+                    )
+    return increments
+
+def record_rollups(db: Session, completed: list):
+    increments = rollup_increments(completed)
+    if not increments:
+        return
+    rows = [
+        {**dict(zip(ROLLUP_KEY, key)), **{c: counts.get(c, 0) for c in ROLLUP_COUNTERS}}
+        for key, counts in increments.items()
+    ]
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert(PredictionRollup)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=ROLLUP_KEY,
+            set_={c: getattr(PredictionRollup, c) + getattr(stmt.excluded, c) for c in ROLLUP_COUNTERS},
+        )
+        db.execute(stmt, rows)
+        return
+    for row in rows:
+        existing = db.query(PredictionRollup).filter_by(**{k: row[k] for k in ROLLUP_KEY}).first()
+        if existing:
+            for c in ROLLUP_COUNTERS:
+                setattr(existing, c, getattr(existing, c) + row[c])
+        else:
+            db.add(PredictionRollup(**row))
+
+def _as_dict(row):
+    return {c: getattr(row, c) for c in ROLLUP_COUNTERS}
+
+def get_stats(db: Session, model_version: str = ALL_VERSIONS, granularity: str = None,
+              since: datetime = None, until: datetime = None):
+    rows = (
+        db.query(PredictionRollup)
+        .filter(PredictionRollup.granularity == "all", PredictionRollup.bucket_start == ALL_TIME)
+        .all()
+    )
+    totals = next(
+        (_as_dict(r) for r in rows if r.model_version == model_version and r.defect_type == ""),
+        {c: 0 for c in ROLLUP_COUNTERS},
+    )
+    completed = totals["scans"] - totals["failures"]
+    response = {
+        "model_version": model_version,
+        **totals,
+        "defect_rate": totals["defective_scans"] / completed if completed else 0.0,
+        "by_defect_type": {
+            r.defect_type: _as_dict(r) for r in rows if r.model_version == model_version and r.defect_type
+        },
+        "by_model_version": {
+            r.model_version: _as_dict(r) for r in rows if r.model_version != ALL_VERSIONS and r.defect_type == ""
+        },
+    }
+    if granularity:
+        query = db.query(PredictionRollup).filter(
+            PredictionRollup.granularity == granularity,
+            PredictionRollup.model_version == model_version,
+            PredictionRollup.defect_type == "",
+        )
+        if since:
+            query = query.filter(PredictionRollup.bucket_start >= bucket_start(since, granularity))
+        if until:
+            query = query.filter(PredictionRollup.bucket_start < until)
+        response["series"] = [
+            {"bucket_start": r.bucket_start, **_as_dict(r)}
+            for r in query.order_by(PredictionRollup.bucket_start).all()
+        ]
+    return response
+
+def rebuild_rollups(db: Session, chunk_size: int = 1000):
+    db.query(PredictionRollup).delete()
+    query = (
+        db.query(PredictionHistory.created_at, PredictionHistory.model_version,
+                 PredictionHistory.status, PredictionHistory.result)
+        .filter(PredictionHistory.status.in_(["SUCCESS", "FAILURE"]),
+                or_(PredictionHistory.batch_id.is_(None), PredictionHistory.batch_id.notlike(f"{STREAM_BATCH_PREFIX}%")))
+        .execution_options(yield_per=chunk_size)
+    )
+    chunk = []
+    for row in query:
+        chunk.append(tuple(row))
+        if len(chunk) >= chunk_size:
+            record_rollups(db, chunk)
+            chunk = []
+    # Archived predictions still count towards the rollups they were part of.
+    for row in archive.iter_archived(db, ["created_at", "model_version", "status", "result", "batch_id"]):
+        if not in_rollups(row["batch_id"]):
+            continue
+        chunk.append((row["created_at"], row["model_version"], row["status"], row["result"]))
+        if len(chunk) >= chunk_size:
+            record_rollups(db, chunk)
+            chunk = []
+    record_rollups(db, chunk)
+    db.commit()
+
+if __name__ == "__main__":
+    from .models import SessionLocal
+    from .migrations import migrate
+    migrate()
+    session = SessionLocal()
+    try:
+        rebuild_rollups(session)
+        print("Rollups rebuilt from prediction_history")
+    finally:
+        session.close()
@@ -0,0 +1,217 @@
+from starlette.concurrency import run_in_threadpool
+import numpy as np
+import asyncio
+import cv2
+import io
+import os
+import time
+import uuid
+import logging
+from .batching import MicroBatcher
+from .model_registry import registry
+from .models import AsyncSessionLocal
+from .services import run_inference_batch, create_task_entry
+from .uploads import UPLOAD_DIR, store_stream
+from .stats import STREAM_BATCH_PREFIX
+from . import metrics, renders
+
+logger = logging.getLogger(__name__)
+
+STREAM_DUP_THRESHOLD = int(os.getenv("STREAM_DUP_THRESHOLD", "5"))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "8"))
+STREAM_MAX_IN_FLIGHT = int(os.getenv("STREAM_MAX_IN_FLIGHT", "4"))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "8"))
+STREAM_BATCH_WAIT_MS = float(os.getenv("STREAM_BATCH_WAIT_MS", "5"))
+HASH_SIZE = 8
+
+# All streams share one batcher, so frames from several cameras are coalesced into model
+# calls and the model is only ever driven from one thread.
+batcher = MicroBatcher(run_inference_batch, max_batch_size=STREAM_BATCH_SIZE, max_wait_ms=STREAM_BATCH_WAIT_MS,
+                       version=registry.version)
+
+_END = object()
+
+def dhash(image: np.ndarray, size: int = HASH_SIZE):
+    # Difference hash: one bit per horizontally adjacent pixel pair of a size+1 x size grayscale thumbnail.
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming(a: int, b: int):
+    return bin(a ^ b).count("1")
+
+def decode_frame(data: bytes):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode frame")
+    return image, dhash(image)
+
+def store_frame(data: bytes, result: dict, task_id: str, upload_dir: str = UPLOAD_DIR):
+    filename, file_path, content_hash, _ = store_stream(io.BytesIO(data), upload_dir)
+    try:
+        renders.render(file_path, result=result)
+    except Exception as e:
+        logger.warning(f"Rendering previews for stream frame {task_id} failed: {e}")
+    return filename, content_hash
+
+async def persist_frame(data: bytes, result: dict, task_id: str, original_filename: str, batch_id: str = None,
+                        upload_dir: str = UPLOAD_DIR):
+    # File writes and rendering run in the threadpool; the row goes through the API's pooled async engine.
+    filename, content_hash = await run_in_threadpool(store_frame, data, result, task_id, upload_dir)
+    async with AsyncSessionLocal() as db:
+        await db.run_sync(create_task_entry, task_id, filename, original_filename, content_hash,
+                          result.get("model_version"), status="SUCCESS", result=result, batch_id=batch_id)
+
+class FrameStream:
+    # Three stages joined by bounded queues: the socket reader drops frames when decoding falls
+    # behind, the decoder skips frames whose dHash is within dup_threshold bits of the last frame
+    # it kept and submits the rest to the model, and the deliverer sends results back in frame
+    # order and persists the frames that have defects.
+    def __init__(self, send, infer=None, persist=None, dup_threshold: int = STREAM_DUP_THRESHOLD,
+                 queue_size: int = STREAM_QUEUE_SIZE, max_in_flight: int = STREAM_MAX_IN_FLIGHT):
+        self._send = send
+        self._send_lock = asyncio.Lock()
+        self.infer = infer or batcher.submit
+        self.persist = persist or persist_frame
+        self.dup_threshold = dup_threshold
+        self.stream_id = uuid.uuid4().hex[:12]
+        self._frames = asyncio.Queue(maxsize=queue_size)
+        self._in_flight = asyncio.Queue(maxsize=max_in_flight)
+        self._persisting = set()
+        self._last_hash = None
+        self.received = 0
+        self.counts = {"inspected": 0, "duplicate": 0, "dropped": 0, "invalid": 0, "defective": 0, "persisted": 0}
+
+    async def send(self, message: dict):
+        async with self._send_lock:
+            await self._send(message)
+
+    def _count(self, outcome: str):
+        self.counts[outcome] += 1
+        metrics.STREAM_FRAMES.labels(outcome).inc()
+
+    def feed(self, data: bytes):
+        seq = self.received
+        self.received += 1
+        try:
+            self._frames.put_nowait((seq, data, time.perf_counter()))
+        except asyncio.QueueFull:
+            self._count("dropped")
+
+    async def end(self):
+        await self._frames.put(_END)
+
+    async def run(self):
+        decoder = asyncio.create_task(self._decode())
+        try:
+            await self._deliver()
+        finally:
+            decoder.cancel()
+            if self._persisting:
+                await asyncio.gather(*self._persisting, return_exceptions=True)
+        return self.summary()
+
+    async def _decode(self):
+        while True:
+            entry = await self._frames.get()
+            if entry is _END:
+                await self._in_flight.put(_END)
+                return
+            seq, data, received_at = entry
+            try:
+                image, frame_hash = await run_in_threadpool(decode_frame, data)
+            except ValueError as e:
+                self._count("invalid")
+                await self.send({"type": "error", "frame": seq, "detail": str(e)})
+                continue
+            if self._last_hash is not None and hamming(frame_hash, self._last_hash) <= self.dup_threshold:
+                self._count("duplicate")
+                await self.send({"type": "skipped", "frame": seq, "reason": "duplicate"})
+                continue
+            self._last_hash = frame_hash
+            await self._in_flight.put((seq, data, received_at, asyncio.wrap_future(self.infer(image))))
+
+    async def _deliver(self):
+        while True:
+            entry = await self._in_flight.get()
+            if entry is _END:
+                return
+            seq, data, received_at, future = entry
+            try:
+                result = await future
+            except Exception as e:
+                await self.send({"type": "error", "frame": seq, "detail": str(e)})
+                continue
+            self._count("inspected")
+            message = {
+                "type": "detection", "frame": seq, "defects": result["defects"],
+                "model_version": result.get("model_version"),
+                "latency_ms": round((time.perf_counter() - received_at) * 1000, 1),
+            }
+            if result["defects"]:
+                self._count("defective")
+                message["task_id"] = str(uuid.uuid4())
+                task = asyncio.create_task(self._persist(data, result, message["task_id"], seq))
+                self._persisting.add(task)
+                task.add_done_callback(self._persisting.discard)
+            await self.send(message)
+
+    async def _persist(self, data: bytes, result: dict, task_id: str, seq: int):
+        try:
+            # The stream id doubles as the rows' batch id, which keeps them out of the rollups.
+            await self.persist(data, result, task_id, f"stream-{self.stream_id}-{seq:06d}.jpg",
+                               f"{STREAM_BATCH_PREFIX}{self.stream_id}")
+            self._count("persisted")
+        except Exception as e:
+            metrics.record_error("stream", e, result.get("model_version"))
+            logger.error(f"Persisting stream frame {task_id} failed: {e}")
+
+    def summary(self):
+        return {"type": "summary", "stream_id": self.stream_id, "received": self.received, **self.counts}
+
+def replay(source: str, url: str, fps: float = 0, quality: int = 90, max_frames: int = 0):
+    # Stand-in camera: sends the frames of a video file (or a camera index) over the stream
+    # socket and prints detections as they come back.
+    import json
+    import threading
+    from websockets.sync.client import connect
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise SystemExit(f"Could not open {source}")
+    with connect(url, max_size=None) as ws:
+        def receive():
+            for raw in ws:
+                message = json.loads(raw)
+                if message["type"] == "detection" and message["defects"]:
+                    types = ", ".join(d["type"] for d in message["defects"])
+                    print(f'frame {message["frame"]}: {types} ({message["latency_ms"]} ms) -> {message["task_id"]}')
+                elif message["type"] == "summary":
+                    print(f"Summary: {message}")
+        reader = threading.Thread(target=receive, daemon=True)
+        reader.start()
+        sent, start = 0, time.perf_counter()
+        while not max_frames or sent < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            ws.send(encoded.tobytes())
+            sent += 1
+            if fps:
+                time.sleep(max(0.0, start + sent / fps - time.perf_counter()))
+        ws.send("end")
+        reader.join()
+    capture.release()
+    print(f"Sent {sent} frames in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay a video file into the /stream inspection socket")
+    parser.add_argument("source", help="video file, MJPEG file or camera index")
+    parser.add_argument("--url", default="ws://localhost:8000/stream")
+    parser.add_argument("--fps", type=float, default=0, help="pace frames like a live camera; 0 sends as fast as possible")
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument("--max-frames", type=int, default=0)
+    args = parser.parse_args()
+    replay(args.source, args.url, args.fps, args.quality, args.max_frames)
@@ -0,0 +1,71 @@
+from torchvision.ops import batched_nms
+import numpy as np
+import torch
+import cv2
+
+DEFAULT_TILE_SIZE = 640
+DEFAULT_TILE_OVERLAP = 0.2
+DEFAULT_BLANK_STD = 4.0
+DEFAULT_MERGE_IOU = 0.5
+
+def _starts(length: int, tile_size: int, stride: int):
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+def tile_grid(height: int, width: int, tile_size: int = DEFAULT_TILE_SIZE, overlap: float = DEFAULT_TILE_OVERLAP):
+    stride = max(1, int(tile_size * (1 - overlap)))
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in _starts(height, tile_size, stride)
+        for x in _starts(width, tile_size, stride)
+    ]
+
+def is_blank(tile: np.ndarray, std_threshold: float = DEFAULT_BLANK_STD):
+    if std_threshold <= 0:
+        return False
+    gray = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY) if tile.ndim == 3 else tile
+    return float(gray.std()) < std_threshold
+
+def box_iou(a: np.ndarray, b: np.ndarray):
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+# Class-aware greedy NMS; each kept box is the confidence-weighted mean of the
+# boxes it suppresses, so a defect seen by two overlapping tiles is reported once.
+def merge_boxes(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray, iou_threshold: float = DEFAULT_MERGE_IOU):
+    if len(boxes) == 0:
+        return boxes.reshape(0, 4), scores, classes
+    order = np.argsort(-scores, kind="stable")
+    boxes, scores, classes = boxes[order], scores[order], classes[order]
+    # The sequential keep pass runs in torchvision's kernel, one class at a time via coordinate offsets.
+    keep = batched_nms(torch.from_numpy(boxes.astype(np.float32)), torch.from_numpy(scores.astype(np.float32)),
+                       torch.from_numpy(classes.astype(np.int64)), iou_threshold).numpy()
+    keep.sort()
+
+    # Greedy NMS suppresses a box with the first kept box of its class that overlaps it, so
+    # fusion only needs each class's IoU against its kept boxes. A box the kernel suppressed
+    # right at the threshold falls back to its closest kept box.
+    kept = np.zeros(len(boxes), dtype=bool)
+    kept[keep] = True
+    owner = np.arange(len(boxes))
+    for cls in np.unique(classes):
+        members = np.flatnonzero(classes == cls)
+        anchors = members[kept[members]]
+        iou = box_iou(boxes[members], boxes[anchors])
+        overlaps = iou > iou_threshold
+        owner[members] = anchors[np.where(overlaps.any(axis=1), overlaps.argmax(axis=1), iou.argmax(axis=1))]
+    owner[keep] = keep
+    slot = np.searchsorted(keep, owner)
+    fused = np.zeros((len(keep), 4), dtype=np.result_type(boxes, scores))
+    weights = np.zeros(len(keep), dtype=fused.dtype)
+    np.add.at(fused, slot, boxes * scores[:, None])
+    np.add.at(weights, slot, scores)
+    fused /= weights[:, None]
+    return fused, scores[keep], classes[keep]
@@ -0,0 +1,211 @@
+from fastapi import UploadFile, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+import hashlib
+import tarfile
+import zipfile
+import os
+import uuid
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads")
+CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "1000"))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(2 * 1024 ** 3)))
+# Room for the multipart boundaries and part headers around a single file.
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tif"),
+    (b"MM\x00*", "tif"),
+]
+
+def sniff_image_type(header: bytes):
+    for signature, extension in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def request_body_limit(path: str):
+    if path == "/predict/batch":
+        return MAX_BATCH_BYTES
+    if path == "/predict" or path.startswith("/references/"):
+        return MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES
+    return None
+
+class UploadSizeLimit:
+    # Starlette receives and spools the whole multipart body before a route runs, so the size
+    # cap has to sit in front of it: a declared Content-Length over the limit is refused before
+    # any body is read, and a chunked body is cut off as soon as it passes the limit.
+    def __init__(self, app, limit=request_body_limit):
+        self.app = app
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limit(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        declared = dict(scope["headers"]).get(b"content-length", b"")
+        if declared.isdigit() and int(declared) > limit:
+            response = JSONResponse({"detail": f"Request body exceeds {limit} bytes."}, status_code=413)
+            return await response(scope, receive, send)
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > limit:
+                # Raised inside the form parser; FastAPI passes HTTPException through as the response.
+                raise HTTPException(status_code=413, detail=f"Request body exceeds {limit} bytes.")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+def _open_part(path: str):
+    return open(path, "wb")
+
+def _close_part(buffer):
+    buffer.flush()
+    os.fsync(buffer.fileno())
+    buffer.close()
+
+def _finalize(buffer, tmp_path: str, file_path: str):
+    _close_part(buffer)
+    _place(tmp_path, file_path)
+
+def _place(tmp_path: str, file_path: str):
+    try:
+        # A duplicate upload renews the shared file's age, so image retention sees it as in use.
+        os.utime(file_path)
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        os.replace(tmp_path, file_path)
+
+def _discard(buffer, tmp_path: str):
+    buffer.close()
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+async def receive_upload(file: UploadFile, upload_dir: str = UPLOAD_DIR, max_bytes: int = None):
+    # Reads the upload in chunks without blocking the event loop: disk writes and
+    # fsync run in the threadpool and the SHA-256 is computed as chunks arrive.
+    # The file stays hidden under a temporary name until place_uploads, so work turned
+    # away after hashing is dropped with discard_uploads and leaves nothing in uploads/.
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+    first = await file.read(CHUNK_SIZE)
+    extension = sniff_image_type(first)
+    if extension is None:
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
+
+    tmp_path = os.path.join(upload_dir, f".{uuid.uuid4()}.part")
+    buffer = await run_in_threadpool(_open_part, tmp_path)
+    digest = hashlib.sha256()
+    size = 0
+    chunk = first
+    try:
+        while chunk:
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes.")
+            digest.update(chunk)
+            await run_in_threadpool(buffer.write, chunk)
+            chunk = await file.read(CHUNK_SIZE)
+        await run_in_threadpool(_close_part, buffer)
+    except BaseException:
+        await run_in_threadpool(_discard, buffer, tmp_path)
+        raise
+
+    content_hash = digest.hexdigest()
+    return tmp_path, f"{content_hash}.{extension}", content_hash, size
+
+def place_uploads(received: list, upload_dir: str = UPLOAD_DIR):
+    # (tmp_path, filename) pairs; files are stored under their content hash so identical
+    # uploads share one file.
+    paths = []
+    for tmp_path, filename in received:
+        file_path = os.path.join(upload_dir, filename)
+        _place(tmp_path, file_path)
+        paths.append(file_path)
+    return paths
+
+def discard_uploads(tmp_paths: list):
+    for tmp_path in tmp_paths:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def receive_stream(stream, upload_dir: str = UPLOAD_DIR, max_bytes: int = None):
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+    first = stream.read(CHUNK_SIZE)
+    extension = sniff_image_type(first)
+    if extension is None:
+        raise ValueError("not an image")
+
+    tmp_path = os.path.join(upload_dir, f".{uuid.uuid4()}.part")
+    buffer = _open_part(tmp_path)
+    digest = hashlib.sha256()
+    size = 0
+    chunk = first
+    try:
+        while chunk:
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f"exceeds {max_bytes} bytes")
+            digest.update(chunk)
+            buffer.write(chunk)
+            chunk = stream.read(CHUNK_SIZE)
+        _close_part(buffer)
+    except BaseException:
+        _discard(buffer, tmp_path)
+        raise
+
+    content_hash = digest.hexdigest()
+    return tmp_path, f"{content_hash}.{extension}", content_hash, size
+
+def store_stream(stream, upload_dir: str = UPLOAD_DIR, max_bytes: int = None):
+    tmp_path, filename, content_hash, size = receive_stream(stream, upload_dir, max_bytes)
+    [file_path] = place_uploads([(tmp_path, filename)], upload_dir)
+    return filename, file_path, content_hash, size
+
+def is_archive(header: bytes):
+    return header.startswith(b"PK\x03\x04") or header.startswith(b"\x1f\x8b") or header[257:262] == b"ustar"
+
+def _archive_members(fileobj):
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        yield info.filename, member
+        return
+    fileobj.seek(0)
+    with tarfile.open(fileobj=fileobj, mode="r:*") as archive:
+        for info in archive:
+            if info.isfile():
+                with archive.extractfile(info) as member:
+                    yield info.name, member
+
+def receive_archive(fileobj, upload_dir: str = UPLOAD_DIR, max_files: int = None):
+    # Members are received like single uploads: hidden until placed.
+    max_files = max_files or MAX_BATCH_FILES
+    received, rejected = [], []
+    try:
+        for name, member in _archive_members(fileobj):
+            if os.path.basename(name).startswith("."):
+                continue
+            if len(received) >= max_files:
+                raise HTTPException(status_code=413, detail=f"Archive holds more than {max_files} files.")
+            try:
+                received.append((os.path.basename(name), *receive_stream(member, upload_dir)))
+            except ValueError as e:
+                rejected.append({"filename": name, "reason": str(e)})
+    except BaseException:
+        discard_uploads([item[1] for item in received])
+        raise
+    return received, rejected
@@ -0,0 +1,264 @@
+"""End-to-end latency/throughput benchmark for /predict -> predict_defect -> /status.
+
+Runs entirely offline against local stand-ins: SQLite (or any DATABASE_URL),
+Celery in eager mode or a threaded worker on the in-memory broker, and synthetic
+PCB images. Results are written as JSON so runs on different commits can be
+compared with --compare.
+
+    python -m backend.benchmarks.bench_pipeline --concurrency 1 4 16 --requests 64
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from functools import wraps
+import numpy as np
+import argparse
+import inspect
+import resource
+import subprocess
+import tempfile
+import platform
+import threading
+import json
+import time
+import os
+import cv2
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["eager", "worker"], default="eager",
+                        help="eager: tasks run inline in the API call; worker: threaded Celery worker on memory://")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="requests per concurrency level")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=960)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--worker-concurrency", type=int, default=16)
+    parser.add_argument("--database-url", default=None, help="defaults to a temporary SQLite file")
+    parser.add_argument("--model", default=None, help="MODEL_PATH override")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", default=None, help="previous result JSON to diff against")
+    return parser.parse_args()
+
+def configure_environment(args, workdir):
+    # Must run before backend.app is imported: engines, upload dir and model path are read at import time.
+    os.environ.setdefault("DATABASE_URL", args.database_url or f"sqlite:///{workdir}/bench.db")
+    os.environ["UPLOAD_DIR"] = os.path.join(workdir, "uploads")
+    os.environ.setdefault("EVENTS_BACKEND", "memory")
+    # Every benchmark request comes from one client; measure the pipeline, not the rate limiter.
+    os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    if args.model:
+        os.environ["MODEL_PATH"] = args.model
+    os.makedirs(os.environ["UPLOAD_DIR"], exist_ok=True)
+
+def synthetic_pcb(width, height, seed):
+    rng = np.random.default_rng(seed)
+    board = np.zeros((height, width, 3), dtype=np.uint8)
+    board[:] = (40, 110 + rng.integers(0, 20), 30)
+    for _ in range(max(8, width * height // 20000)):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        if rng.random() < 0.5:
+            x2, y2 = (x + int(rng.integers(-200, 200)), y) if rng.random() < 0.5 else (x, y + int(rng.integers(-200, 200)))
+            cv2.line(board, (x, y), (x2, y2), (60, 170, 200), int(rng.integers(2, 6)))
+        else:
+            size = int(rng.integers(6, 24))
+            cv2.rectangle(board, (x, y), (x + size, y + size), (180, 180, 190), -1)
+            cv2.circle(board, (x + size // 2, y + size // 2), size // 4, (90, 90, 90), -1)
+    ok, encoded = cv2.imencode(".jpg", board, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes()
+
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds * 1000)
+
+    def wrap(self, stage, fn):
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def timed_async(*a, **kw):
+                start = time.perf_counter()
+                try:
+                    return await fn(*a, **kw)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+            return timed_async
+
+        @wraps(fn)
+        def timed(*a, **kw):
+            start = time.perf_counter()
+            try:
+                return fn(*a, **kw)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+
+    def summary(self):
+        with self._lock:
+            return {stage: percentiles(values) for stage, values in self.samples.items()}
+
+def percentiles(values_ms):
+    values = np.asarray(values_ms)
+    if not len(values):
+        return {}
+    return {
+        "count": int(len(values)),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+def instrument(timer):
+    from backend.app.api import routes
+    from backend.app import tasks, services
+
+    routes.receive_upload = timer.wrap("upload_write", routes.receive_upload)
+    routes.create_task_entry = timer.wrap("create_task_entry", routes.create_task_entry)
+    routes.predict_defect.delay = timer.wrap("dispatch", routes.predict_defect.delay)
+    tasks.update_task_result = timer.wrap("update_task_result", tasks.update_task_result)
+    tasks.batcher.handler = timer.wrap("inference_batch", tasks.batcher.handler)
+    services.acquire_model = timer.wrap("model_lookup", services.acquire_model)
+
+def run_request(client, payload, timeout=120):
+    start = time.perf_counter()
+    response = client.post("/predict", files={"file": ("bench.jpg", payload, "image/jpeg")})
+    response.raise_for_status()
+    submitted = time.perf_counter()
+    task_id = response.json()["task_id"]
+    status = response.json()["status"]
+    while status not in ("SUCCESS", "FAILURE"):
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"task {task_id} did not finish in {timeout}s")
+        time.sleep(0.005)
+        status = client.get(f"/status/{task_id}").json()["status"]
+    done = time.perf_counter()
+    return {"submit_ms": (submitted - start) * 1000, "end_to_end_ms": (done - start) * 1000, "status": status}
+
+def run_level(app, concurrency, payloads):
+    from fastapi.testclient import TestClient
+    local = threading.local()
+
+    def call(payload):
+        if not hasattr(local, "client"):
+            local.client = TestClient(app)
+        return run_request(local.client, payload)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(call, payloads))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(payloads),
+        "failures": sum(o["status"] != "SUCCESS" for o in outcomes),
+        "images_per_sec": len(payloads) / elapsed,
+        "wall_s": elapsed,
+        "submit_ms": percentiles([o["submit_ms"] for o in outcomes]),
+        "end_to_end_ms": percentiles([o["end_to_end_ms"] for o in outcomes]),
+    }
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if platform.system() == "Darwin" else rss / 1024
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+def compare(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\nComparison with {previous_path} ({previous.get('git_revision')}):")
+    old_levels = {level["concurrency"]: level for level in previous.get("levels", [])}
+    for level in current["levels"]:
+        old = old_levels.get(level["concurrency"])
+        if not old:
+            continue
+        for key, new_value, old_value in [
+            ("images/s", level["images_per_sec"], old["images_per_sec"]),
+            ("e2e p95 ms", level["end_to_end_ms"].get("p95"), old["end_to_end_ms"].get("p95")),
+        ]:
+            if new_value and old_value:
+                print(f"  c={level['concurrency']:<3} {key:<11} {old_value:10.2f} -> {new_value:10.2f} ({(new_value / old_value - 1) * 100:+.1f}%)")
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="pcb-bench-")
+    configure_environment(args, workdir)
+
+    from backend.app.main import app
+    from backend.app.tasks import celery_app, batcher
+    from backend.app.model_registry import registry
+
+    timer = StageTimer()
+    instrument(timer)
+
+    worker = None
+    if args.mode == "eager":
+        celery_app.conf.task_always_eager = True
+    else:
+        from celery.contrib.testing.worker import start_worker
+        celery_app.conf.broker_url = "memory://"
+        celery_app.conf.result_backend = "cache+memory://"
+        celery_app.conf.broker_transport_options = {"polling_interval": 0.005}
+        worker = start_worker(celery_app, pool="threads", concurrency=args.worker_concurrency, perform_ping_check=False)
+        worker.__enter__()
+
+    try:
+        start = time.perf_counter()
+        registry.get()
+        model_load_s = time.perf_counter() - start
+
+        seed = 0
+        warmup = [synthetic_pcb(args.width, args.height, seed + i) for i in range(args.warmup)]
+        seed += args.warmup
+        if warmup:
+            run_level(app, 1, warmup)
+        timer.reset()
+
+        levels, stages = [], {}
+        for concurrency in args.concurrency:
+            payloads = [synthetic_pcb(args.width, args.height, seed + i) for i in range(args.requests)]
+            seed += args.requests
+            result = run_level(app, concurrency, payloads)
+            stages[str(concurrency)] = timer.summary()
+            timer.reset()
+            levels.append(result)
+            print(f"c={concurrency:<3} {result['images_per_sec']:7.2f} img/s  "
+                  f"e2e p50 {result['end_to_end_ms']['p50']:8.1f} ms  p95 {result['end_to_end_ms']['p95']:8.1f} ms  "
+                  f"p99 {result['end_to_end_ms']['p99']:8.1f} ms  failures {result['failures']}")
+
+        output = {
+            "git_revision": git_revision(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "database_url": os.environ["DATABASE_URL"],
+            "model_load_s": model_load_s,
+            "model_cache": registry.stats(),
+            "batching": batcher.stats(),
+            "levels": levels,
+            "stages_ms": stages,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    finally:
+        if worker is not None:
+            worker.__exit__(None, None, None)
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2, default=str)
+    print(f"Peak RSS {output['peak_rss_mb']:.0f} MB; results saved to {args.output}")
+    if args.compare:
+        compare(output, args.compare)
+
+if __name__ == "__main__":
+    main()
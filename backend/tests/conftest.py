@@ -1,6 +1,7 @@
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from backend.app.main import app
 from backend.app.models import Base, get_db
@@ -18,27 +19,28 @@ def db_engine():
     Base.metadata.create_all(bind=engine)
     yield engine
     Base.metadata.drop_all(bind=engine)
+    engine.dispose()
     if os.path.exists("./test.db"):
         os.remove("./test.db")
 
+# Tests seed rows through a synchronous session while the API reads through aiosqlite,
+# so seeded rows are committed for real and the tables are dropped per module instead.
 @pytest.fixture(scope="module")
 def db(db_engine):
-    connection = db_engine.connect()
-    transaction = connection.begin()
-    session = TestingSessionLocal(bind=connection)
+    session = TestingSessionLocal()
     yield session
     session.close()
-    transaction.rollback()
-    connection.close()
 
 @pytest.fixture(scope="module")
 def client(db):
-    def override_get_db():
-        try:
-            yield db
-        finally:
-            pass
+    async_engine = create_async_engine("sqlite+aiosqlite:///./test.db")
+    AsyncTestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_db():
+        async with AsyncTestingSessionLocal() as session:
+            yield session
     
     app.dependency_overrides[get_db] = override_get_db
     with TestClient(app) as c:
         yield c
+    app.dependency_overrides.clear()
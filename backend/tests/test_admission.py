@@ -0,0 +1,100 @@
+from unittest.mock import patch
+import os
+from backend.app import admission
+from backend.app.admission import AdmissionController, LoadTracker, RateLimiter, QUEUES
+from backend.app.api import routes
+from backend.app.uploads import UPLOAD_DIR
+
+JPEG_HEADER = b"\xff\xd8\xff\xe0"
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_load_tracker_rates_cover_busy_time_only():
+    clock = FakeClock()
+    tracker = LoadTracker(clock)
+    for _ in range(4):
+        with tracker.track("inline"):
+            clock.now += 0.5
+        clock.now += 10
+    with tracker.track("backfill", count=16):
+        clock.now += 2
+    assert tracker.rates() == {"inline": 2.0, "backfill": 8.0}
+    assert tracker.rates() == {}
+
+def test_rate_limiter_refills_per_client():
+    clock = FakeClock()
+    limiter = RateLimiter(rate_per_minute=60, burst=2, clock=clock)
+    assert limiter.acquire("station-1") == 0
+    assert limiter.acquire("station-1") == 0
+    assert limiter.acquire("station-1") == 1.0
+    assert limiter.acquire("station-2") == 0
+    clock.now += 1
+    assert limiter.acquire("station-1") == 0
+
+def test_admission_uses_depth_and_reported_throughput():
+    depths = {QUEUES["interactive"]: 90, QUEUES["backfill"]: 10}
+    controller = AdmissionController(lambda: depths, max_wait={"interactive": 10, "backfill": 100},
+                                     max_depth={"interactive": 1000, "backfill": 50}, refresh_seconds=60)
+    controller.refresh()
+    # With no worker reports only the depth cap applies.
+    assert controller.check("interactive") is None
+    controller.observe({"type": "worker_load", "worker": "w1", "rates": {"interactive": 5.0}})
+    controller.observe({"type": "worker_load", "worker": "w2", "rates": {"interactive": 5.0}})
+    assert controller.throughput("interactive") == 10.0
+    assert controller.check("interactive", count=9) is None
+    # 100 queued at 10/s is exactly the 10 s budget; one more crosses it.
+    assert controller.check("interactive") == 1
+    assert controller.check("backfill", count=41) == admission.ADMISSION_RETRY_SECONDS
+    assert controller.stats()["rejected"] == {"interactive:wait": 1, "backfill:depth": 1}
+
+    depths[QUEUES["interactive"]] = 0
+    controller.refresh()
+    assert controller.check("interactive", count=50) is None
+
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_predict_routes_priority_and_returns_429_when_full(mock_celery, client, monkeypatch):
+    controller = AdmissionController(lambda: {}, max_wait={}, max_depth={"inline": 1}, refresh_seconds=60)
+    monkeypatch.setattr(routes, "admission", controller)
+    first = client.post("/predict?priority=inline", files={"file": ("a.jpg", JPEG_HEADER + b"admit a", "image/jpeg")})
+    assert first.status_code == 200
+    assert mock_celery.call_args.kwargs["priority"] == "inline"
+
+    # A full class is shed before the body is read, so nothing is hashed or stored.
+    with patch("backend.app.api.routes.receive_upload") as mock_receive:
+        second = client.post("/predict?priority=inline", files={"file": ("b.jpg", JPEG_HEADER + b"admit b", "image/jpeg")})
+    assert second.status_code == 429
+    assert second.headers["Retry-After"] == str(admission.ADMISSION_RETRY_SECONDS)
+    assert not mock_receive.called
+    assert client.post("/predict?priority=urgent", files={"file": ("c.jpg", JPEG_HEADER, "image/jpeg")}).status_code == 422
+
+@patch("backend.app.api.routes.dispatch_batch")
+def test_batch_shed_after_hashing_leaves_no_files_and_cache_hits_pass(mock_dispatch, client, monkeypatch):
+    controller = AdmissionController(lambda: {}, max_wait={}, max_depth={"backfill": 2}, refresh_seconds=60)
+    monkeypatch.setattr(routes, "admission", controller)
+    files = [("files", (f"s{i}.jpg", JPEG_HEADER + f"shed {i}".encode(), "image/jpeg")) for i in range(3)]
+    before = set(os.listdir(UPLOAD_DIR))
+    # The gate lets it in (one more item fits) but three new boards don't: the received files are dropped.
+    assert client.post("/predict/batch", files=files).status_code == 429
+    assert set(os.listdir(UPLOAD_DIR)) == before
+
+    assert client.post("/predict/batch", files=files[:2]).json()["queued"] == 2
+    controller.refresh()
+    assert controller.check("backfill") is None
+    # Only one slot is left, yet boards already in the cache skip admission after hashing.
+    repeat = client.post("/predict/batch", files=files[:2])
+    assert repeat.status_code == 200
+    assert (repeat.json()["queued"], repeat.json()["cached"]) == (0, 2)
+
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_predict_rate_limits_each_client(mock_celery, client, monkeypatch):
+    monkeypatch.setattr(routes, "rate_limiter", RateLimiter(rate_per_minute=1, burst=1))
+    files = {"file": ("r.jpg", JPEG_HEADER + b"rate limited", "image/jpeg")}
+    assert client.post("/predict", files=files).status_code == 200
+    limited = client.post("/predict", files=files)
+    assert limited.status_code == 429
+    assert int(limited.headers["Retry-After"]) > 0
@@ -1,5 +1,12 @@
+import json
+import threading
+import time
+import io
+import zipfile
 from unittest.mock import patch
 
+JPEG_HEADER = b"\xff\xd8\xff\xe0"
+
 def test_read_main(client):
     response = client.get("/")
     assert response.status_code == 200
@@ -7,7 +14,7 @@ def test_read_main(client):
 
 @patch("backend.app.api.routes.predict_defect.delay")
 def test_predict_endpoint(mock_celery, client):
-    file_content = b"fake image content"
+    file_content = JPEG_HEADER + b"fake image content"
     files = {"file": ("test.jpg", file_content, "image/jpeg")}
     
     mock_celery.return_value = None
@@ -25,3 +32,259 @@ def test_get_history_empty(client):
     response = client.get("/history")
     assert response.status_code == 200
     assert isinstance(response.json(), list)
+
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_duplicate_upload_reuses_prediction(mock_celery, client):
+    files = {"file": ("board.jpg", JPEG_HEADER + b"duplicate board bytes", "image/jpeg")}
+    first = client.post("/predict", files=files).json()
+    assert mock_celery.call_count == 1
+
+    second = client.post("/predict", files=files).json()
+    assert second["cached"] is True
+    assert second["source_task_id"] == first["task_id"]
+    assert second["image_url"] == first["image_url"]
+    assert mock_celery.call_count == 1
+
+    tiled = client.post("/predict?tiled=true", files=files).json()
+    assert "cached" not in tiled
+    assert mock_celery.call_count == 2
+
+    stats = client.get("/cache/stats").json()
+    assert stats["hits"] == 1
+    assert 0 < stats["hit_ratio"] < 1
+
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_predict_rejects_non_image_bytes(mock_celery, client):
+    files = {"file": ("notes.jpg", b"just some text", "image/jpeg")}
+    response = client.post("/predict", files=files)
+    assert response.status_code == 400
+    assert not mock_celery.called
+
+@patch("backend.app.uploads.MAX_UPLOAD_BYTES", 16)
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_predict_rejects_oversized_upload(mock_celery, client):
+    files = {"file": ("large.jpg", JPEG_HEADER + b"x" * 64, "image/jpeg")}
+    response = client.post("/predict", files=files)
+    assert response.status_code == 413
+    assert not mock_celery.called
+
+@patch("backend.app.uploads.MAX_UPLOAD_BYTES", 1024)
+@patch("backend.app.api.routes.receive_upload")
+def test_oversized_body_is_refused_before_the_form_is_parsed(mock_store, client):
+    files = {"file": ("large.jpg", JPEG_HEADER + b"x" * 256 * 1024, "image/jpeg")}
+    declared = client.post("/predict", files=files)
+    assert declared.status_code == 413
+    assert declared.json()["detail"].startswith("Request body exceeds")
+
+    def chunks():
+        yield b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.jpg\"\r\n\r\n"
+        for _ in range(64):
+            yield b"x" * 16 * 1024
+    chunked = client.post("/predict", content=chunks(), headers={"content-type": "multipart/form-data; boundary=b"})
+    assert chunked.status_code == 413
+    assert not mock_store.called
+
+@patch("backend.app.api.routes.dispatch_batch")
+def test_predict_batch_accepts_files_and_archives(mock_dispatch, client):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("lot/board_1.jpg", JPEG_HEADER + b"board one")
+        zf.writestr("lot/board_2.jpg", JPEG_HEADER + b"board two")
+        zf.writestr("lot/readme.txt", b"not an image")
+    files = [
+        ("files", ("board_3.jpg", JPEG_HEADER + b"board three", "image/jpeg")),
+        ("files", ("board_3_retry.jpg", JPEG_HEADER + b"board three", "image/jpeg")),
+        ("files", ("lot.zip", archive.getvalue(), "application/zip")),
+    ]
+
+    response = client.post("/predict/batch", files=files)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == 4
+    assert data["queued"] == 3
+    assert [r["filename"] for r in data["rejected"]] == ["lot/readme.txt"]
+    assert mock_dispatch.call_count == 1
+    assert len(mock_dispatch.call_args[0][0]) == 3
+
+    status = client.get(f"/batch/{data['batch_id']}").json()
+    assert status["total"] == 4
+    assert status["counts"] == {"PENDING": 4}
+    assert status["progress"] == 0
+
+    detailed = client.get(f"/batch/{data['batch_id']}?include_tasks=true").json()
+    assert len(detailed["tasks"]) == 4
+
+def test_batch_status_not_found(client):
+    assert client.get("/batch/missing").status_code == 404
+
+def test_batch_status_reports_failures(client, db):
+    from backend.app.models import PredictionHistory
+    for i, status in enumerate(["FAILURE", "FAILURE", "SUCCESS", "FAILURE"]):
+        batch_id = "batch-failed" if i < 2 else "batch-partial"
+        db.add(PredictionHistory(task_id=f"bs-{i}", filename=f"{i}.jpg", status=status, batch_id=batch_id))
+    db.commit()
+    assert client.get("/batch/batch-failed").json()["status"] == "FAILURE"
+    partial = client.get("/batch/batch-partial").json()
+    assert (partial["status"], partial["completed"]) == ("PARTIAL_FAILURE", 2)
+
+def test_history_keyset_pagination_and_filters(client, db):
+    from datetime import datetime, timedelta
+    from backend.app.models import PredictionHistory
+    from backend.app.defects import record_defects
+    base = datetime(2024, 1, 1)
+    for i in range(5):
+        row = PredictionHistory(
+            task_id=f"page-{i}", filename=f"page-{i}.jpg", original_filename=f"page-{i}.jpg",
+            status="SUCCESS", created_at=base + timedelta(minutes=i),
+            result={"defects": [{"type": "spike"}]} if i % 2 else {"defects": []},
+            defect_count=1 if i % 2 else 0, defect_types=",spike," if i % 2 else "",
+        )
+        db.add(row)
+        db.flush()
+        record_defects(db, [(row.id, row.created_at, row.result)])
+    db.commit()
+    window = {"date_from": "2024-01-01T00:00:00", "date_to": "2024-01-02T00:00:00"}
+
+    first = client.get("/history", params={**window, "limit": 2})
+    assert [item["task_id"] for item in first.json()] == ["page-4", "page-3"]
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = client.get("/history", params={**window, "limit": 2, "cursor": cursor})
+    assert [item["task_id"] for item in second.json()] == ["page-2", "page-1"]
+
+    spikes = client.get("/history", params={**window, "defect_type": "spike", "fields": "summary"}).json()
+    assert [item["task_id"] for item in spikes] == ["page-3", "page-1"]
+    assert "result" not in spikes[0]
+    assert spikes[0]["defect_count"] == 1
+
+    assert client.get("/history", params={"cursor": "garbage"}).status_code == 400
+
+def test_stats_reads_incremental_rollups(client, db):
+    from datetime import datetime
+    from backend.app.stats import record_rollups
+    ts = datetime(2024, 2, 1, 10, 30)
+    record_rollups(db, [
+        (ts, "v1", "SUCCESS", {"defects": [{"type": "spike"}, {"type": "spike"}, {"type": "poor_solder"}]}),
+        (ts, "v1", "SUCCESS", {"defects": []}),
+    ])
+    record_rollups(db, [(ts, "v2", "FAILURE", {"error": "boom"})])
+    db.commit()
+
+    stats = client.get("/stats").json()
+    assert stats["scans"] == 3
+    assert stats["defective_scans"] == 1
+    assert stats["defects"] == 3
+    assert stats["failures"] == 1
+    assert stats["defect_rate"] == 0.5
+    assert stats["by_defect_type"]["spike"]["defects"] == 2
+    assert stats["by_model_version"]["v1"]["scans"] == 2
+
+    hourly = client.get("/stats", params={"model_version": "v1", "granularity": "hour"}).json()
+    assert [point["scans"] for point in hourly["series"]] == [2]
+
+def _read_events(response):
+    events = []
+    for line in response.iter_lines():
+        if line.startswith("data: "):
+            events.append(json.loads(line[len("data: "):]))
+    return events
+
+def test_events_stream_pushes_transitions(client, db):
+    from backend.app.models import PredictionHistory
+    from backend.app.events import publish_status
+    db.add(PredictionHistory(task_id="sse-done", filename="d.jpg", status="SUCCESS", result={"defects": []}))
+    db.add(PredictionHistory(task_id="sse-live", filename="l.jpg", status="PENDING", batch_id="sse-batch"))
+    db.commit()
+
+    def finish():
+        time.sleep(0.2)
+        publish_status("sse-live", "STARTED", batch_id="sse-batch")
+        publish_status("sse-live", "SUCCESS", {"defects": [{"type": "spike"}]}, "sse-batch")
+
+    threading.Thread(target=finish).start()
+    params = {"task_id": ["sse-done", "sse-missing"], "batch_id": "sse-batch"}
+    with client.stream("GET", "/events", params=params) as response:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = _read_events(response)
+
+    by_task = [(e["task_id"], e["status"]) for e in events]
+    assert ("sse-done", "SUCCESS") in by_task
+    assert ("sse-missing", "NOT_FOUND") in by_task
+    assert by_task[-2:] == [("sse-live", "STARTED"), ("sse-live", "SUCCESS")]
+    assert events[-1]["result"] == {"defects": [{"type": "spike"}]}
+
+def test_events_requires_subscription(client):
+    assert client.get("/events").status_code == 400
+
+def test_defect_table_queries_and_backfill(client, db):
+    from datetime import datetime
+    from backend.app.models import PredictionHistory
+    from backend.app.defects import backfill_defects
+    for i, confidence in enumerate([0.95, 0.5]):
+        db.add(PredictionHistory(
+            task_id=f"defect-{i}", filename=f"defect-{i}.jpg", original_filename=f"defect-{i}.jpg",
+            status="SUCCESS", created_at=datetime(2024, 3, 1, 8 + i),
+            result={"defects": [
+                {"type": "poor_solder", "class_id": 3, "confidence": confidence, "bbox": [1, 2, 3, 4]},
+                {"type": "exc_solder", "class_id": 0, "confidence": 0.9, "bbox": [5, 6, 7, 8]},
+            ]},
+        ))
+    clean = PredictionHistory(task_id="defect-clean", filename="clean.jpg", status="SUCCESS",
+                              created_at=datetime(2024, 3, 1, 12), result={"defects": []})
+    db.add(clean)
+    db.commit()
+
+    backfill_defects(db, chunk_size=1)
+    db.refresh(clean)
+    assert (clean.defect_count, clean.defect_types) == (0, "")
+    # A rerun reads nothing: defective rows now have their defects, clean ones their summary.
+    assert backfill_defects(db) == {"predictions": 0, "defects": 0}
+
+    window = {"since": "2024-03-01T00:00:00", "until": "2024-03-02T00:00:00"}
+    confident = client.get("/defects", params={**window, "defect_type": "poor_solder", "min_confidence": 0.8}).json()
+    assert [(d["task_id"], d["x2"]) for d in confident] == [("defect-0", 3.0)]
+
+    density = client.get("/defects/density", params=window).json()
+    assert density == [
+        {"day": "2024-03-01", "defect_type": "exc_solder", "defects": 2, "boards": 2, "mean_confidence": 0.9},
+        {"day": "2024-03-01", "defect_type": "poor_solder", "defects": 2, "boards": 2, "mean_confidence": 0.725},
+    ]
+
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_metrics_endpoint_exposes_stage_histograms(mock_celery, client):
+    client.post("/predict", files={"file": ("m.jpg", JPEG_HEADER + b"metrics board", "image/jpeg")})
+    assert mock_celery.call_args[0][3] > 0
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    for stage in ("upload_write", "cache_lookup", "create_task_entry", "dispatch"):
+        assert f'pcb_stage_duration_seconds_count{{model_version="yolov8n.pt",stage="{stage}"}}' in body
+    assert 'pcb_http_request_duration_seconds_count{method="POST",route="/predict",status="200"}' in body
+
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_thumbnail_and_overlay_are_rendered_lazily_with_etags(mock_celery, client, db):
+    import cv2
+    import numpy as np
+    from backend.app.models import PredictionHistory
+    board = np.random.default_rng(1).integers(0, 255, (1200, 1600, 3), dtype=np.uint8)
+    payload = cv2.imencode(".jpg", board)[1].tobytes()
+    task = client.post("/predict", files={"file": ("render.jpg", payload, "image/jpeg")}).json()
+
+    thumbnail = client.get(task["thumbnail_url"])
+    assert thumbnail.status_code == 200
+    assert thumbnail.headers["cache-control"].startswith("public")
+    assert max(cv2.imdecode(np.frombuffer(thumbnail.content, np.uint8), cv2.IMREAD_COLOR).shape[:2]) == 256
+    assert len(thumbnail.content) < len(payload)
+    cached = client.get(task["thumbnail_url"], headers={"If-None-Match": thumbnail.headers["etag"]})
+    assert cached.status_code == 304
+
+    assert client.get(task["overlay_url"]).status_code == 404
+    row = db.query(PredictionHistory).filter(PredictionHistory.task_id == task["task_id"]).one()
+    row.status = "SUCCESS"
+    row.result = {"defects": [{"type": "spur", "confidence": 0.9, "bbox": [100, 100, 400, 300]}]}
+    db.commit()
+    overlay = client.get(task["overlay_url"])
+    assert overlay.status_code == 200
+    assert overlay.headers["etag"] != thumbnail.headers["etag"]
+    assert max(cv2.imdecode(np.frombuffer(overlay.content, np.uint8), cv2.IMREAD_COLOR).shape[:2]) == 1280
@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import os
+import time
+from backend.app import archive, stats
+from backend.app.models import PredictionHistory, PredictionDefect, PredictionArchive, ArchivedTask
+from backend.app.defects import record_defects
+
+def _add(db, task_id, created_at, status="SUCCESS", defects=(), filename=None):
+    row = PredictionHistory(
+        task_id=task_id, filename=filename or f"{task_id}.jpg", original_filename=f"{task_id}.jpg",
+        status=status, created_at=created_at,
+        result={"defects": [{"type": t, "confidence": 0.9, "bbox": [1, 2, 3, 4]} for t in defects]} if status == "SUCCESS" else None,
+        defect_count=len(defects), defect_types=f",{','.join(defects)}," if defects else "",
+    )
+    db.add(row)
+    db.flush()
+    record_defects(db, [(row.id, row.created_at, row.result)])
+    return row
+
+def test_compaction_moves_old_rows_to_archive_and_history_merges_them(client, db, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    _add(db, "old-jan-1", datetime(2023, 1, 10), defects=["spur"])
+    _add(db, "old-jan-2", datetime(2023, 1, 20))
+    _add(db, "old-feb", datetime(2023, 2, 5), defects=["short"])
+    _add(db, "old-pending", datetime(2023, 1, 15), status="PENDING")
+    _add(db, "recent", datetime(2024, 6, 1), defects=["spur"])
+    db.commit()
+
+    assert archive.archive_rows(db, datetime(2024, 1, 1), chunk_size=2) == {"rows": 3, "files": 2}
+    hot = {row.task_id for row in db.query(PredictionHistory.task_id)}
+    assert hot == {"old-pending", "recent"}
+    # Defect rows outlive their archived predictions.
+    assert db.query(PredictionDefect).count() == 3
+    assert sum(entry.row_count for entry in db.query(PredictionArchive)) == 3
+
+    window = {"date_from": "2022-01-01T00:00:00", "date_to": "2025-01-01T00:00:00", "limit": 2}
+    pages, params = [], dict(window)
+    while True:
+        response = client.get("/history", params=params)
+        pages.append([item["task_id"] for item in response.json()])
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params = {**window, "cursor": response.headers["X-Next-Cursor"]}
+    assert pages == [["recent", "old-feb"], ["old-jan-2", "old-pending"], ["old-jan-1"]]
+
+    spurs = client.get("/history", params={**window, "defect_type": "spur", "fields": "summary", "limit": 10}).json()
+    assert [item["task_id"] for item in spurs] == ["recent", "old-jan-1"]
+    assert "result" not in spurs[1]
+    full = client.get("/history", params={**window, "status": "SUCCESS", "limit": 10}).json()
+    assert full[1]["task_id"] == "old-feb"
+    assert full[1]["result"]["defects"][0]["type"] == "short"
+
+    defects = client.get("/defects", params={"limit": 10}).json()
+    assert [(d["task_id"], d["defect_type"]) for d in defects] == [("recent", "spur"), ("old-feb", "short"), ("old-jan-1", "spur")]
+    assert defects[1]["original_filename"] == "old-feb.jpg"
+    stats.rebuild_rollups(db)
+    days = stats.get_stats(db, granularity="day", since=datetime(2023, 1, 1), until=datetime(2023, 3, 1))["series"]
+    assert [(b["bucket_start"].day, b["scans"], b["defects"]) for b in days] == [(10, 1, 1), (20, 1, 0), (5, 1, 1)]
+
+def test_image_retention_keeps_files_still_in_use(client, db, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    uploads, cold = tmp_path / "uploads", tmp_path / "cold"
+    uploads.mkdir()
+    old = time.time() - 200 * 86400
+    for name in ("shared.jpg", "aged.jpg", "archived-recent.jpg"):
+        (uploads / name).write_bytes(b"image")
+        os.utime(uploads / name, (old, old))
+    (uploads / "fresh.jpg").write_bytes(b"image")
+
+    now = datetime.utcnow()
+    _add(db, "ret-aged", now - timedelta(days=200), filename="aged.jpg")
+    _add(db, "ret-shared-old", now - timedelta(days=200), filename="shared.jpg")
+    _add(db, "ret-shared-new", now - timedelta(days=1), filename="shared.jpg")
+    _add(db, "ret-archived", now - timedelta(days=40), filename="archived-recent.jpg")
+    db.commit()
+    archive.archive_rows(db, now - timedelta(days=30))
+
+    summary = archive.apply_image_retention(db, days=90, action="move", upload_dir=str(uploads), target_dir=str(cold))
+    assert summary["removed"] == 1
+    assert sorted(os.listdir(uploads)) == ["archived-recent.jpg", "fresh.jpg", "shared.jpg"]
+    assert os.listdir(cold) == ["aged.jpg"]
+
+def test_image_retention_spares_files_reused_during_the_run(db, tmp_path, monkeypatch):
+    from backend.app import uploads as upload_store
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    old = time.time() - 200 * 86400
+    for name in ("dedup.jpg", "linked.jpg", "idle.jpg"):
+        (uploads / name).write_bytes(b"image")
+        os.utime(uploads / name, (old, old))
+
+    # A repeat upload of the same content lands on the existing file and renews its age.
+    tmp_file = uploads / ".repeat.part"
+    upload_store._finalize(open(tmp_file, "wb"), str(tmp_file), str(uploads / "dedup.jpg"))
+    assert not tmp_file.exists()
+
+    # A row that links to an aged file after the first reference check still keeps it.
+    def link_during_run(db_, names, since, archive_dir=None):
+        _add(db, "ret-linked-late", datetime.utcnow(), status="PENDING", filename="linked.jpg")
+        db.commit()
+        return set()
+
+    monkeypatch.setattr(archive, "_referenced_archived", link_during_run)
+    assert archive.apply_image_retention(db, days=90, upload_dir=str(uploads))["removed"] == 1
+    assert sorted(os.listdir(uploads)) == ["dedup.jpg", "linked.jpg"]
+
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_archived_tasks_keep_status_and_previews(mock_celery, client, db, tmp_path, monkeypatch):
+    import cv2
+    import numpy as np
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    # Files indexed by earlier tests live in their own tmp dirs.
+    db.query(PredictionArchive).delete()
+    db.query(ArchivedTask).delete()
+    db.commit()
+    payload = cv2.imencode(".jpg", np.full((300, 400, 3), 120, dtype=np.uint8))[1].tobytes()
+    task_id = client.post("/predict", files={"file": ("arch.jpg", payload, "image/jpeg")}).json()["task_id"]
+    row = db.query(PredictionHistory).filter_by(task_id=task_id).one()
+    row.status, row.created_at = "SUCCESS", datetime(2022, 5, 1)
+    row.result = {"defects": [{"type": "spur", "confidence": 0.9, "bbox": [10, 10, 50, 50]}]}
+    db.commit()
+    archive.archive_rows(db, datetime(2023, 1, 1))
+    db.expire_all()
+    assert db.query(PredictionHistory).filter_by(task_id=task_id).first() is None
+
+    status = client.get(f"/status/{task_id}").json()
+    assert status["status"] == "SUCCESS" and status["result"]["defects"][0]["type"] == "spur"
+    assert client.get(f"/thumbnail/{task_id}").status_code == 200
+    assert client.get(f"/overlay/{task_id}").status_code == 200
+    # Unknown ids are answered from the archived_task index without opening any file.
+    with patch.object(archive, "_read", side_effect=AssertionError("Parquet read for an unknown task")):
+        assert client.get("/status/never-existed").status_code == 404
+        assert client.get("/thumbnail/never-existed").status_code == 404
+
+    # Archives written before the index existed are indexed once by migrate().
+    db.query(ArchivedTask).delete()
+    db.commit()
+    assert archive.index_archived_tasks(db) == 1
+    assert client.get(f"/status/{task_id}").json()["status"] == "SUCCESS"
@@ -0,0 +1,59 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from backend.app.batching import MicroBatcher
+
+def test_batcher_groups_concurrent_submissions():
+    calls = []
+    release = threading.Event()
+
+    def handler(items):
+        calls.append(list(items))
+        release.wait(1)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(handler, max_batch_size=4, max_wait_ms=200)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = list(pool.map(batcher.submit, range(8)))
+        release.set()
+        results = [f.result(timeout=5) for f in futures]
+
+    assert results == [i * 2 for i in range(8)]
+    assert all(len(batch) <= 4 for batch in calls)
+    assert len(calls) < 8
+    stats = batcher.stats()
+    assert stats["images"] == 8
+    assert sum(stats["batch_size_distribution"].values()) == len(calls)
+    assert "p95" in stats["queue_wait_ms"]
+
+def test_batcher_isolates_failing_item():
+    def handler(items):
+        if "bad" in items:
+            raise ValueError("corrupt image")
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(handler, max_batch_size=4, max_wait_ms=100)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = list(pool.map(batcher.submit, ["a", "bad", "c"]))
+
+    assert futures[0].result(timeout=5) == "A"
+    assert futures[2].result(timeout=5) == "C"
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+
+def test_batcher_survives_version_errors_and_short_results():
+    versions = iter([RuntimeError("registry unavailable")])
+
+    def version():
+        error = next(versions, None)
+        if error:
+            raise error
+        return "v1"
+
+    # Drops the last result of any multi-item batch; single items come back intact.
+    batcher = MicroBatcher(lambda items: [item + 1 for item in items][:max(1, len(items) - 1)],
+                           max_batch_size=4, max_wait_ms=100, version=version)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = list(pool.map(batcher.submit, [1, 2, 3]))
+    assert sorted(f.result(timeout=5) for f in futures) == [2, 3, 4]
+    assert batcher.submit(10).result(timeout=5) == 11
@@ -0,0 +1,70 @@
+import json
+import os
+from PIL import Image
+from ml import data_preprocessing as dp
+
+def _sample(source, sample_id, labels=("spike",), image=True):
+    path = source / f"{sample_id}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    shapes = [{"label": label, "points": [[10 + i, 10], [30 + i, 40]]} for i, label in enumerate(labels)]
+    path.write_text(json.dumps({"imagePath": path.stem + ".png", "imageWidth": 100, "imageHeight": 80, "shapes": shapes}))
+    if image:
+        Image.new("RGB", (100, 80), (len(sample_id) * 20 % 255, 0, 0)).save(source / f"{sample_id}.png")
+
+def _run(source, output, capsys):
+    dp.prepare_dataset(str(source), str(output), str(output / "data.yaml"), workers=1)
+    with open(output / dp.MANIFEST_NAME) as f:
+        manifest = json.load(f)
+    return manifest, capsys.readouterr().out
+
+def _outputs(output):
+    return sorted(os.path.relpath(os.path.join(root, name), output)
+                  for root, _, names in os.walk(output) for name in names if root != str(output))
+
+def test_rebuild_processes_only_added_changed_and_deleted_samples(tmp_path, capsys):
+    source, output = tmp_path / "data", tmp_path / "dataset"
+    for sample_id in ("a/img0", "b/img0", "board1", "board2"):
+        _sample(source, sample_id)
+    manifest, out = _run(source, output, capsys)
+    assert "4 to process" in out
+    samples = manifest["samples"]
+    # Same file name in two directories: both are kept, each with its own image.
+    assert samples["a/img0"]["label"].endswith("a__img0.txt") and samples["b/img0"]["label"].endswith("b__img0.txt")
+    assert samples["b/img0"]["image_src"] == str(source / "b" / "img0.png")
+    assert len(_outputs(output)) == 8
+    splits = {sample_id: entry["split"] for sample_id, entry in samples.items()}
+
+    # Rewriting a file with the same content is caught by the hash and not reprocessed.
+    (source / "board1.json").write_text((source / "board1.json").read_text())
+    assert "0 to process" in _run(source, output, capsys)[1]
+
+    _sample(source, "b/img0", labels=("spike", "poor_solder"), image=False)
+    _sample(source, "board3")
+    os.remove(source / "a" / "img0.json")
+    manifest, out = _run(source, output, capsys)
+    assert "2 to process, 1 deleted" in out
+    assert "a/img0" not in manifest["samples"]
+    assert not any("a__img0" in path for path in _outputs(output))
+    b_label = output / manifest["samples"]["b/img0"]["label"]
+    assert [line.split()[0] for line in b_label.read_text().splitlines()] == ["4", "3"]
+    # Splits hash the sample id, so adding samples never moves existing ones.
+    assert all(manifest["samples"][sid]["split"] == split for sid, split in splits.items() if sid in manifest["samples"])
+
+def test_new_labels_append_classes_and_relabel_only_on_reshuffle(tmp_path, capsys):
+    source, output = tmp_path / "data", tmp_path / "dataset"
+    _sample(source, "p1")
+    _sample(source, "p2", labels=("zz_scratch",))
+    manifest, _ = _run(source, output, capsys)
+    assert manifest["classes"] == dp.CLASSES + ["zz_scratch"]
+
+    # A new label sorting after the known ones only touches its own sample.
+    _sample(source, "p3", labels=("zzz_burn",))
+    manifest, out = _run(source, output, capsys)
+    assert "1 to process" in out and manifest["classes"][-1] == "zzz_burn"
+
+    # One sorting before them shifts existing ids, so every label file is rewritten.
+    _sample(source, "p4", labels=("aa_crack",))
+    manifest, out = _run(source, output, capsys)
+    assert "Class ids changed" in out and "4 to process" in out
+    p2_label = output / manifest["samples"]["p2"]["label"]
+    assert p2_label.read_text().split()[0] == str(manifest["classes"].index("zz_scratch"))
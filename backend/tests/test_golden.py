@@ -0,0 +1,89 @@
+from unittest.mock import patch, MagicMock
+import numpy as np
+import cv2
+from backend.app import golden
+from backend.app.services import run_reference_inference
+from backend.tests.test_tiling import _fake_result
+
+JPEG_HEADER = b"\xff\xd8\xff\xe0"
+
+def _canvas():
+    # Textured synthetic board: plenty of corners for ORB.
+    rng = np.random.default_rng(7)
+    canvas = np.full((560, 760, 3), (30, 90, 40), dtype=np.uint8)
+    for _ in range(120):
+        x, y = int(rng.integers(0, 720)), int(rng.integers(0, 520))
+        color = tuple(int(c) for c in rng.integers(60, 255, 3))
+        cv2.rectangle(canvas, (x, y), (x + int(rng.integers(8, 40)), y + int(rng.integers(8, 40))), color, -1)
+    return canvas
+
+def _png(image):
+    return cv2.imencode(".png", image)[1].tobytes()
+
+def test_changed_regions_find_only_the_defect(tmp_path):
+    canvas = _canvas()
+    golden.register_reference("board-a", _png(canvas[20:500, 20:700]), str(tmp_path))
+    reference = golden.load_reference("board-a", str(tmp_path))
+    assert golden.load_reference("board-a", str(tmp_path)) is reference
+
+    shifted = canvas[26:506, 29:709].copy()
+    gray = cv2.cvtColor(shifted, cv2.COLOR_BGR2GRAY)
+    homography, matches = golden.align(gray, reference)
+    assert matches >= golden.MIN_MATCHES
+    assert np.allclose(homography[:2, 2], [-9, -6], atol=1.0)
+    clean = golden.changed_regions(gray, reference, homography)
+
+    cv2.circle(shifted, (300, 200), 12, (255, 255, 255), -1)
+    regions = golden.changed_regions(cv2.cvtColor(shifted, cv2.COLOR_BGR2GRAY), reference, homography)
+    new = [r for r in regions if r not in clean]
+    assert len(new) == 1
+    x0, y0, x1, y1 = new[0]
+    assert x0 < 288 and x1 > 312 and y0 < 188 and y1 > 212
+    # On the clean board only the strips the shifted reference no longer covers are flagged.
+    assert clean and all(r[2] == 680 or r[3] == 480 for r in clean)
+
+@patch("backend.app.services.registry")
+@patch("backend.app.services.acquire_model")
+def test_reference_inference_skips_clean_boards_and_maps_crops(mock_acquire_model, mock_registry, tmp_path, monkeypatch):
+    monkeypatch.setattr(golden, "GOLDEN_DIR", str(tmp_path / "golden"))
+    board = _canvas()[20:500, 20:700]
+    golden.register_reference("board-b", _png(board))
+    model = MagicMock()
+    model.names = {0: "spur"}
+    model.side_effect = lambda crops, **kwargs: [_fake_result([(5, 5, 25, 25, 0.9, 0)]) for _ in crops]
+    mock_acquire_model.return_value = (model, "v1")
+    mock_registry.version.return_value = "v1"
+
+    clean_path = str(tmp_path / "clean.png")
+    cv2.imwrite(clean_path, board)
+    clean = run_reference_inference(clean_path, "board-b")
+    assert clean["defects"] == []
+    assert clean["reference"]["aligned"] and clean["reference"]["crops"] == 0
+    assert clean["reference"]["skipped_fraction"] == 1.0
+    assert model.call_count == 0
+
+    defective = board.copy()
+    cv2.circle(defective, (300, 200), 12, (255, 255, 255), -1)
+    defect_path = str(tmp_path / "defect.png")
+    cv2.imwrite(defect_path, defective)
+    result = run_reference_inference(defect_path, "board-b")
+    assert result["reference"]["regions"] == 1
+    assert 0.8 < result["reference"]["skipped_fraction"] < 1.0
+    crop = model.call_args[0][0][0]
+    assert crop.shape[0] < 480 and crop.shape[1] < 680
+    x0, y0 = result["defects"][0]["bbox"][:2]
+    # The fake box sits 5 px into the crop, which is the defect's region grown to REGION_MIN_SIDE.
+    assert 300 - 80 < x0 < 300 - 12 and 200 - 80 < y0 < 200 - 12
+
+@patch("backend.app.api.routes.predict_defect.delay")
+def test_predict_with_board_type_requires_registered_reference(mock_celery, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(golden, "GOLDEN_DIR", str(tmp_path))
+    files = {"file": ("g.jpg", JPEG_HEADER + b"golden board", "image/jpeg")}
+    assert client.post("/predict?board_type=board-c", files=files).status_code == 400
+
+    registered = client.post("/references/board-c", files={"file": ("ref.png", _png(_canvas()), "image/png")}).json()
+    assert [r["version"] for r in client.get("/references").json()] == [registered["version"]]
+    assert client.post("/predict?board_type=board-c", files=files).status_code == 200
+    options = mock_celery.call_args[0][2]
+    assert options["reference"] == {"board_type": "board-c", "version": registered["version"]}
+    assert client.post("/references/bad%20name", files={"file": ("ref.png", b"x", "image/png")}).status_code == 400
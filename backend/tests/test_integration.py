@@ -1,8 +1,10 @@
 from unittest.mock import patch
 from backend.app.services import update_task_result
 
+JPEG_HEADER = b"\xff\xd8\xff\xe0"
+
 def test_integration_flow(client):
-    file_content = b"fake image content"
+    file_content = JPEG_HEADER + b"fake image content"
     files = {"file": ("integration_test.jpg", file_content, "image/jpeg")}
     
     with patch("backend.app.api.routes.predict_defect.delay") as mock_celery:
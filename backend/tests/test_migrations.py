@@ -0,0 +1,35 @@
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+from backend.app.migrations import migrate
+from backend.app.services import find_cached_prediction
+from backend.app.stats import get_stats
+
+def test_migrate_upgrades_a_first_release_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/legacy.db")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE prediction_history (id INTEGER PRIMARY KEY, task_id VARCHAR UNIQUE, filename VARCHAR, "
+            "original_filename VARCHAR, result JSON, status VARCHAR, created_at DATETIME)"
+        ))
+        conn.execute(text("INSERT INTO prediction_history (task_id, filename, status, created_at) VALUES ('legacy', 'a.jpg', 'SUCCESS', '2023-03-01 09:00:00')"))
+        conn.execute(text(
+            "INSERT INTO prediction_history (task_id, filename, status, created_at, result) VALUES "
+            "('legacy-spur', 'b.jpg', 'SUCCESS', '2023-03-01 10:00:00', "
+            "'{\"defects\": [{\"type\": \"spur\", \"confidence\": 0.9, \"bbox\": [1, 2, 3, 4]}]}')"
+        ))
+
+    applied = migrate(engine)
+    assert "prediction_history.content_hash" in applied and "ix_prediction_history_cache_key" in applied
+    # Existing history is counted in /stats and /defects right after the upgrade.
+    assert "prediction_defect (1 rows)" in applied and "prediction_rollup" in applied
+    assert migrate(engine) == []
+
+    inspector = inspect(engine)
+    assert {"content_hash", "model_version", "batch_id", "defect_count"} <= {c["name"] for c in inspector.get_columns("prediction_history")}
+    assert inspector.has_table("prediction_defect")
+    db = sessionmaker(bind=engine)()
+    assert find_cached_prediction(db, "abc", "v1") is None
+    totals = get_stats(db)
+    assert (totals["scans"], totals["defects"]) == (2, 1)
+    db.close()
+    engine.dispose()
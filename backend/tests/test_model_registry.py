@@ -0,0 +1,131 @@
+from unittest.mock import patch, MagicMock
+import threading
+import time
+import json
+import pytest
+from backend.app.model_registry import ModelRegistry, file_digest
+from backend.app import model_store
+
+@patch("backend.app.model_registry.YOLO")
+def test_registry_caches_and_warms_up(mock_yolo, tmp_path):
+    weights = tmp_path / "best.pt"
+    weights.write_bytes(b"weights-v1")
+    mock_yolo.side_effect = lambda path, **kwargs: MagicMock()
+
+    registry = ModelRegistry(max_size=2)
+    first = registry.get(str(weights))
+    second = registry.get(str(weights))
+
+    assert first is second
+    assert mock_yolo.call_count == 1
+    assert first.call_count == 1
+    stats = registry.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert "load_s" in stats["models"][0]
+
+@patch("backend.app.model_registry.YOLO")
+def test_registry_reloads_changed_file_and_evicts_lru(mock_yolo, tmp_path):
+    mock_yolo.side_effect = lambda path, **kwargs: MagicMock()
+    registry = ModelRegistry(max_size=2)
+
+    paths = []
+    for i in range(3):
+        weights = tmp_path / f"model_{i}.pt"
+        weights.write_bytes(f"weights-{i}".encode())
+        paths.append(str(weights))
+        registry.get(str(weights))
+
+    assert mock_yolo.call_count == 3
+    assert registry.stats()["evictions"] == 1
+    assert registry.stats()["size"] == 2
+
+    with open(paths[2], "wb") as f:
+        f.write(b"weights-2-retrained")
+    registry.get(paths[2])
+    assert mock_yolo.call_count == 4
+
+@patch("backend.app.model_registry.YOLO")
+def test_backend_requires_passing_parity_report(mock_yolo, tmp_path):
+    mock_yolo.side_effect = lambda path, **kwargs: MagicMock()
+    weights = tmp_path / "best.pt"
+    weights.write_bytes(b"weights")
+    (tmp_path / "best.onnx").write_bytes(b"onnx graph")
+
+    registry = ModelRegistry()
+    pytorch_model = registry.get(str(weights), backend="onnxruntime")
+    assert mock_yolo.call_args[0][0] == str(weights)
+
+    # A report written while the process runs is picked up by the same registry.
+    report = {"source_digest": file_digest(str(weights)), "backends": {"onnxruntime": {"passed": True}}}
+    (tmp_path / "best.parity.json").write_text(json.dumps(report))
+    registry.get(str(weights), backend="onnxruntime")
+    assert mock_yolo.call_args[0][0] == str(tmp_path / "best.onnx")
+    assert registry.version(str(weights), backend="onnxruntime").endswith("-onnxruntime")
+
+    # So is one that withdraws the backend after a failed re-check.
+    report["backends"]["onnxruntime"] = {"passed": False, "max_box_diff": 12.5}
+    (tmp_path / "best.parity.json").write_text(json.dumps(report))
+    assert registry.get(str(weights), backend="onnxruntime") is pytorch_model
+    assert not registry.version(str(weights), backend="onnxruntime").endswith("-onnxruntime")
+
+def test_store_promote_and_rollback(tmp_path):
+    store = str(tmp_path / "store")
+    versions = []
+    for i in range(3):
+        weights = tmp_path / f"run_{i}.pt"
+        weights.write_bytes(f"weights-{i}".encode())
+        versions.append(model_store.register_version(str(weights), store))
+        model_store.promote(versions[-1], store)
+
+    assert model_store.current_version(store) == versions[2]
+    assert model_store.rollback(store) == versions[1]
+    assert model_store.rollback(store) == versions[0]
+    assert model_store.active_weights(store) == model_store.weights_path(versions[0], store)
+    with pytest.raises(ValueError):
+        model_store.rollback(store)
+    with pytest.raises(ValueError):
+        model_store.promote("unknown", store)
+
+@patch("backend.app.model_registry.YOLO")
+def test_acquire_serves_old_model_until_new_one_is_warm(mock_yolo, tmp_path):
+    store = str(tmp_path / "store")
+    release = threading.Event()
+
+    def load(path, **kwargs):
+        if "weights-2" in open(path, "rb").read().decode():
+            release.wait(5)
+        return MagicMock(name=path)
+    mock_yolo.side_effect = load
+
+    old_weights, new_weights = tmp_path / "v1.pt", tmp_path / "v2.pt"
+    old_weights.write_bytes(b"weights-1")
+    new_weights.write_bytes(b"weights-2")
+    old_version = model_store.register_version(str(old_weights), store)
+    new_version = model_store.register_version(str(new_weights), store)
+    model_store.promote(old_version, store)
+
+    registry = ModelRegistry(store=store, poll_seconds=0)
+    old_model, version = registry.acquire()
+    assert version == old_version
+
+    model_store.promote(new_version, store)
+    for _ in range(3):
+        assert registry.acquire() == (old_model, old_version)
+    release.set()
+    for _ in range(100):
+        model, version = registry.acquire()
+        if version == new_version:
+            break
+        time.sleep(0.01)
+    assert version == new_version and model is not old_model
+    assert registry.stats()["swaps"] == 1
+
+    model_store.rollback(store)
+    registry.acquire()
+    for _ in range(100):
+        if registry.acquire()[0] is old_model:
+            break
+        time.sleep(0.01)
+    assert registry.acquire() == (old_model, old_version)
+    assert mock_yolo.call_count == 2
@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func
+import threading
+from backend.app.models import PredictionHistory, PredictionDefect, PredictionRollup
+from backend.app.result_writer import ResultWriter
+from backend.app.services import write_task_results, find_cached_prediction, create_task_entry, create_task_entries
+
+def test_bulk_write_updates_linked_rows_and_replays_cleanly(db):
+    db.add_all([
+        PredictionHistory(task_id="rw-a", filename="a.jpg", status="PENDING"),
+        PredictionHistory(task_id="rw-b", filename="b.jpg", status="PENDING"),
+        PredictionHistory(task_id="rw-dup", filename="a.jpg", status="PENDING", source_task_id="rw-a"),
+    ])
+    db.commit()
+    spur = {"defects": [{"type": "spur", "confidence": 0.9, "bbox": [1, 2, 3, 4]}]}
+    items = [
+        ("rw-a", {"defects": []}, "SUCCESS", "v1"),
+        ("rw-a", spur, "SUCCESS", "v1"),
+        ("rw-b", {"error": "corrupt"}, "FAILURE", None),
+    ]
+    published = write_task_results(db, items)
+    db.commit()
+    assert sorted(task_id for task_id, *_ in published) == ["rw-a", "rw-b", "rw-dup"]
+
+    def snapshot():
+        rows = {row.task_id: (row.status, row.defect_count) for row in db.query(PredictionHistory)}
+        defects = db.query(PredictionDefect).count()
+        scans = db.query(func.sum(PredictionRollup.scans)).scalar()
+        return rows, defects, scans
+
+    before = snapshot()
+    assert before[0] == {"rw-a": ("SUCCESS", 1), "rw-b": ("FAILURE", None), "rw-dup": ("SUCCESS", 1)}
+    assert before[1] == 2
+
+    write_task_results(db, items)
+    db.commit()
+    db.expire_all()
+    assert snapshot() == before
+
+def test_writer_coalesces_concurrent_results():
+    calls = []
+    writer = ResultWriter(lambda items: calls.append(list(items)), max_batch_size=8, max_wait_ms=200)
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        futures = list(pool.map(lambda i: writer.submit(f"t{i}", {}, "SUCCESS"), range(16)))
+    for future in futures:
+        future.result(timeout=5)
+    assert sum(len(batch) for batch in calls) == 16
+    assert all(len(batch) <= 8 for batch in calls)
+    assert len(calls) < 16
+    assert writer.stats()["written"] == 16
+    writer.close()
+
+def test_writer_retries_transient_failures_and_flushes_on_close():
+    attempts, written = [], []
+    gate = threading.Event()
+
+    def flush(items):
+        gate.wait(1)
+        attempts.append(len(items))
+        if len(attempts) <= 2:
+            raise ConnectionError("database restarting")
+        written.extend(task_id for task_id, *_ in items)
+
+    writer = ResultWriter(flush, max_batch_size=4, max_wait_ms=50, retries=3, backoff_ms=1)
+    futures = [writer.submit(f"t{i}", {}, "SUCCESS") for i in range(3)]
+    gate.set()
+    writer.close()
+    assert all(f.done() and f.exception() is None for f in futures)
+    assert sorted(written) == ["t0", "t1", "t2"]
+    assert writer.stats()["retried"] == 2
+    assert writer.stats()["failed"] == 0
+
+def test_duplicate_linked_after_source_flush_takes_its_result(db):
+    db.add(PredictionHistory(task_id="race-src", filename="r.jpg", status="PENDING", content_hash="race",
+                             model_version="v1", inference_options=""))
+    db.commit()
+    cached = find_cached_prediction(db, "race", "v1")
+    assert cached.status == "PENDING"
+
+    # The source's result commits between the cache lookup and the linked inserts.
+    spur = {"defects": [{"type": "spur", "confidence": 0.9, "bbox": [1, 2, 3, 4]}]}
+    write_task_results(db, [("race-src", spur, "SUCCESS", "v1")])
+    db.commit()
+
+    linked = create_task_entry(db, "race-dup", "r.jpg", "r.jpg", "race", "v1",
+                               status=cached.status, result=cached.result, source_task_id=cached.task_id)
+    create_task_entries(db, [{"task_id": "race-batch", "filename": "r.jpg", "original_filename": "r.jpg",
+                              "status": "PENDING", "source_task_id": "race-src"}])
+    db.expire_all()
+    rows = {row.task_id: row for row in db.query(PredictionHistory).filter(PredictionHistory.task_id.like("race-%"))}
+    assert linked.status == "SUCCESS"
+    assert {task_id: (row.status, row.defect_count) for task_id, row in rows.items()} == \
+        {"race-src": ("SUCCESS", 1), "race-dup": ("SUCCESS", 1), "race-batch": ("SUCCESS", 1)}
+    assert db.query(PredictionDefect).filter(PredictionDefect.prediction_id.in_([r.id for r in rows.values()])).count() == 3
+
+def test_flush_publishes_all_statuses_once_per_flush(db, monkeypatch):
+    from sqlalchemy.orm import sessionmaker
+    from backend.app import events, services
+    monkeypatch.setattr(services, "SessionLocal", sessionmaker(bind=db.get_bind(), autoflush=False))
+    db.add_all([PredictionHistory(task_id=f"pub-{i}", filename=f"pub-{i}.jpg", status="PENDING") for i in range(3)])
+    db.commit()
+    items = [(f"pub-{i}", {"defects": []}, "SUCCESS", "v1") for i in range(3)]
+
+    class RecordingNotifyBroker(events.PostgresNotifyBroker):
+        calls = []
+
+        def publish_many(self, batch, conn=None):
+            self.calls.append(([event["task_id"] for event in batch], conn))
+
+    monkeypatch.setattr(events, "_broker", RecordingNotifyBroker())
+    assert services.flush_task_results(items) == 3
+    # One statement, issued on the flush's own session rather than a new connection.
+    [(task_ids, conn)] = RecordingNotifyBroker.calls
+    assert sorted(task_ids) == ["pub-0", "pub-1", "pub-2"] and conn is not None
+
+    # In-process listeners are only called after the commit, so they can read the result back.
+    seen = []
+    broker = events.InMemoryBroker()
+    broker.subscribe(lambda event: seen.append(db.query(PredictionHistory.status).filter_by(task_id=event["task_id"]).scalar()))
+    monkeypatch.setattr(events, "_broker", broker)
+    db.query(PredictionHistory).filter(PredictionHistory.task_id.like("pub-%")).update({"status": "PENDING"})
+    db.commit()
+    services.flush_task_results(items)
+    assert seen == ["SUCCESS"] * 3
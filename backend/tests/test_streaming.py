@@ -0,0 +1,72 @@
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+import asyncio
+import numpy as np
+import cv2
+from backend.app import streaming
+from backend.app.batching import MicroBatcher
+from backend.app.models import PredictionHistory, PredictionDefect
+from backend.app.stats import get_stats, rebuild_rollups
+
+def _board(increasing: bool, level: int):
+    ramp = np.linspace(0, 100, 320) if increasing else np.linspace(100, 0, 320)
+    image = np.tile(ramp + level, (240, 1)).astype(np.uint8)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+def _jpeg(image):
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+def _fake_model(images):
+    # Bright boards "have" a spur.
+    return [{"defects": [{"type": "spur", "class_id": 4, "confidence": 0.9, "bbox": [10, 10, 40, 40]}]
+             if image.mean() > 128 else [], "model_version": "stream-test"} for image in images]
+
+def test_dhash_separates_near_duplicates_from_new_boards():
+    board = _board(True, 50)
+    noisy = np.clip(board.astype(int) + np.random.default_rng(0).integers(-3, 4, board.shape), 0, 255).astype(np.uint8)
+    assert streaming.hamming(streaming.dhash(board), streaming.dhash(noisy)) <= streaming.STREAM_DUP_THRESHOLD
+    assert streaming.hamming(streaming.dhash(board), streaming.dhash(_board(False, 50))) > 32
+
+def test_stream_skips_duplicates_and_persists_only_defect_frames(client, monkeypatch):
+    persisted = []
+    monkeypatch.setattr(streaming, "batcher", MicroBatcher(_fake_model, max_wait_ms=1))
+
+    async def persist(data, result, task_id, name, batch_id):
+        persisted.append((task_id, name, batch_id))
+
+    monkeypatch.setattr(streaming, "persist_frame", persist)
+    frames = [_board(True, 20), _board(True, 20), _board(False, 150), _board(False, 151)]
+
+    with client.websocket_connect("/stream") as ws:
+        for frame in frames:
+            ws.send_bytes(_jpeg(frame))
+        ws.send_bytes(b"not a frame")
+        ws.send_text("end")
+        messages = []
+        while not messages or messages[-1]["type"] != "summary":
+            messages.append(ws.receive_json())
+
+    by_frame = {m["frame"]: m for m in messages if "frame" in m}
+    assert by_frame[0]["type"] == "detection" and by_frame[0]["defects"] == []
+    assert by_frame[1] == {"type": "skipped", "frame": 1, "reason": "duplicate"}
+    assert by_frame[2]["defects"][0]["type"] == "spur"
+    assert by_frame[3]["type"] == "skipped"
+    assert by_frame[4]["type"] == "error"
+    summary = messages[-1]
+    assert {k: summary[k] for k in ("received", "inspected", "duplicate", "invalid", "defective", "persisted")} == \
+        {"received": 5, "inspected": 2, "duplicate": 2, "invalid": 1, "defective": 1, "persisted": 1}
+    assert persisted == [(by_frame[2]["task_id"], f"stream-{summary['stream_id']}-000002.jpg", f"stream-{summary['stream_id']}")]
+
+def test_persisted_frame_is_a_finished_prediction(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(streaming, "AsyncSessionLocal", async_sessionmaker(create_async_engine("sqlite+aiosqlite:///./test.db")))
+    result = _fake_model([_board(False, 150)])[0]
+    asyncio.run(streaming.persist_frame(_jpeg(_board(False, 150)), result, "stream-task", "stream-abc-000007.jpg",
+                                        "stream-abc", upload_dir=str(tmp_path)))
+
+    row = db.query(PredictionHistory).filter_by(task_id="stream-task").one()
+    assert (row.status, row.defect_count, row.model_version) == ("SUCCESS", 1, "stream-test")
+    assert db.query(PredictionDefect).filter_by(prediction_id=row.id).count() == 1
+
+    # Only defective frames are stored, so stream rows stay out of /stats, rebuilds included.
+    assert get_stats(db)["scans"] == 0
+    rebuild_rollups(db)
+    assert get_stats(db)["scans"] == 0
@@ -0,0 +1,54 @@
+from unittest.mock import patch, MagicMock
+import numpy as np
+import cv2
+from backend.app import tiling
+from backend.app.services import run_tiled_inference
+
+def test_tile_grid_covers_image_with_overlap():
+    windows = tiling.tile_grid(1000, 1500, tile_size=640, overlap=0.25)
+    covered = np.zeros((1000, 1500), dtype=bool)
+    for x0, y0, x1, y1 in windows:
+        assert x1 - x0 <= 640 and y1 - y0 <= 640
+        covered[y0:y1, x0:x1] = True
+    assert covered.all()
+    assert tiling.tile_grid(300, 300, tile_size=640) == [(0, 0, 300, 300)]
+
+def test_merge_boxes_fuses_same_class_only():
+    boxes = np.array([[10, 10, 50, 50], [12, 12, 52, 52], [10, 10, 50, 50], [200, 200, 240, 240]], dtype=np.float32)
+    scores = np.array([0.9, 0.6, 0.8, 0.7], dtype=np.float32)
+    classes = np.array([0, 0, 1, 0])
+    merged, merged_scores, merged_classes = tiling.merge_boxes(boxes, scores, classes, iou_threshold=0.5)
+    assert len(merged) == 3
+    assert np.allclose(merged_scores, [0.9, 0.8, 0.7])
+    assert merged_classes.tolist() == [0, 1, 0]
+    assert 10 < merged[0][0] < 12
+
+def _fake_result(boxes):
+    r = MagicMock()
+    r.boxes.__len__.return_value = len(boxes)
+    r.boxes.xyxy.cpu.return_value.numpy.return_value = np.array([b[:4] for b in boxes], dtype=np.float32).reshape(-1, 4)
+    r.boxes.conf.cpu.return_value.numpy.return_value = np.array([b[4] for b in boxes], dtype=np.float32)
+    r.boxes.cls.cpu.return_value.numpy.return_value = np.array([b[5] for b in boxes], dtype=np.float32)
+    return r
+
+@patch("backend.app.services.acquire_model")
+def test_tiled_inference_maps_boxes_and_skips_blank_tiles(mock_acquire_model, tmp_path):
+    image = np.zeros((200, 400, 3), dtype=np.uint8)
+    image[:, 200:] = np.random.default_rng(0).integers(0, 255, (200, 200, 3), dtype=np.uint8)
+    path = str(tmp_path / "panel.png")
+    cv2.imwrite(path, image)
+
+    model = MagicMock()
+    model.names = {0: "spike"}
+    model.side_effect = lambda tiles, **kwargs: [_fake_result([(5, 5, 25, 25, 0.9, 0)]) for _ in tiles]
+    mock_acquire_model.return_value = (model, "v1")
+
+    result = run_tiled_inference(path, tile_size=200, tile_overlap=0.0)
+
+    assert result["tiling"]["tiles"] == 2
+    assert result["tiling"]["tiles_skipped"] == 1
+    assert set(result["tiling"]["timings_ms"]) == {"decode_ms", "tiling_ms", "inference_ms", "merge_ms"}
+    assert len(result["defects"]) == 1
+    assert result["defects"][0]["type"] == "spike"
+    assert result["defects"][0]["bbox"] == [205.0, 5.0, 225.0, 25.0]
+    assert result["model_version"] == "v1"
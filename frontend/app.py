@@ -1,7 +1,9 @@
 import streamlit as st
 import requests
+import json
 import time
-from PIL import Image, ImageDraw
+import base64
+from PIL import Image
 import io
 
 BACKEND_URL = "http://backend:8000"
@@ -90,16 +92,58 @@ st.markdown(hide_st_style, unsafe_allow_html=True)
 
 st.title("PCB Defect Detection System")
 
+# Previews are rendered and cached by the API, so only a few kilobytes cross the wire per image.
+# Failed fetches raise so they are retried on the next run instead of being cached.
+@st.cache_data(show_spinner=False, max_entries=1000)
+def _fetch_preview(kind, task_id):
+    res = requests.get(f"{API_URL}/{kind}/{task_id}")
+    res.raise_for_status()
+    return res.content
+
+def fetch_preview(kind, task_id):
+    try:
+        return _fetch_preview(kind, task_id)
+    except Exception:
+        return None
+
+def preview_data_uri(task_id):
+    content = fetch_preview("thumbnail", task_id)
+    return f"data:image/jpeg;base64,{base64.b64encode(content).decode()}" if content else None
+
+# The API sends a keep-alive comment every 15 s on /events, so a longer silence means the stream
+# is stuck; updates then come from polling /status until the task finishes.
+EVENTS_TIMEOUT = (5, float(os.getenv("EVENTS_READ_TIMEOUT", "20")))
+STATUS_POLL_SECONDS = 1.0
+STATUS_POLL_LIMIT_SECONDS = float(os.getenv("STATUS_POLL_LIMIT_SECONDS", "300"))
+FINAL_STATUSES = ("SUCCESS", "FAILURE", "NOT_FOUND")
+
+def task_updates(task_id):
+    try:
+        with requests.get(f"{API_URL}/events", params={"task_id": task_id}, stream=True, timeout=EVENTS_TIMEOUT) as events:
+            for line in events.iter_lines(decode_unicode=True):
+                if line and line.startswith("data: "):
+                    update = json.loads(line[len("data: "):])
+                    yield update
+                    if update["status"] in FINAL_STATUSES:
+                        return
+    except requests.exceptions.RequestException:
+        pass
+    deadline = time.time() + STATUS_POLL_LIMIT_SECONDS
+    while time.time() < deadline:
+        res = requests.get(f"{API_URL}/status/{task_id}", timeout=(5, 10))
+        update = res.json() if res.status_code == 200 else {"task_id": task_id, "status": "NOT_FOUND"}
+        yield update
+        if update["status"] in FINAL_STATUSES:
+            return
+        time.sleep(STATUS_POLL_SECONDS)
+
 # Function to fetch stats
 def get_stats():
     try:
-        res = requests.get(f"{API_URL}/history")
+        res = requests.get(f"{API_URL}/stats")
         if res.status_code == 200:
-            history = res.json()
-            total_scans = len(history)
-            defects_found = sum(1 for item in history if item.get("result") and item["result"].get("defects"))
-            defect_rate = (defects_found / total_scans * 100) if total_scans > 0 else 0
-            return total_scans, defects_found, defect_rate
+            stats = res.json()
+            return stats["scans"], stats["defective_scans"], stats["defect_rate"] * 100
     except:
         pass
     return 0, 0, 0
@@ -129,54 +173,52 @@ if page == "Live Inspection":
         
         with col_data:
             st.subheader("Analysis Control")
+            board_type = st.text_input("Board type (optional golden reference)")
             if st.button("Run Inspection Analysis", type="primary"):
                 with st.spinner('Processing...'):
                     try:
                         files = {"file": uploaded_file.getvalue()}
-                        response = requests.post(f"{API_URL}/predict", files={"file": (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)})
+                        params = {"board_type": board_type} if board_type else {}
+                        response = requests.post(f"{API_URL}/predict", params=params, files={"file": (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)})
                         
                         if response.status_code == 200:
                             data = response.json()
                             task_id = data["task_id"]
                             st.info(f"Task ID: {task_id}")
                             
-                            progress_bar = st.progress(0)
-                            for i in range(100):
-                                time.sleep(0.01)
-                                progress_bar.progress(i + 1)
+                            status_box = st.empty()
+                            status_box.info("Queued")
                             
-                            while True:
-                                res = requests.get(f"{API_URL}/status/{task_id}")
-                                if res.status_code == 200:
-                                    status_data = res.json()
-                                    if status_data["status"] == "SUCCESS":
-                                        result = status_data.get("result", {})
-                                        defects = result.get("defects", [])
-                                        
-                                        if defects:
-                                            st.error(f"{len(defects)} Defects Found")
-                                        else:
-                                            st.success("No Defects Detected")
-                                        
-                                        # Draw bounding boxes
-                                        draw = ImageDraw.Draw(image)
-                                        for d in defects:
-                                            bbox = d["bbox"]
-                                            label = f"{d['type'].upper()} ({d['confidence']:.2f})"
-                                            draw.rectangle(bbox, outline="red", width=4)
-                                            draw.text((bbox[0], bbox[1]-10), label, fill="red")
-                                            
+                            for status_data in task_updates(task_id):
+                                if status_data["status"] == "STARTED":
+                                    status_box.info("Analyzing...")
+                                elif status_data["status"] == "SUCCESS":
+                                    status_box.empty()
+                                    result = status_data.get("result") or {}
+                                    defects = result.get("defects", [])
+                                
+                                    if defects:
+                                        st.error(f"{len(defects)} Defects Found")
+                                    else:
+                                        st.success("No Defects Detected")
+                                
+                                    overlay = fetch_preview("overlay", task_id)
+                                    if overlay:
                                         with col_img:
-                                            st.image(image, caption='Analyzed Result', use_column_width=True)
-                                        
-                                        st.subheader("Defect Report")
-                                        for d in defects:
-                                            st.markdown(f"**Type:** `{d['type']}` | **Conf:** `{d['confidence']:.2f}`")
-                                        break
-                                    elif status_data["status"] == "FAILURE":
-                                        st.error("System Error: Analysis Failed")
-                                        break
-                                time.sleep(1)
+                                            st.image(overlay, caption='Analyzed Result', use_column_width=True)
+                                
+                                    st.subheader("Defect Report")
+                                    for d in defects:
+                                        st.markdown(f"**Type:** `{d['type']}` | **Conf:** `{d['confidence']:.2f}`")
+                                    break
+                                elif status_data["status"] in ("FAILURE", "NOT_FOUND"):
+                                    status_box.empty()
+                                    st.error("System Error: Analysis Failed")
+                                    break
+                            else:
+                                status_box.warning(f"Still processing; check Analysis History for task {task_id} later")
+                        elif response.status_code == 429:
+                            st.warning(f"Inspection queue is busy, try again in {response.headers.get('Retry-After', '?')}s")
                         else:
                             st.error(f"API Error: {response.status_code}")
                     except Exception as e:
@@ -186,16 +228,12 @@ elif page == "Historical Data":
     st.header("Analysis History")
     if st.button("Refresh Data"):
         try:
-            res = requests.get(f"{API_URL}/history")
+            res = requests.get(f"{API_URL}/history", params={"fields": "summary", "limit": 100})
             if res.status_code == 200:
                 history = res.json()
                 processed_data = []
                 for item in history:
-                    defect_types = []
-                    result = item.get("result")
-                    if result and "defects" in result:
-                        for defect in result["defects"]:
-                            defect_types.append(defect.get("type", "unknown"))
+                    defect_types = [t for t in (item.get("defect_types") or "").split(",") if t]
                     
                     try:
                         from datetime import datetime
@@ -205,13 +243,17 @@ elif page == "Historical Data":
                         formatted_date = item["created_at"]
 
                     processed_data.append({
+                        "Preview": preview_data_uri(item["task_id"]),
                         "Filename": item.get("original_filename", item["filename"]),
                         "Defect Types": ", ".join(defect_types) if defect_types else "None",
                         "Status": item["status"],
                         "Created At": formatted_date
                     })
                 
-                st.dataframe(processed_data, use_container_width=True)
+                st.dataframe(
+                    processed_data, use_container_width=True,
+                    column_config={"Preview": st.column_config.ImageColumn("Preview")},
+                )
             else:
                 st.error("Failed to retrieve history logs")
         except Exception as e:
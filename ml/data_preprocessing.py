@@ -1,139 +1,356 @@
-import cv2
 import os
+import io
 import json
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+import argparse
+import hashlib
 import shutil
-import random
 import yaml
 
 DATA_SOURCE = '/app/ml/data'
 BASE_OUTPUT = '/app/ml/dataset'
+DATA_YAML = '/app/ml/data.yaml'
 IMAGES_DIR = os.path.join(BASE_OUTPUT, 'images')
 LABELS_DIR = os.path.join(BASE_OUTPUT, 'labels')
+CLASSES = ['exc_solder', 'good', 'no_good', 'poor_solder', 'spike']
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 32
+VAL_FRACTION = 0.2
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 2
 
-for split in ['train', 'val']:
-    os.makedirs(os.path.join(IMAGES_DIR, split), exist_ok=True)
-    os.makedirs(os.path.join(LABELS_DIR, split), exist_ok=True)
+# EXIF orientations that rotate the image by 90 degrees; cv2.imread and LabelMe both apply them.
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+FICLONE = 0x40049409
 
 def find_images(root_dir):
+    # Keyed by path without extension, so an annotation finds the image next to it even when
+    # another directory holds one with the same name, and by bare stem for annotations kept
+    # apart from their images.
     image_map = {}
     print(f"Scanning for images in {root_dir}...")
     exts = {'.jpg', '.jpeg', '.png', '.bmp'}
+    found = 0
     for path in Path(root_dir).rglob('*'):
         if path.suffix.lower() in exts:
+            image_map[str(path.with_suffix(''))] = str(path)
             image_map[path.stem] = str(path)
-    print(f"Found {len(image_map)} images.")
+            found += 1
+    print(f"Found {found} images.")
     return image_map
 
-def json_to_yolo(json_path, classes, image_map):
+def lookup_image(json_path, image_map):
+    path = Path(json_path)
+    return image_map.get(str(path.with_suffix(''))) or image_map.get(path.stem)
+
+def output_stem(sample_id):
+    # Outputs are named by sample id (its path under the source), so a/img0 and b/img0 never collide.
+    return sample_id.replace('/', '__')
+
+def image_size(image_path):
+    # Only the file header is parsed; no pixel data is decoded.
+    with Image.open(image_path) as img:
+        width, height = img.size
+        try:
+            orientation = img.getexif().get(0x0112)
+        except Exception:
+            orientation = None
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return width, height
+
+def shapes_to_yolo(shapes, class_index, width, height):
+    if not shapes:
+        return np.zeros((0, 5), dtype=np.float64)
+    points = [np.asarray(shape['points'], dtype=np.float64).reshape(-1, 2) for shape in shapes]
+    starts = np.cumsum([0] + [len(p) for p in points[:-1]])
+    flat = np.concatenate(points)
+    mins = np.minimum.reduceat(flat, starts)
+    maxs = np.maximum.reduceat(flat, starts)
+    scale = np.array([width, height], dtype=np.float64)
+    centers = np.clip((mins + maxs) / 2 / scale, 0, 1)
+    sizes = np.clip((maxs - mins) / scale, 0, 1)
+    class_ids = np.array([class_index[shape['label']] for shape in shapes], dtype=np.float64)
+    return np.column_stack([class_ids, centers, sizes])
+
+def format_labels(boxes):
+    buf = io.StringIO()
+    np.savetxt(buf, boxes, fmt=['%d', '%.6f', '%.6f', '%.6f', '%.6f'])
+    return buf.getvalue()
+
+def resolve_image(json_path, data, image_map):
+    image_path = lookup_image(json_path, image_map)
+    if image_path:
+        return image_path
+    potential_path = os.path.join(os.path.dirname(json_path), data.get('imagePath', ''))
+    if os.path.isfile(potential_path):
+        return potential_path
+    return None
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def split_for(sample_id, val_fraction=VAL_FRACTION):
+    # Hash of the sample id, not a shuffle: a sample never changes split as the dataset grows.
+    bucket = int(hashlib.sha1(sample_id.encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return 'val' if bucket < val_fraction else 'train'
+
+def json_to_yolo(json_path, class_index, image_map):
     with open(json_path, 'r') as f:
         data = json.load(f)
-    
-    base_name = os.path.splitext(os.path.basename(json_path))[0]
-    
-    if base_name in image_map:
-        image_path = image_map[base_name]
-    else:
-        image_name_in_json = data.get('imagePath', '')
-        potential_path = os.path.join(os.path.dirname(json_path), image_name_in_json)
-        if os.path.exists(potential_path):
-             image_path = potential_path
-        else:
-            print(f"Image not found for {json_path} (basename: {base_name})")
-            return None, None
 
-    img = cv2.imread(image_path)
-    if img is None:
-        print(f"Could not read image {image_path}")
+    image_path = resolve_image(json_path, data, image_map)
+    if image_path is None:
+        print(f"Image not found for {json_path}")
         return None, None
-        
-    height, width, _ = img.shape
-    
-    yolo_lines = []
-    
-    for shape in data['shapes']:
-        label = shape['label']
-        if label not in classes:
-            classes.append(label)
-        
-        class_id = classes.index(label)
-        points = np.array(shape['points'])
-        
-        x_min = np.min(points[:, 0])
-        x_max = np.max(points[:, 0])
-        y_min = np.min(points[:, 1])
-        y_max = np.max(points[:, 1])
-        
-        x_center = (x_min + x_max) / 2 / width
-        y_center = (y_min + y_max) / 2 / height
-        w = (x_max - x_min) / width
-        h = (y_max - y_min) / height
-        
-        x_center = max(0, min(1, x_center))
-        y_center = max(0, min(1, y_center))
-        w = max(0, min(1, w))
-        h = max(0, min(1, h))
-        
-        yolo_lines.append(f"{class_id} {x_center} {y_center} {w} {h}")
-        
-    return image_path, yolo_lines
-
-def prepare_dataset():
-    classes = ['exc_solder', 'good', 'no_good', 'poor_solder', 'spike']
-    json_files = list(Path(DATA_SOURCE).rglob('*.json'))
-    
+
+    width, height = data.get('imageWidth'), data.get('imageHeight')
+    if not width or not height:
+        try:
+            width, height = image_size(image_path)
+        except Exception as e:
+            print(f"Could not read image {image_path}: {e}")
+            return None, None
+
+    return image_path, shapes_to_yolo(data.get('shapes', []), class_index, width, height)
+
+def link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return 'reflink'
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+_worker_state = {}
+
+def _init_worker(class_index, image_map, output):
+    _worker_state.update(class_index=class_index, image_map=image_map, output=output)
+
+def fingerprint(item):
+    sample_id, json_path = item
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+    image_src = resolve_image(json_path, data, _worker_state['image_map'])
+    return sample_id, {
+        'json_stat': file_stat(json_path),
+        'json_sha256': file_sha256(json_path),
+        'image_src': image_src,
+        'image_stat': file_stat(image_src) if image_src else None,
+        'image_sha256': file_sha256(image_src) if image_src else None,
+        'labels': sorted({shape['label'] for shape in data.get('shapes', [])}),
+    }
+
+def process_sample(item):
+    sample_id, json_file, split = item
+    image_src, boxes = json_to_yolo(json_file, _worker_state['class_index'], _worker_state['image_map'])
+    if image_src is None:
+        return sample_id, None, None
+    stem = output_stem(sample_id)
+    image_rel = os.path.join('images', split, stem + os.path.splitext(image_src)[1])
+    label_rel = os.path.join('labels', split, stem + '.txt')
+    method = link_or_copy(image_src, os.path.join(_worker_state['output'], image_rel))
+    with open(os.path.join(_worker_state['output'], label_rel), 'w') as f:
+        f.write(format_labels(boxes))
+    return sample_id, {'split': split, 'image': image_rel, 'label': label_rel}, method
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def remove_outputs(entry, output):
+    for key in ('image', 'label'):
+        if entry.get(key):
+            try:
+                os.remove(os.path.join(output, entry[key]))
+            except FileNotFoundError:
+                pass
+
+def outputs_exist(entry, output):
+    return all(entry.get(key) and os.path.exists(os.path.join(output, entry[key])) for key in ('image', 'label'))
+
+def is_unchanged(entry, json_path, image_path, split, output):
+    # Cheap stat comparison; anything that fails it is re-hashed before being reprocessed.
+    if not entry or entry.get('split') != split or not outputs_exist(entry, output):
+        return False
+    try:
+        return (entry['json_stat'] == file_stat(json_path) and image_path is not None
+                and entry['image_src'] == image_path and entry['image_stat'] == file_stat(image_path))
+    except OSError:
+        return False
+
+def write_data_yaml(path, content):
+    if os.path.exists(path):
+        with open(path) as f:
+            if yaml.safe_load(f) == content:
+                return False
+    with open(path, 'w') as f:
+        yaml.dump(content, f)
+    return True
+
+def _map(fn, items, workers, initializer=None, initargs=()):
+    if workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        return map(fn, items)
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    try:
+        return list(pool.map(fn, items, chunksize=CHUNKSIZE))
+    finally:
+        pool.shutdown()
+
+def prepare_dataset(source=DATA_SOURCE, output=BASE_OUTPUT, data_yaml=DATA_YAML, workers=WORKERS,
+                    val_fraction=VAL_FRACTION, full=False, shards=False, imgsz=640):
+    for split in ['train', 'val']:
+        os.makedirs(os.path.join(output, 'images', split), exist_ok=True)
+        os.makedirs(os.path.join(output, 'labels', split), exist_ok=True)
+
+    json_files = sorted(Path(source).rglob('*.json'))
+
     if not json_files:
-        print(f"No JSON files found in {DATA_SOURCE}")
+        print(f"No JSON files found in {source}")
         return
-        
-    image_map = find_images(DATA_SOURCE)
-
-    random.shuffle(json_files)
-    split_idx = int(len(json_files) * 0.8)
-    train_files = json_files[:split_idx]
-    val_files = json_files[split_idx:]
-    
-    print(f"Found {len(json_files)} JSON files. Split: {len(train_files)} train, {len(val_files)} val")
-    
-    def process_files(files, split):
-        count = 0
-        for json_file in files:
-            image_src, yolo_lines = json_to_yolo(str(json_file), classes, image_map)
-            
-            if image_src:
-                base_name = os.path.splitext(os.path.basename(json_file))[0]
-                
-                image_dst = os.path.join(IMAGES_DIR, split, os.path.basename(image_src))
-                shutil.copy(image_src, image_dst)
-                
-                label_dst = os.path.join(LABELS_DIR, split, base_name + '.txt')
-                with open(label_dst, 'w') as f:
-                    f.write('\n'.join(yolo_lines))
-                count += 1
-        print(f"Processed {count} files for {split}")
-
-    print("Processing training set...")
-    process_files(train_files, 'train')
-    print("Processing validation set...")
-    process_files(val_files, 'val')
-    
+
+    manifest_path = os.path.join(output, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    if full or manifest.get('version') != MANIFEST_VERSION:
+        # A rebuild starts by removing what the old manifest wrote, so outputs named under an
+        # earlier layout never linger next to the new ones.
+        for entry in manifest.get('samples', {}).values():
+            remove_outputs(entry, output)
+        manifest = {}
+    previous = manifest.get('samples', {})
+    image_map = find_images(source)
+
+    samples = {Path(p).relative_to(source).with_suffix('').as_posix(): str(p) for p in json_files}
+    splits = {sample_id: split_for(sample_id, val_fraction) for sample_id in samples}
+    stale = [
+        (sample_id, json_path) for sample_id, json_path in samples.items()
+        if not is_unchanged(previous.get(sample_id), json_path,
+                            lookup_image(json_path, image_map) or previous.get(sample_id, {}).get('image_src'),
+                            splits[sample_id], output)
+    ]
+    fingerprints = dict(_map(fingerprint, stale, workers, _init_worker, ({}, image_map, output)))
+
+    entries = {sample_id: dict(previous[sample_id]) for sample_id in samples if sample_id in previous}
+    changed = []
+    for sample_id, fp in fingerprints.items():
+        old = entries.get(sample_id, {})
+        same_content = (old.get('json_sha256') == fp['json_sha256'] and old.get('image_sha256') == fp['image_sha256']
+                        and old.get('split') == splits[sample_id] and outputs_exist(old, output))
+        entries[sample_id] = {**old, **fp}
+        if not same_content:
+            changed.append(sample_id)
+
+    # Known classes keep their ids and new labels are appended sorted; only a reshuffle of
+    # existing ids forces every label file to be rewritten.
+    labels = set().union(*(entry.get('labels', []) for entry in entries.values()))
+    classes = list(CLASSES) + sorted(labels - set(CLASSES))
+    old_classes = manifest.get('classes', [])
+    if classes[:len(old_classes)] != old_classes:
+        print("Class ids changed, relabelling every sample")
+        changed = list(samples)
+    class_index = {name: i for i, name in enumerate(classes)}
+
+    deleted = [sample_id for sample_id in previous if sample_id not in samples]
+    for sample_id in deleted:
+        remove_outputs(previous[sample_id], output)
+    for sample_id in changed:
+        if sample_id in previous:
+            remove_outputs(previous[sample_id], output)
+
+    print(f"Found {len(json_files)} JSON files: {len(changed)} to process, {len(deleted)} deleted, "
+          f"{len(samples) - len(changed)} unchanged")
+    if changed:
+        print(f"Processing with {workers} worker(s)...")
+
+    items = [(sample_id, samples[sample_id], splits[sample_id]) for sample_id in sorted(changed)]
+    methods = {}
+    for sample_id, outputs, method in _map(process_sample, items, workers, _init_worker,
+                                           (class_index, image_map, output)):
+        if outputs is None:
+            entries.pop(sample_id, None)
+            continue
+        entries[sample_id].update(outputs)
+        methods[method] = methods.get(method, 0) + 1
+    if methods:
+        print(f"Images placed by: {methods}")
+
+    counts = {'train': 0, 'val': 0}
+    for entry in entries.values():
+        counts[entry['split']] += 1
+    print(f"Split: {counts['train']} train, {counts['val']} val")
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'source': str(source),
+        'val_fraction': val_fraction,
+        'classes': classes,
+        'samples': entries,
+    }
+    save_manifest(manifest_path, manifest)
+
     yaml_content = {
-        'path': BASE_OUTPUT,
+        'path': output,
         'train': 'images/train',
         'val': 'images/val',
         'names': {i: name for i, name in enumerate(classes)}
     }
-    
-    with open('/app/ml/data.yaml', 'w') as f:
-        yaml.dump(yaml_content, f)
-        
+    if shards:
+        from shards import SHARDS_NAME, write_shards
+        write_shards(output, manifest, imgsz, workers=workers)
+        yaml_content['shards'] = SHARDS_NAME
+
+    if write_data_yaml(data_yaml, yaml_content):
+        print(f"Data YAML saved to {data_yaml}")
+    else:
+        print(f"Data YAML unchanged at {data_yaml}")
+
     print("Dataset preparation complete.")
     print(f"Classes: {classes}")
-    print(f"Data YAML saved to /app/ml/data.yaml")
 
 if __name__ == "__main__":
-    if not os.path.exists(DATA_SOURCE):
-        print(f"Data source {DATA_SOURCE} does not exist. Please mount your dataset there.")
+    parser = argparse.ArgumentParser(description="Convert LabelMe annotations to a YOLO dataset")
+    parser.add_argument('--source', default=DATA_SOURCE)
+    parser.add_argument('--output', default=BASE_OUTPUT)
+    parser.add_argument('--data-yaml', default=DATA_YAML)
+    parser.add_argument('--workers', type=int, default=WORKERS, help="1 runs serially in-process")
+    parser.add_argument('--val-fraction', type=float, default=VAL_FRACTION)
+    parser.add_argument('--full', action='store_true', help="ignore the manifest and rebuild everything")
+    parser.add_argument('--shards', action='store_true', help="also write letterboxed, memory-mapped training shards")
+    parser.add_argument('--imgsz', type=int, default=640, help="shard image size")
+    args = parser.parse_args()
+    if not os.path.exists(args.source):
+        print(f"Data source {args.source} does not exist. Please mount your dataset there.")
     else:
-        prepare_dataset()
+        prepare_dataset(args.source, args.output, args.data_yaml, args.workers, args.val_fraction, args.full,
+                        args.shards, args.imgsz)
@@ -1,4 +1,5 @@
 from ultralytics import YOLO
+from sharded_dataset import ShardedDetectionValidator
 import os
 
 def evaluate_model():
@@ -9,7 +10,7 @@ def evaluate_model():
 
     model = YOLO(model_path)
 
-    metrics = model.val(data='/app/ml/data.yaml')
+    metrics = model.val(data='/app/ml/data.yaml', validator=ShardedDetectionValidator)
     
     print(f"mAP50: {metrics.box.map50}")
     print(f"mAP50-95: {metrics.box.map}")
@@ -0,0 +1,82 @@
+from ultralytics import YOLO
+from pathlib import Path
+import numpy as np
+import cv2
+import os
+
+MODEL_PATH = '/app/ml/yolov8_model/best.pt'
+DATA_YAML = '/app/ml/data.yaml'
+CALIBRATION_DIR = '/app/ml/dataset/images/train'
+IMGSZ = 640
+CALIBRATION_IMAGES = 64
+
+def letterbox(image, imgsz=IMGSZ):
+    h, w = image.shape[:2]
+    scale = min(imgsz / h, imgsz / w)
+    resized = cv2.resize(image, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    top = (imgsz - resized.shape[0]) // 2
+    left = (imgsz - resized.shape[1]) // 2
+    canvas[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return canvas
+
+def calibration_batches(images_dir=CALIBRATION_DIR, imgsz=IMGSZ, limit=CALIBRATION_IMAGES):
+    exts = {'.jpg', '.jpeg', '.png', '.bmp'}
+    paths = sorted(p for p in Path(images_dir).rglob('*') if p.suffix.lower() in exts)[:limit]
+    for path in paths:
+        image = cv2.imread(str(path))
+        if image is None:
+            continue
+        # Same preprocessing Ultralytics applies before an ONNX forward pass: letterbox, BGR->RGB, CHW, 0-1.
+        tensor = letterbox(image, imgsz)[:, :, ::-1].transpose(2, 0, 1)
+        yield np.ascontiguousarray(tensor, dtype=np.float32)[None] / 255.0
+
+def quantize_onnx(onnx_path, output_path, mode='static', images_dir=CALIBRATION_DIR, imgsz=IMGSZ):
+    from onnxruntime.quantization import quantize_dynamic, quantize_static, CalibrationDataReader, QuantFormat, QuantType
+    import onnx
+
+    if mode == 'static' and os.path.isdir(images_dir):
+        input_name = onnx.load(onnx_path).graph.input[0].name
+
+        class Reader(CalibrationDataReader):
+            def __init__(self):
+                self.batches = iter({input_name: batch} for batch in calibration_batches(images_dir, imgsz))
+
+            def get_next(self):
+                return next(self.batches, None)
+
+        quantize_static(onnx_path, output_path, Reader(), quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True)
+    else:
+        if mode == 'static':
+            print(f"No calibration images in {images_dir}, falling back to dynamic quantization")
+        quantize_dynamic(onnx_path, output_path, weight_type=QuantType.QUInt8)
+    return output_path
+
+def export_all(weights_path=MODEL_PATH, data=DATA_YAML, imgsz=IMGSZ, int8_mode='static'):
+    model = YOLO(weights_path)
+    stem = os.path.splitext(weights_path)[0]
+    exports = {
+        'torchscript': dict(format='torchscript'),
+        'onnxruntime': dict(format='onnx', dynamic=True, simplify=True),
+        'openvino': dict(format='openvino', dynamic=True),
+        'openvino-int8': dict(format='openvino', dynamic=True, int8=True, data=data),
+    }
+    outputs = {}
+    for backend, kwargs in exports.items():
+        try:
+            outputs[backend] = model.export(imgsz=imgsz, **kwargs)
+            print(f"Exported {backend}: {outputs[backend]}")
+        except Exception as e:
+            print(f"Export to {backend} failed: {e}")
+
+    if 'onnxruntime' in outputs:
+        try:
+            outputs['onnx-int8'] = quantize_onnx(outputs['onnxruntime'], f"{stem}.int8.onnx", int8_mode, imgsz=imgsz)
+            print(f"Exported onnx-int8 ({int8_mode}): {outputs['onnx-int8']}")
+        except Exception as e:
+            print(f"INT8 quantization of ONNX model failed: {e}")
+    return outputs
+
+if __name__ == '__main__':
+    export_all()
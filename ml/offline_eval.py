@@ -0,0 +1,373 @@
+from pathlib import Path
+import numpy as np
+import argparse
+import json
+import os
+from data_preprocessing import image_size
+
+MODEL_PATH = '/app/ml/yolov8_model/best.pt'
+DATA_YAML = '/app/ml/data.yaml'
+IMAGES_DIR = '/app/ml/dataset/images/val'
+LABELS_DIR = '/app/ml/dataset/labels/val'
+CACHE_DIR = '/app/ml/eval_cache'
+IMGSZ = 640
+# Raw detections are cached at Ultralytics' validation settings so any higher threshold can be replayed.
+CACHE_CONF = 0.001
+CACHE_NMS_IOU = 0.7
+MAX_DET = 300
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+PR_POINTS = 101
+CHUNK = 64
+
+def model_version(weights_path):
+    # Same id the API stores in PredictionHistory.model_version for PyTorch weights.
+    from backend.app.model_registry import file_digest
+    return file_digest(weights_path)[:12]
+
+def list_images(images_dir):
+    exts = {'.jpg', '.jpeg', '.png', '.bmp'}
+    return sorted(str(p.relative_to(images_dir)) for p in Path(images_dir).rglob('*') if p.suffix.lower() in exts)
+
+def empty_detections():
+    return {
+        'det_image': np.zeros(0, dtype=np.int32),
+        'det_xyxy': np.zeros((0, 4), dtype=np.float32),
+        'det_conf': np.zeros(0, dtype=np.float32),
+        'det_cls': np.zeros(0, dtype=np.int16),
+    }
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as f:
+        cache = {k: f[k] for k in f.files}
+    cache['meta'] = json.loads(str(cache['meta']))
+    return cache
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    arrays = {k: v for k, v in cache.items() if k != 'meta'}
+    np.savez(tmp_path, meta=json.dumps(cache['meta']), **arrays)
+    os.replace(tmp_path, path)
+
+def cache_detections(weights_path=MODEL_PATH, images_dir=IMAGES_DIR, cache_dir=CACHE_DIR, imgsz=IMGSZ):
+    from ultralytics import YOLO
+
+    version = model_version(weights_path)
+    path = os.path.join(cache_dir, f"{version}-{imgsz}.npz")
+    images = list_images(images_dir)
+    cache = load_cache(path) or {
+        'meta': {'model_version': version, 'imgsz': imgsz, 'conf': CACHE_CONF, 'nms_iou': CACHE_NMS_IOU, 'max_det': MAX_DET},
+        'images': np.zeros(0, dtype=str),
+        'shapes': np.zeros((0, 2), dtype=np.int32),
+        **empty_detections(),
+    }
+    known = set(cache['images'].tolist())
+    missing = [name for name in images if name not in known]
+    if not missing:
+        print(f"Detections for {version} cached in {path} ({len(images)} images)")
+        return path, cache
+
+    print(f"Running {version} on {len(missing)} uncached images...")
+    model = YOLO(weights_path)
+    cache['meta']['names'] = {int(k): v for k, v in model.names.items()}
+    offset = len(cache['images'])
+    names, shapes, parts = [], [], [cache]
+    for start in range(0, len(missing), CHUNK):
+        chunk = missing[start:start + CHUNK]
+        results = model([os.path.join(images_dir, name) for name in chunk], imgsz=imgsz, conf=CACHE_CONF,
+                        iou=CACHE_NMS_IOU, max_det=MAX_DET, verbose=False)
+        for name, r in zip(chunk, results):
+            boxes = r.boxes
+            parts.append({
+                'det_image': np.full(len(boxes), offset + len(names), dtype=np.int32),
+                'det_xyxy': boxes.xyxy.cpu().numpy().astype(np.float32),
+                'det_conf': boxes.conf.cpu().numpy().astype(np.float32),
+                'det_cls': boxes.cls.cpu().numpy().astype(np.int16),
+            })
+            names.append(name)
+            shapes.append(r.orig_shape)
+    for key in empty_detections():
+        cache[key] = np.concatenate([p[key] for p in parts])
+    cache['images'] = np.concatenate([cache['images'], np.array(names)])
+    cache['shapes'] = np.concatenate([cache['shapes'], np.array(shapes, dtype=np.int32).reshape(-1, 2)])
+    save_cache(path, cache)
+    print(f"Cached {len(cache['det_conf'])} detections for {len(cache['images'])} images in {path}")
+    return path, cache
+
+def load_ground_truth(image_names, shapes, labels_dir=LABELS_DIR):
+    gt_image, gt_xyxy, gt_cls = [], [], []
+    for i, (name, (height, width)) in enumerate(zip(image_names, shapes)):
+        label_path = os.path.join(labels_dir, os.path.splitext(name)[0] + '.txt')
+        if not os.path.exists(label_path) or not os.path.getsize(label_path):
+            continue
+        labels = np.loadtxt(label_path, dtype=np.float32, ndmin=2).reshape(-1, 5)
+        xy, wh = labels[:, 1:3] * (width, height), labels[:, 3:5] * (width, height)
+        gt_xyxy.append(np.concatenate([xy - wh / 2, xy + wh / 2], axis=1))
+        gt_cls.append(labels[:, 0].astype(np.int16))
+        gt_image.append(np.full(len(labels), i, dtype=np.int32))
+    if not gt_image:
+        return np.zeros(0, np.int32), np.zeros((0, 4), np.float32), np.zeros(0, np.int16)
+    return np.concatenate(gt_image), np.concatenate(gt_xyxy), np.concatenate(gt_cls)
+
+def candidate_pairs(det_image, gt_image, n_images):
+    # Every (detection, ground truth) pair that shares an image, without a Python loop over images.
+    order = np.argsort(gt_image, kind='stable')
+    counts = np.bincount(gt_image, minlength=n_images)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    per_det = counts[det_image]
+    det_idx = np.repeat(np.arange(len(det_image)), per_det)
+    within = np.arange(per_det.sum()) - np.repeat(np.cumsum(per_det) - per_det, per_det)
+    gt_idx = order[np.repeat(starts[det_image], per_det) + within]
+    return det_idx, gt_idx
+
+def pair_iou(a, b):
+    lt = np.maximum(a[:, :2], b[:, :2])
+    rb = np.minimum(a[:, 2:], b[:, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=1)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+def greedy_match(det_idx, gt_idx, iou, threshold):
+    # Highest-IoU pairs first, each detection and each ground truth used at most once (Ultralytics' matching).
+    keep = iou >= threshold
+    d, g, v = det_idx[keep], gt_idx[keep], iou[keep]
+    order = np.argsort(-v, kind='stable')
+    d, g = d[order], g[order]
+    first = np.sort(np.unique(d, return_index=True)[1])
+    d, g = d[first], g[first]
+    first = np.sort(np.unique(g, return_index=True)[1])
+    return d[first], g[first]
+
+def compute_ap(recall, precision):
+    # Precision drops to zero past the highest recall reached, so unreached recall earns no area.
+    mrec = np.concatenate(([0.0], recall, [recall[-1] if len(recall) else 1.0], [1.0]))
+    mpre = np.concatenate(([1.0], precision, [0.0], [0.0]))
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))
+    x = np.linspace(0, 1, PR_POINTS)
+    trapz = getattr(np, 'trapezoid', None) or np.trapz
+    return float(trapz(np.interp(x, mrec, mpre), x)), np.interp(x, mrec, mpre)
+
+def apply_class_map(cls, names, class_map):
+    # class_map renames (and so merges) classes, e.g. {"poor_solder": "no_good"}; unmapped names keep theirs.
+    eval_names = sorted({class_map.get(n, n) for n in names.values()})
+    lookup = np.full(max(names) + 1, -1, dtype=np.int16)
+    for i, n in names.items():
+        lookup[i] = eval_names.index(class_map.get(n, n))
+    return lookup[cls], {i: n for i, n in enumerate(eval_names)}
+
+def score(det_image, det_xyxy, det_conf, det_cls, gt_image, gt_xyxy, gt_cls, n_images, names,
+          conf=0.25, iou=0.5, class_map=None):
+    if class_map:
+        det_cls, eval_names = apply_class_map(det_cls, names, class_map)
+        gt_cls, _ = apply_class_map(gt_cls, names, class_map)
+        names = eval_names
+    nc = len(names)
+    keep = det_conf >= conf
+    det_image, det_xyxy, det_conf, det_cls = det_image[keep], det_xyxy[keep], det_conf[keep], det_cls[keep]
+
+    det_idx, gt_idx = candidate_pairs(det_image, gt_image, n_images)
+    ious = pair_iou(det_xyxy[det_idx], gt_xyxy[gt_idx])
+    same_class = det_cls[det_idx] == gt_cls[gt_idx]
+    tp = np.zeros((len(det_conf), len(IOU_THRESHOLDS)), dtype=bool)
+    for j, threshold in enumerate(IOU_THRESHOLDS):
+        d, _ = greedy_match(det_idx[same_class], gt_idx[same_class], ious[same_class], threshold)
+        tp[d, j] = True
+    d, _ = greedy_match(det_idx[same_class], gt_idx[same_class], ious[same_class], iou)
+    tp_at_iou = np.zeros(len(det_conf), dtype=bool)
+    tp_at_iou[d] = True
+
+    order = np.argsort(-det_conf, kind='stable')
+    tp_sorted, cls_sorted = tp[order], det_cls[order]
+    n_gt = np.bincount(gt_cls, minlength=nc)
+    n_pred = np.bincount(det_cls, minlength=nc)
+    n_tp = np.bincount(det_cls[tp_at_iou], minlength=nc)
+    ap = np.zeros((nc, len(IOU_THRESHOLDS)))
+    pr_curves = np.zeros((nc, PR_POINTS))
+    for c in range(nc):
+        mask = cls_sorted == c
+        if not mask.any() or not n_gt[c]:
+            continue
+        tpc = tp_sorted[mask].cumsum(0)
+        fpc = (~tp_sorted[mask]).cumsum(0)
+        recall = tpc / n_gt[c]
+        precision = tpc / (tpc + fpc)
+        for j in range(len(IOU_THRESHOLDS)):
+            ap[c, j], curve = compute_ap(recall[:, j], precision[:, j])
+            if j == 0:
+                pr_curves[c] = curve
+
+    # Confusion matrix rows are predictions, columns ground truth; index nc is background.
+    matrix = np.zeros((nc + 1, nc + 1), dtype=np.int64)
+    d, g = greedy_match(det_idx, gt_idx, ious, iou)
+    np.add.at(matrix, (det_cls[d], gt_cls[g]), 1)
+    unmatched_det = np.ones(len(det_conf), dtype=bool)
+    unmatched_det[d] = False
+    unmatched_gt = np.ones(len(gt_cls), dtype=bool)
+    unmatched_gt[g] = False
+    np.add.at(matrix, (det_cls[unmatched_det], nc), 1)
+    np.add.at(matrix, (nc, gt_cls[unmatched_gt]), 1)
+
+    present = n_gt > 0
+    precision = np.divide(n_tp, n_pred, out=np.zeros(nc), where=n_pred > 0)
+    recall = np.divide(n_tp, n_gt, out=np.zeros(nc), where=n_gt > 0)
+    return {
+        'conf': conf,
+        'iou': iou,
+        'images': int(n_images),
+        'instances': int(len(gt_cls)),
+        'precision': float(precision[present].mean()) if present.any() else 0.0,
+        'recall': float(recall[present].mean()) if present.any() else 0.0,
+        'map50': float(ap[present, 0].mean()) if present.any() else 0.0,
+        'map50_95': float(ap[present].mean()) if present.any() else 0.0,
+        'per_class': {
+            names[c]: {
+                'instances': int(n_gt[c]), 'predictions': int(n_pred[c]), 'precision': float(precision[c]),
+                'recall': float(recall[c]), 'ap50': float(ap[c, 0]), 'ap50_95': float(ap[c].mean()),
+            }
+            for c in range(nc)
+        },
+        'confusion_matrix': {'labels': [names[c] for c in range(nc)] + ['background'], 'matrix': matrix.tolist()},
+        'pr_curves': {'recall': np.linspace(0, 1, PR_POINTS).tolist(),
+                      'precision': {names[c]: pr_curves[c].tolist() for c in range(nc)}},
+    }
+
+def evaluate_cached(cache, labels_dir=LABELS_DIR, images=None, conf=0.25, iou=0.5, class_map=None):
+    names = {int(k): v for k, v in cache['meta']['names'].items()}
+    image_names = cache['images']
+    det = {k: cache[k] for k in empty_detections()}
+    if images is not None:
+        # Score only the images still in the split; the cache may hold more.
+        index = {name: i for i, name in enumerate(image_names.tolist())}
+        selected = np.array([index[name] for name in images if name in index], dtype=np.int64)
+        remap = np.full(len(image_names), -1, dtype=np.int64)
+        remap[selected] = np.arange(len(selected))
+        keep = remap[det['det_image']] >= 0
+        det = {k: v[keep] for k, v in det.items()}
+        det['det_image'] = remap[det['det_image']].astype(np.int32)
+        image_names, shapes = image_names[selected], cache['shapes'][selected]
+    else:
+        shapes = cache['shapes']
+    gt_image, gt_xyxy, gt_cls = load_ground_truth(image_names.tolist(), shapes, labels_dir)
+    return score(det['det_image'], det['det_xyxy'], det['det_conf'], det['det_cls'],
+                 gt_image, gt_xyxy, gt_cls, len(image_names), names, conf, iou, class_map)
+
+def history_detections(model_version=None, upload_dir=None):
+    # Latest finished prediction per uploaded file name, read from the indexed prediction_defect table.
+    from backend.app.models import SessionLocal, PredictionHistory, PredictionDefect
+    from backend.app.uploads import UPLOAD_DIR
+
+    upload_dir = upload_dir or UPLOAD_DIR
+    db = SessionLocal()
+    try:
+        query = db.query(PredictionHistory.id, PredictionHistory.original_filename, PredictionHistory.filename,
+                         PredictionHistory.model_version).filter(PredictionHistory.status == "SUCCESS")
+        if model_version:
+            query = query.filter(PredictionHistory.model_version == model_version)
+        latest = {}
+        for row in query.order_by(PredictionHistory.id):
+            latest[(row.model_version, os.path.splitext(row.original_filename or row.filename)[0])] = row
+        rows = list(latest.values())
+        ids = [row.id for row in rows]
+        defects = []
+        for start in range(0, len(ids), 5000):
+            defects.extend(db.query(
+                PredictionDefect.prediction_id, PredictionDefect.class_id, PredictionDefect.defect_type,
+                PredictionDefect.confidence, PredictionDefect.x1, PredictionDefect.y1, PredictionDefect.x2, PredictionDefect.y2,
+            ).filter(PredictionDefect.prediction_id.in_(ids[start:start + 5000])).all())
+    finally:
+        db.close()
+    return rows, defects, upload_dir
+
+def evaluate_history(labels_dir=LABELS_DIR, names=None, model_version=None, conf=0.25, iou=0.5, class_map=None,
+                     upload_dir=None):
+    rows, defects, upload_dir = history_detections(model_version, upload_dir)
+    reports = {}
+    for version in sorted({row.model_version for row in rows}, key=str):
+        version_rows = [row for row in rows if row.model_version == version]
+        index = {row.id: i for i, row in enumerate(version_rows)}
+        found = [d for d in defects if d.prediction_id in index]
+        image_names, shapes = [], []
+        for row in version_rows:
+            image_names.append(row.original_filename or row.filename)
+            try:
+                width, height = image_size(os.path.join(upload_dir, row.filename))
+            except Exception:
+                width, height = 0, 0
+            shapes.append((height, width))
+        gt_image, gt_xyxy, gt_cls = load_ground_truth(image_names, shapes, labels_dir)
+        version_names = names or {int(d.class_id): d.defect_type for d in found if d.class_id is not None}
+        # Rows written before class ids were stored only carry the class name.
+        class_ids = {name: i for i, name in version_names.items()}
+        reports[version] = score(
+            np.array([index[d.prediction_id] for d in found], dtype=np.int32),
+            np.array([[d.x1, d.y1, d.x2, d.y2] for d in found], dtype=np.float32).reshape(-1, 4),
+            np.array([d.confidence for d in found], dtype=np.float32),
+            np.array([class_ids.get(d.defect_type, d.class_id) for d in found], dtype=np.int16),
+            gt_image, gt_xyxy, gt_cls, len(version_rows), version_names, conf, iou, class_map,
+        )
+    return reports
+
+def print_report(report, title):
+    print(f"{title}: conf={report['conf']} iou={report['iou']} images={report['images']} instances={report['instances']}")
+    print(f"  mAP50: {report['map50']:.4f}  mAP50-95: {report['map50_95']:.4f}  "
+          f"Precision: {report['precision']:.4f}  Recall: {report['recall']:.4f}")
+    for name, m in report['per_class'].items():
+        if not m['instances'] and not m['predictions']:
+            continue
+        print(f"  {name:<14} n={m['instances']:<5} P={m['precision']:.3f} R={m['recall']:.3f} "
+              f"AP50={m['ap50']:.3f} AP50-95={m['ap50_95']:.3f}")
+
+def load_names(data_yaml=DATA_YAML):
+    import yaml
+    with open(data_yaml) as f:
+        names = yaml.safe_load(f)['names']
+    return {int(k): v for k, v in (names.items() if isinstance(names, dict) else enumerate(names))}
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score cached detections at any threshold")
+    parser.add_argument('source', choices=['model', 'history'],
+                        help="model: cached detections of --weights on --images; history: PredictionHistory rows")
+    parser.add_argument('--weights', default=MODEL_PATH)
+    parser.add_argument('--images', default=IMAGES_DIR)
+    parser.add_argument('--labels', default=LABELS_DIR)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--imgsz', type=int, default=IMGSZ)
+    parser.add_argument('--data-yaml', default=DATA_YAML, help="class names for history scoring")
+    parser.add_argument('--model-version', default=None, help="history: only this model version")
+    parser.add_argument('--conf', type=float, nargs='+', default=[0.25])
+    parser.add_argument('--iou', type=float, default=0.5)
+    parser.add_argument('--class-map', default=None, help="JSON file mapping class names to evaluation names")
+    parser.add_argument('--output', default=None, help="write full reports (confusion matrices, PR curves) as JSON")
+    args = parser.parse_args()
+
+    class_map = None
+    if args.class_map:
+        with open(args.class_map) as f:
+            class_map = json.load(f)
+
+    reports = {}
+    if args.source == 'model':
+        weights = args.weights if os.path.exists(args.weights) else 'yolov8n.pt'
+        _, cache = cache_detections(weights, args.images, args.cache_dir, args.imgsz)
+        images = list_images(args.images)
+        for conf in args.conf:
+            report = evaluate_cached(cache, args.labels, images, conf, args.iou, class_map)
+            reports.setdefault(cache['meta']['model_version'], []).append(report)
+            print_report(report, cache['meta']['model_version'])
+    else:
+        names = load_names(args.data_yaml) if os.path.exists(args.data_yaml) else None
+        for conf in args.conf:
+            for version, report in evaluate_history(args.labels, names, args.model_version, conf, args.iou, class_map).items():
+                reports.setdefault(version, []).append(report)
+                print_report(report, f"history {version}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f)
+        print(f"Reports saved to {args.output}")
+
+if __name__ == '__main__':
+    main()
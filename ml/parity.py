@@ -0,0 +1,114 @@
+from ultralytics import YOLO
+from pathlib import Path
+from datetime import datetime
+import numpy as np
+import json
+import os
+from backend.app.inference_backends import BACKEND_ARTIFACTS, DEFAULT_BACKEND, artifact_path, parity_report_path
+from backend.app.model_registry import file_digest
+
+MODEL_PATH = '/app/ml/yolov8_model/best.pt'
+IMAGES_DIR = '/app/ml/dataset/images/val'
+IMGSZ = 640
+MAX_IMAGES = 50
+CONF = 0.25
+MATCH_IOU = 0.5
+MIN_MATCH_RATE = 0.95
+MAX_CONF_DELTA = 0.05
+
+def box_iou(a, b):
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+def detect(model, images, imgsz=IMGSZ, conf=CONF):
+    outputs = []
+    for r in model(images, imgsz=imgsz, conf=conf, verbose=False, stream=True):
+        outputs.append((r.boxes.xyxy.cpu().numpy(), r.boxes.conf.cpu().numpy(), r.boxes.cls.cpu().numpy().astype(int)))
+    return outputs
+
+def match_detections(reference, candidate, iou_threshold=MATCH_IOU):
+    ref_boxes, ref_conf, ref_cls = reference
+    cand_boxes, cand_conf, cand_cls = candidate
+    if len(ref_boxes) == 0 or len(cand_boxes) == 0:
+        return 0, np.array([]), np.array([])
+    iou = box_iou(ref_boxes, cand_boxes)
+    iou[ref_cls[:, None] != cand_cls[None, :]] = 0
+    matched, ious, deltas = 0, [], []
+    used = np.zeros(len(cand_boxes), dtype=bool)
+    for i in np.argsort(-ref_conf):
+        row = np.where(used, 0, iou[i])
+        j = int(row.argmax())
+        if row[j] >= iou_threshold:
+            used[j] = True
+            matched += 1
+            ious.append(row[j])
+            deltas.append(abs(ref_conf[i] - cand_conf[j]))
+    return matched, np.array(ious), np.array(deltas)
+
+def compare(reference, candidate, iou_threshold=MATCH_IOU):
+    ref_total = sum(len(r[0]) for r in reference)
+    cand_total = sum(len(c[0]) for c in candidate)
+    matched, ious, deltas = 0, [], []
+    for ref, cand in zip(reference, candidate):
+        m, i, d = match_detections(ref, cand, iou_threshold)
+        matched += m
+        ious.append(i)
+        deltas.append(d)
+    ious = np.concatenate(ious) if ious else np.array([])
+    deltas = np.concatenate(deltas) if deltas else np.array([])
+    return {
+        "reference_detections": ref_total,
+        "backend_detections": cand_total,
+        "recall_vs_reference": matched / ref_total if ref_total else 1.0,
+        "precision_vs_reference": matched / cand_total if cand_total else 1.0,
+        "mean_iou": float(ious.mean()) if len(ious) else None,
+        "max_conf_delta": float(deltas.max()) if len(deltas) else 0.0,
+    }
+
+def run_parity(weights_path=MODEL_PATH, images_dir=IMAGES_DIR, imgsz=IMGSZ, max_images=MAX_IMAGES,
+               min_match_rate=MIN_MATCH_RATE, max_conf_delta=MAX_CONF_DELTA):
+    exts = {'.jpg', '.jpeg', '.png', '.bmp'}
+    images = [str(p) for p in sorted(Path(images_dir).rglob('*')) if p.suffix.lower() in exts][:max_images]
+    if not images:
+        print(f"No images found in {images_dir}")
+        return None
+
+    reference = detect(YOLO(weights_path), images, imgsz)
+    report = {
+        "source": weights_path,
+        "source_digest": file_digest(weights_path),
+        "images": len(images),
+        "checked_at": datetime.utcnow().isoformat(),
+        "thresholds": {"match_iou": MATCH_IOU, "min_match_rate": min_match_rate, "max_conf_delta": max_conf_delta},
+        "backends": {},
+    }
+    for backend in BACKEND_ARTIFACTS:
+        if backend == DEFAULT_BACKEND:
+            continue
+        artifact = artifact_path(weights_path, backend)
+        if not os.path.exists(artifact):
+            print(f"Skipping {backend}: {artifact} not found")
+            continue
+        try:
+            result = compare(reference, detect(YOLO(artifact, task='detect'), images, imgsz))
+            result["passed"] = (
+                result["recall_vs_reference"] >= min_match_rate
+                and result["precision_vs_reference"] >= min_match_rate
+                and result["max_conf_delta"] <= max_conf_delta
+            )
+        except Exception as e:
+            result = {"passed": False, "error": str(e)}
+        report["backends"][backend] = result
+        print(f"{backend}: {'PASS' if result['passed'] else 'FAIL'} {result}")
+
+    with open(parity_report_path(weights_path), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Parity report saved to {parity_report_path(weights_path)}")
+    return report
+
+if __name__ == '__main__':
+    run_parity()
@@ -0,0 +1,97 @@
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer, DetectionValidator
+from ultralytics.utils import colorstr
+from pathlib import Path
+import numpy as np
+import os
+from shards import ShardReader, load_meta
+
+def shard_dir_for(data, img_path, imgsz):
+    # data.yaml carries `shards: shards` once data_preprocessing has built them; the split is
+    # taken from the images/<split> path Ultralytics resolved from the same yaml.
+    if not data or not data.get('shards') or not isinstance(img_path, (str, Path)):
+        return None
+    split_dir = os.path.join(data['path'], data['shards'], Path(img_path).name)
+    meta = load_meta(split_dir)
+    if meta is None:
+        return None
+    if meta['imgsz'] != imgsz:
+        print(f"Shards in {split_dir} are {meta['imgsz']}px but imgsz={imgsz}, reading loose images instead")
+        return None
+    return split_dir
+
+class ShardedYOLODataset(YOLODataset):
+    def __init__(self, *args, shard_dir, **kwargs):
+        self.shards = ShardReader(shard_dir)
+        # The OS page cache already holds the decoded shards, so Ultralytics' RAM/disk caches would only duplicate them.
+        kwargs['cache'] = False
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        files = [os.path.join(self.shards.split_dir, sample_id) for sample_id in self.shards.samples]
+        if self.fraction < 1:
+            files = files[:round(len(files) * self.fraction)]
+        elif isinstance(self.fraction, int) and self.fraction > 1:
+            files = files[:self.fraction]
+        return files
+
+    def get_labels(self):
+        shape = (self.shards.imgsz, self.shards.imgsz)
+        labels = []
+        for i, im_file in enumerate(self.im_files):
+            boxes = np.array(self.shards.boxes(i), dtype=np.float32)
+            labels.append({
+                'im_file': im_file,
+                'shape': shape,
+                'cls': boxes[:, 0:1],
+                'bboxes': boxes[:, 1:5],
+                'segments': [],
+                'keypoints': None,
+                'normalized': True,
+                'bbox_format': 'xywh',
+            })
+        return labels
+
+    def load_image(self, i, *args, **kwargs):
+        # Read-only memmap view: no decode, no copy. Augmentations build new arrays from it.
+        im = self.shards.image(i)
+        if self.augment:
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return im, im.shape[:2], im.shape[:2]
+
+def build_sharded_dataset(cfg, img_path, batch, data, shard_dir, mode='train', rect=False, stride=32):
+    return ShardedYOLODataset(
+        img_path=img_path,
+        shard_dir=shard_dir,
+        imgsz=cfg.imgsz,
+        batch_size=batch,
+        augment=mode == 'train',
+        hyp=cfg,
+        rect=cfg.rect or rect,
+        single_cls=cfg.single_cls or False,
+        stride=int(stride),
+        pad=0.0 if mode == 'train' else 0.5,
+        prefix=colorstr(f"{mode}: "),
+        task=cfg.task,
+        classes=cfg.classes,
+        data=data,
+        fraction=cfg.fraction if mode == 'train' else 1.0,
+    )
+
+class ShardedDetectionTrainer(DetectionTrainer):
+    def build_dataset(self, img_path, mode='train', batch=None):
+        shard_dir = shard_dir_for(self.data, img_path, self.args.imgsz)
+        if shard_dir is None:
+            return super().build_dataset(img_path, mode, batch)
+        model = getattr(self.model, 'module', self.model)
+        gs = max(int(model.stride.max() if model else 0), 32)
+        return build_sharded_dataset(self.args, img_path, batch, self.data, shard_dir, mode, rect=mode == 'val', stride=gs)
+
+class ShardedDetectionValidator(DetectionValidator):
+    def build_dataset(self, img_path, mode='val', batch=None):
+        shard_dir = shard_dir_for(self.data, img_path, self.args.imgsz)
+        if shard_dir is None:
+            return super().build_dataset(img_path, mode, batch)
+        return build_sharded_dataset(self.args, img_path, batch, self.data, shard_dir, mode, stride=self.stride)
@@ -0,0 +1,171 @@
+import os
+import json
+import hashlib
+import shutil
+import numpy as np
+import cv2
+
+IMGSZ = 640
+SHARD_SIZE = 1024
+SHARDS_NAME = 'shards'
+SHARDS_VERSION = 1
+PAD_VALUE = 114
+
+# Layout per split (dataset/shards/<split>/):
+#   images-NNNNN.npy  uint8 (n, imgsz, imgsz, 3) BGR, letterboxed and centre-padded like Ultralytics' LetterBox
+#   labels.npy        float32 (m, 5) cls, x, y, w, h normalized to the letterboxed image
+#   offsets.npy       int64 (count + 1,) row ranges into labels.npy per image
+#   meta.json         sample ids, original shapes, shard sizes and the content key the shards were built from
+
+def letterbox(image, imgsz=IMGSZ):
+    h, w = image.shape[:2]
+    scale = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * scale)), int(round(h * scale))
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((imgsz, imgsz, 3), PAD_VALUE, dtype=np.uint8)
+    left, top = (imgsz - new_w) // 2, (imgsz - new_h) // 2
+    canvas[top:top + new_h, left:left + new_w] = image
+    return canvas, scale, (left, top)
+
+def letterbox_labels(labels, width, height, scale, pad, imgsz=IMGSZ):
+    labels = labels.astype(np.float32).copy()
+    labels[:, 1] = (labels[:, 1] * width * scale + pad[0]) / imgsz
+    labels[:, 2] = (labels[:, 2] * height * scale + pad[1]) / imgsz
+    labels[:, 3] = labels[:, 3] * width * scale / imgsz
+    labels[:, 4] = labels[:, 4] * height * scale / imgsz
+    return labels
+
+def split_key(entries, classes, imgsz):
+    h = hashlib.sha256(json.dumps([SHARDS_VERSION, imgsz, classes], sort_keys=True).encode())
+    for sample_id in sorted(entries):
+        entry = entries[sample_id]
+        h.update(f"{sample_id}\0{entry.get('json_sha256')}\0{entry.get('image_sha256')}\n".encode())
+    return h.hexdigest()
+
+_open_memmaps = {}
+
+def _write_row(item):
+    shard_path, row, image_path, label_path, imgsz = item
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Could not read image {image_path}")
+    height, width = image.shape[:2]
+    canvas, scale, pad = letterbox(image, imgsz)
+    images = _open_memmaps.get(shard_path)
+    if images is None:
+        images = _open_memmaps[shard_path] = np.load(shard_path, mmap_mode='r+')
+    images[row] = canvas
+    labels = np.zeros((0, 5), dtype=np.float32)
+    if os.path.getsize(label_path):
+        labels = np.loadtxt(label_path, dtype=np.float32, ndmin=2).reshape(-1, 5)
+    return letterbox_labels(labels, width, height, scale, pad, imgsz), (height, width)
+
+def _flush_memmaps():
+    for images in _open_memmaps.values():
+        images.flush()
+    _open_memmaps.clear()
+
+def write_split(output, split, entries, classes, imgsz=IMGSZ, shard_size=SHARD_SIZE, workers=1):
+    from data_preprocessing import _map
+
+    split_dir = os.path.join(output, SHARDS_NAME, split)
+    key = split_key(entries, classes, imgsz)
+    meta = load_meta(split_dir)
+    if meta and meta.get('key') == key:
+        print(f"Shards for {split} are up to date ({meta['count']} images)")
+        return False
+
+    tmp_dir = split_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    sample_ids = sorted(entries)
+    shards, items = [], []
+    for index, start in enumerate(range(0, len(sample_ids), shard_size)):
+        chunk = sample_ids[start:start + shard_size]
+        name = f"images-{index:05d}.npy"
+        shard_path = os.path.join(tmp_dir, name)
+        np.lib.format.open_memmap(shard_path, mode='w+', dtype=np.uint8, shape=(len(chunk), imgsz, imgsz, 3)).flush()
+        shards.append({'file': name, 'count': len(chunk)})
+        for row, sample_id in enumerate(chunk):
+            entry = entries[sample_id]
+            items.append((shard_path, row, os.path.join(output, entry['image']), os.path.join(output, entry['label']), imgsz))
+
+    # Pool processes write through shared file mappings, so their rows land in the page cache
+    # even though only this process's maps are flushed explicitly.
+    results = list(_map(_write_row, items, workers))
+    _flush_memmaps()
+
+    labels = [r[0] for r in results]
+    offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(lb) for lb in labels])
+    np.save(os.path.join(tmp_dir, 'labels.npy'), np.concatenate(labels) if labels else np.zeros((0, 5), np.float32))
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': SHARDS_VERSION,
+            'key': key,
+            'imgsz': imgsz,
+            'classes': classes,
+            'count': len(sample_ids),
+            'shards': shards,
+            'samples': sample_ids,
+            'ori_shapes': [r[1] for r in results],
+        }, f)
+
+    shutil.rmtree(split_dir, ignore_errors=True)
+    os.rename(tmp_dir, split_dir)
+    print(f"Wrote {len(sample_ids)} {split} images to {len(shards)} shard(s) in {split_dir}")
+    return True
+
+def write_shards(output, manifest, imgsz=IMGSZ, shard_size=SHARD_SIZE, workers=1):
+    samples = manifest.get('samples', {})
+    for split in ['train', 'val']:
+        entries = {sid: e for sid, e in samples.items() if e.get('split') == split and e.get('image')}
+        write_split(output, split, entries, manifest.get('classes', []), imgsz, shard_size, workers)
+
+def load_meta(split_dir):
+    path = os.path.join(split_dir, 'meta.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        meta = json.load(f)
+    return meta if meta.get('version') == SHARDS_VERSION else None
+
+class ShardReader:
+    # Shards are opened lazily and read-only so forked or spawned dataloader workers map the
+    # same page-cache pages instead of each holding decoded copies.
+    def __init__(self, split_dir):
+        self.split_dir = split_dir
+        self.meta = load_meta(split_dir)
+        if self.meta is None:
+            raise FileNotFoundError(f"No shards found in {split_dir}")
+        self.labels = np.load(os.path.join(split_dir, 'labels.npy'))
+        self.offsets = np.load(os.path.join(split_dir, 'offsets.npy'))
+        self._starts = np.cumsum([0] + [s['count'] for s in self.meta['shards']])
+        self._images = None
+
+    def __len__(self):
+        return self.meta['count']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    @property
+    def samples(self):
+        return self.meta['samples']
+
+    @property
+    def imgsz(self):
+        return self.meta['imgsz']
+
+    def image(self, i):
+        if self._images is None:
+            self._images = [np.load(os.path.join(self.split_dir, s['file']), mmap_mode='r') for s in self.meta['shards']]
+        shard = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return self._images[shard][i - self._starts[shard]]
+
+    def boxes(self, i):
+        return self.labels[self.offsets[i]:self.offsets[i + 1]]
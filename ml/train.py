@@ -1,4 +1,8 @@
 from ultralytics import YOLO
+from export import export_all
+from parity import run_parity
+from sharded_dataset import ShardedDetectionTrainer
+from backend.app.model_store import register_version, weights_path, promote
 import os
 
 def train_model():
@@ -6,7 +10,9 @@ def train_model():
 
     
     print("Starting training...")
+    # Reads the memory-mapped shards when data.yaml lists them, loose images otherwise.
     results = model.train(
+        trainer=ShardedDetectionTrainer,
         data='/app/ml/data.yaml',
         epochs=20, 
         imgsz=640, 
@@ -16,15 +22,18 @@ def train_model():
         name='pcb_defect_v1'
     )
     
-    success = model.export(format='torchscript')
-    
     best_model_path = '/app/ml/runs/pcb_defect_v1/weights/best.pt'
-    target_path = '/app/ml/yolov8_model/best.pt'
     
     if os.path.exists(best_model_path):
-        os.makedirs(os.path.dirname(target_path), exist_ok=True)
-        os.rename(best_model_path, target_path)
-        print(f"Model saved to {target_path}")
+        # Workers only see the new weights once they are fully written, exported and
+        # parity-checked; promote flips the store pointer they poll in one rename.
+        version = register_version(best_model_path)
+        target_path = weights_path(version)
+        print(f"Model registered as {version} at {target_path}")
+        export_all(target_path)
+        run_parity(target_path)
+        promote(version)
+        print(f"Promoted {version}")
     else:
         print("Training finished but best.pt not found (maybe run locally?)")
 